@@ -0,0 +1,126 @@
+import sys
+import time
+import argparse
+from podio import root_io
+import edm4hep
+from tree_tools import index_track_hits, index_pfo_cluster_hits, index_pfo_tracks
+
+# per-hit scans of the conformal tracking tracks and of the pandora pfos (as done
+# before the HitIndex lookups) against the inverted indices, on CLD events,
+# ideally busy ones with overlay, e.g.
+# python benchmark_hit_association.py out_reco_edm4hep_REC.edm4hep.root --events 20
+
+tracker_hit_collections = [
+    "VXDTrackerHits",
+    "VXDEndcapTrackerHits",
+    "ITrackerHits",
+    "OTrackerHits",
+    "ITrackerEndcapHits",
+    "OTrackerEndcapHits",
+]
+calo_hit_collections = ["ECALBarrel", "ECALEndcap", "HCALBarrel", "HCALEndcap", "HCALOther"]
+
+
+def scan_track_of_hit(hit_index, hit_collection, track_collection):
+    # same loop as the former find_trackCT_pfo_and_cluster_of_hit, the break only
+    # leaves the hits of the track: the last track containing the hit wins
+    track_index = -1
+    for index_track, track in enumerate(track_collection):
+        for hit in track.getTrackerHits():
+            object_id_hit = hit.getObjectID()
+            if hit_index == object_id_hit.index and object_id_hit.collectionID == hit_collection:
+                track_index = index_track
+                break
+    return track_index
+
+
+def scan_pfo_of_hit(hit_index, hit_collection, pfo_collection):
+    for index_pfo, pfo in enumerate(pfo_collection):
+        for cluster in pfo.getClusters():
+            for hit in cluster.getHits():
+                object_id_hit = hit.getObjectID()
+                if hit_index == object_id_hit.index and object_id_hit.collectionID == hit_collection:
+                    return index_pfo
+    return -1
+
+
+def scan_pfo_of_track(track_index, track_collection, pfo_collection):
+    for index_pfo, pfo in enumerate(pfo_collection):
+        for track in pfo.getTracks():
+            object_id = track.getObjectID()
+            if track_index == object_id.index and object_id.collectionID == track_collection:
+                return index_pfo
+    return -1
+
+
+def hits_of_event(event, names):
+    hits = []
+    for name in names:
+        try:
+            coll = event.get(name)
+        except Exception:
+            continue
+        for hit in coll:
+            object_id = hit.getObjectID()
+            hits.append((object_id.index, object_id.collectionID))
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="CLD reco edm4hep file")
+    parser.add_argument("--events", default=10, type=int)
+    parser.add_argument("--skip-scan", action="store_true", default=False)
+    args = parser.parse_args()
+
+    reader = root_io.Reader(args.input)
+    timings = {"scan": 0.0, "index": 0.0}
+    n_lookups = 0
+    for i, event in enumerate(reader.get("events")):
+        if i >= args.events:
+            break
+        tracks = event.get("SiTracks_Refitted")
+        pfos = event.get("PandoraPFOs")
+        tracker_hits = hits_of_event(event, tracker_hit_collections)
+        calo_hits = hits_of_event(event, calo_hit_collections)
+        track_ids = [(t.getObjectID().index, t.getObjectID().collectionID) for t in tracks]
+        n_lookups += len(tracker_hits) + len(calo_hits) + len(track_ids)
+
+        t0 = time.time()
+        track_hit_index = index_track_hits(tracks)
+        pfo_hit_index = index_pfo_cluster_hits(pfos)
+        pfo_track_index = index_pfo_tracks(pfos)
+        result_index = (
+            [track_hit_index.get(j, c)[0] for j, c in tracker_hits],
+            [pfo_hit_index.get(j, c)[3] for j, c in calo_hits],
+            [pfo_track_index.get(j, c)[1] for j, c in track_ids],
+        )
+        timings["index"] += time.time() - t0
+
+        if not args.skip_scan:
+            t0 = time.time()
+            result_scan = (
+                [scan_track_of_hit(j, c, tracks) for j, c in tracker_hits],
+                [scan_pfo_of_hit(j, c, pfos) for j, c in calo_hits],
+                [scan_pfo_of_track(j, c, pfos) for j, c in track_ids],
+            )
+            timings["scan"] += time.time() - t0
+            if result_scan != result_index:
+                print("event {}: index and scan differ".format(i))
+                sys.exit(1)
+        print(
+            "event {}: {} tracker hits, {} calo hits, {} tracks, {} pfos".format(
+                i, len(tracker_hits), len(calo_hits), len(track_ids), len(pfos)
+            )
+        )
+
+    for name, dt in timings.items():
+        if name == "scan" and args.skip_scan:
+            continue
+        print("{:>6}: {} lookups in {:.2f} s".format(name, n_lookups, dt))
+    if not args.skip_scan and timings["index"] > 0:
+        print("speed-up: {:.1f}x".format(timings["scan"] / timings["index"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import os
 import sys
 import math
 import ROOT
@@ -6,6 +7,8 @@ from ROOT import TFile, TTree
 import numpy as np
 from podio import root_io
 import edm4hep
+# parquet_tree is shared with the IDEA converter, see tree_tools.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_processing"))
 from tree_tools import (
     initialize,
     clear_dic,
@@ -13,6 +16,7 @@ from tree_tools import (
     store_gen_particles,
     store_track_hits,
 )
+from parquet_tree import ParquetTree
 
 # TODO
 # is last track state position at calo?
@@ -40,10 +44,16 @@ store_pandora_hits = sys.argv[3]
 print("will store calo hits", store_pandora_hits)
 store_tau = sys.argv[4]
 print("will store store_tau", store_tau)
+# output.parquet is written as parquet in row groups of row_group_size events
+row_group_size = int(sys.argv[5]) if len(sys.argv) > 5 else 1000
 reader = root_io.Reader(input_file)
 metadata = reader.get("metadata")[0]
-out_root = TFile(output_file, "RECREATE")
-t = TTree("events", "pf tree lar")
+if output_file.endswith(".parquet"):
+    out_root = None
+    t = ParquetTree(output_file, row_group_size)
+else:
+    out_root = TFile(output_file, "RECREATE")
+    t = TTree("events", "pf tree lar")
 event_number, n_hit, n_part, dic, t = initialize(t, store_tau)
 
 event_number[0] = 0
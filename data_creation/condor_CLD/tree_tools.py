@@ -1,3 +1,4 @@
+import os
 import sys
 import math
 import ROOT
@@ -8,6 +9,20 @@ from podio import root_io
 import edm4hep
 import dd4hep as dd4hepModule
 from ROOT import dd4hep
+# modules shared with the other converters (mc_ancestry, edm4hep_index,
+# parquet_tree): next to this file when copied to the job directory, in
+# data_processing otherwise
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_processing"))
+from mc_ancestry import MCParticleTable
+from edm4hep_index import (
+    HitIndex,
+    index_cluster_hits,
+    index_track_hits,
+    index_pfo_cluster_hits,
+    index_pfo_tracks,
+    LinkTable,
+    sim_hit_mc_links,
+)
 
 c_light = 2.99792458e8
 Bz_clic = 4.0
@@ -52,26 +67,9 @@ def get_genparticle_daughters(i, mcparts):
     return daughter_positions
 
 
-def find_pandora_cluster_of_hit(hit_index, hit_collection, cluster_collection):
-
-    for index_c, cluster in enumerate(cluster_collection):
-        cluster_hits = cluster.getHits()
-        cluster_energy = cluster.getEnergy()
-        for index_h, hit in enumerate(cluster_hits):
-            object_id_hit = hit.getObjectID()
-            if (
-                hit_index == object_id_hit.index
-                and object_id_hit.collectionID == hit_collection
-            ):
-                pandora_cluster_index = index_c
-                cluster_energy_found = cluster_energy
-                break
-            else:
-                pandora_cluster_index = -1
-                cluster_energy_found = 0
-        if pandora_cluster_index >= 0:
-            break
-    return pandora_cluster_index, cluster_energy_found
+def find_pandora_cluster_of_hit(hit_index, hit_collection, cluster_hit_index):
+    # cluster_hit_index = index_cluster_hits(cluster_collection)
+    return cluster_hit_index.get(hit_index, hit_collection)
 
 
 # def check_pandora_pfos(event):
@@ -89,83 +87,20 @@ def find_pandora_cluster_of_hit(hit_index, hit_collection, cluster_collection):
 #         #     cluster_energy = cluster.getEnergy()
 #         #     print("cluster energy", cluster_energy)
 #         break
-def find_trackCT_pfo_and_cluster_of_hit(hit_index, hit_collection, track_collection):
-    track_index = -1
-    for index_track, track in enumerate(track_collection):
-        # print(dir(track))
-        track_hits = track.getTrackerHits()
-        for index_h, hit in enumerate(track_hits):
-            object_id_hit = hit.getObjectID()
-            if (
-                hit_index == object_id_hit.index
-                and object_id_hit.collectionID == hit_collection
-            ):
-                track_index = index_track
-                break
-    return track_index
-
-
-def find_pandora_pfo_and_cluster_of_hit(
-    hit_index, hit_collection, cluster_collection, pfo_collection
-):
-    pandora_cluster_index = -1
-    pfo_index = -1
-    for index_pfo, pfo in enumerate(pfo_collection):
-        # print("index pfo ", index_pfo)
-        clusters_pfo = pfo.getClusters()
-        pfo_energy = pfo.getEnergy()
-        for index_c, cluster in enumerate(clusters_pfo):
-            # print("index cluster ", index_c)
-            cluster_hits = cluster.getHits()
-            cluster_energy = cluster.getEnergy()
-            cluster_id = cluster.getObjectID().index
-            for index_h, hit in enumerate(cluster_hits):
-                object_id_hit = hit.getObjectID()
-                if (
-                    hit_index == object_id_hit.index
-                    and object_id_hit.collectionID == hit_collection
-                ):
-                    pandora_cluster_index = cluster_id
-                    cluster_energy_found = cluster_energy
-                    pfo_energy_found = pfo_energy
-                    pfo_index = index_pfo
-                    break
-                else:
-                    pandora_cluster_index = -1
-                    cluster_energy_found = 0
-                    pfo_energy_found = 0
-                    pfo_index = -1
-            if pandora_cluster_index >= 0:
-                break
-        if pandora_cluster_index >= 0:
-            break
-    # print("PFO", pfo_index, pfo_energy_found)
-    return pandora_cluster_index, cluster_energy_found, pfo_energy_found, pfo_index
-
-
-def find_pandora_pfo_track(hit_index, hit_collection, pfo_collection):
-    pandora_cluster_index = -1
-    pandora_pfo_index = -1
-    pfo_energy_found = 0
-    for index_pfo, pfo in enumerate(pfo_collection):
-        tracks_pfo = pfo.getTracks()
-        pfo_energy = pfo.getEnergy()
-        for index_t, track in enumerate(tracks_pfo):
-            # print("index cluster ", index_c)
-            track_index = track.getObjectID().index
-            track_collection_id = track.getObjectID().collectionID
-
-            if hit_index == track_index and track_collection_id == hit_collection:
-                pandora_pfo_index = index_pfo
-                pfo_energy_found = pfo_energy
-                break
-            else:
-                pandora_pfo_index = -1
-                pfo_energy_found = 0
-        if pandora_pfo_index >= 0:
-            break
-    # print(pandora_cluster_index, pfo_energy_found, pandora_pfo_index)
-    return pandora_cluster_index, pfo_energy_found, pandora_pfo_index
+def find_trackCT_pfo_and_cluster_of_hit(hit_index, hit_collection, track_hit_index):
+    # track_hit_index = index_track_hits(track_collection)
+    return track_hit_index.get(hit_index, hit_collection)[0]
+
+
+def find_pandora_pfo_and_cluster_of_hit(hit_index, hit_collection, pfo_hit_index):
+    # pfo_hit_index = index_pfo_cluster_hits(pfo_collection)
+    return pfo_hit_index.get(hit_index, hit_collection)
+
+
+def find_pandora_pfo_track(hit_index, hit_collection, pfo_track_index):
+    # pfo_track_index = index_pfo_tracks(pfo_collection)
+    pfo_energy_found, pandora_pfo_index = pfo_track_index.get(hit_index, hit_collection)
+    return -1, pfo_energy_found, pandora_pfo_index
 
 
 def get_genparticle_parents(i, mcparts):
@@ -198,63 +133,20 @@ def find_mother_particle(j, gen_part_coll):
     return pp_old
 
 
-def find_mother_particle_check_tau(j, gen_part_coll, tau_index0, tau_index1):
-    parent_p = j
-    counter = 0
-    belongs_to_tau1 = False
-    belongs_to_tau2 = False
-    while len(np.reshape(np.array(parent_p), -1)) < 1.5:
-        if type(parent_p) == list:
-            if len(parent_p) > 0:
-                parent_p = parent_p[0]
-            else:
-                break
-        parent_p_r = get_genparticle_parents(
-            parent_p,
-            gen_part_coll,
-        )
-        if len(parent_p_r) == 0:
-            break
-        if parent_p_r[0] == tau_index0:
-            belongs_to_tau1 = True
-        if parent_p_r[0] == tau_index1:
-            belongs_to_tau2 = True
-        pp_old = parent_p
-        counter = counter + 1
-        parent_p = parent_p_r
-        if belongs_to_tau1 or belongs_to_tau2:
-            break
-
-    return pp_old, belongs_to_tau1, belongs_to_tau2
-
-
 def find_gen_link(
     j,
     id,
-    SiTracksMCTruthLink,
-    # gen_link_indexmc,
-    # gen_link_weight,
+    link_table,
     genpart_indexes,
     calo=False,
     gen_part_coll=None,
 ):
-    # print(id)
-    gen_positions = []
-    gen_weights = []
-    for i, l in enumerate(SiTracksMCTruthLink):
-        rec_ = l.getRec()
-        object_id = rec_.getObjectID()
-        index = object_id.index
-        collectionID = object_id.collectionID
-        # print(index, j, collectionID, id)
-        if index == j and collectionID == id:
-            # print(j, "found match")
-            gen_positions.append(l.getSim().getObjectID().index)
-            weight = l.getWeight()
-            gen_weights.append(weight)
+    # link_table = LinkTable(event.get("SiTracksMCTruthLink"))
+    gen_positions, _, gen_weights = link_table.links(j, id)
+    gen_weights = gen_weights.tolist()
 
     indices = []
-    for i, pos in enumerate(gen_positions):
+    for i, pos in enumerate(gen_positions.tolist()):
         if pos in genpart_indexes:
             if calo:
                 mother = find_mother_particle(genpart_indexes[pos], gen_part_coll)
@@ -268,46 +160,19 @@ def find_gen_link(
     return indices, gen_weights
 
 
-def find_gen_link_track(
-    j, id, SiTracksMCTruthLink, simcollection, gen_part_coll, store_taus, index_taus
-):
-    gen_positions = []
-    for i, l in enumerate(SiTracksMCTruthLink):
-        rec_ = l.getRec()
-        object_id = rec_.getObjectID()
-        index = object_id.index
-        collectionID = object_id.collectionID
-        # print(index, j, collectionID, id)
-        if index == j and collectionID == id:
-            # print(j, "found match")
-            index_take = l.getSim().getObjectID().index
-            if (
-                l.getSim().getObjectID().collectionID
-                == simcollection[index_take].getObjectID().collectionID
-            ):
-                index_mc_particle = (
-                    simcollection[index_take].getMCParticle().getObjectID().index
-                )
-                gen_positions.append(index_mc_particle)
-                if store_taus == "True":
-                    p, belongs_to_tau_1, belongs_to_tau_2 = (
-                        find_mother_particle_check_tau(
-                            index_mc_particle,
-                            gen_part_coll,
-                            index_taus[0],
-                            index_taus[1],
-                        )
-                        )
-                    if belongs_to_tau_1:
-                        index_tau = index_taus[0]
-                    elif belongs_to_tau_2:
-                        index_tau = index_taus[1]
-                    else:
-                        index_tau = -1
-                    # find mother to find tau
-
-                    break
+def find_gen_link_track(j, id, link_table, sim_links, store_taus, tau_of_mc=None):
+    # link_table = LinkTable(relation_collection), sim_links = sim_hit_mc_links(sim_collection)
+    # tau_of_mc: hit_genlink_tau of every MC particle (MCAncestry.tau_index)
+    sim_collection_id, mc_of_sim = sim_links
+    sim_index, sim_collection, _ = link_table.links(j, id)
+    keep = (sim_collection == sim_collection_id) & (sim_index < len(mc_of_sim))
+    gen_positions = mc_of_sim[sim_index[keep]].tolist()
     if store_taus == "True":
+        # only the first link is used for the tau
+        gen_positions = gen_positions[:1]
+        index_tau = -1
+        if len(gen_positions) > 0 and gen_positions[0] >= 0:
+            index_tau = tau_of_mc[gen_positions[0]]
         return gen_positions, index_tau
     else:
         return gen_positions, 0
@@ -619,7 +484,9 @@ def store_tracks(
     # gen_calo_links1 = "CalohitMCTruthLink#1"
     # gen_calo_weights = "CalohitMCTruthLink"
     pandora_pfos_event = event.get(pandora_pfo)
-    gen_track_link_indextr = event.get(SiTracksMCTruthLink)
+    pfo_track_index = index_pfo_tracks(pandora_pfos_event)
+    # one pass over the links, shared by the two track states
+    gen_track_link_indextr = LinkTable(event.get(SiTracksMCTruthLink))
     # gen_track_link_indexmc = event.get(gen_track_links1)
     # gen_track_link_weight = event.get(gen_track_weights)
 
@@ -678,7 +545,7 @@ def store_tracks(
             ) = find_pandora_pfo_track(
                 track.getObjectID().index,
                 track.getObjectID().collectionID,
-                pandora_pfos_event,
+                pfo_track_index,
             )
             dic["hit_pandora_cluster_energy"].push_back(0)
             dic["hit_pandora_pfo_energy"].push_back(pandora_pfo_energy)
@@ -870,6 +737,9 @@ def store_track_hits(
     o_endcap_relation = "OuterTrackerEndcapHitsRelations"
 
     conformal_tracking_trakcs = event.get("SiTracks_Refitted")
+    if store_pandora_hits == "True":
+        # hit -> conformal tracking track, inverted once per event
+        track_hit_index = index_track_hits(conformal_tracking_trakcs)
     calohit_collections_sim = [
         vxd_barrel_sim,
         vxd_endcap_sim,
@@ -904,9 +774,16 @@ def store_track_hits(
         "InnerTrackerEndcapCollection__CellIDEncoding",
         "OuterTrackerBarrelCollection__CellIDEncoding",
     ]
+    tau_of_mc = None
+    if store_tau == "True":
+        # tau ancestor of every MC particle, resolved once per event
+        ancestry = MCParticleTable.from_collection(gen_part_coll).ancestry
+        tau_of_mc = ancestry.tau_index(index_taus).tolist()
     for calohit_col_index, calohit_coll in enumerate(calohit_collections):
-        relation_collection = event.get(calohit_collections_relation[calohit_col_index])
-        sim_collection = event.get(calohit_collections_sim[calohit_col_index])
+        relation_collection = LinkTable(
+            event.get(calohit_collections_relation[calohit_col_index])
+        )
+        sim_links = sim_hit_mc_links(event.get(calohit_collections_sim[calohit_col_index]))
         cellid_encoding = metadata.get_parameter(names_of_encoders[calohit_col_index])
         decoder = dd4hep.BitFieldCoder(cellid_encoding)
         if debug:
@@ -941,10 +818,9 @@ def store_track_hits(
                 j,
                 hit_collection,
                 relation_collection,
-                sim_collection,
-                gen_part_coll=gen_part_coll,
+                sim_links,
                 store_taus=store_tau,
-                index_taus=index_taus,
+                tau_of_mc=tau_of_mc,
             )
 
             if store_tau == "True":
@@ -958,7 +834,7 @@ def store_track_hits(
                 track_index = find_trackCT_pfo_and_cluster_of_hit(
                     j,
                     hit_collection,
-                    conformal_tracking_trakcs,
+                    track_hit_index,
                 )
                 dic["pandora_track_index"].push_back(track_index)
 
@@ -38,6 +38,9 @@ if [[ "${SAMPLE}" == "Zcard_tau_CLD" ]]
 fi
 cp $PFDIR/data_processing/process_tree_global.py ./
 cp $PFDIR/data_processing/tools_tree_global.py ./
+cp $PFDIR/data_processing/cellid_decoder.py ./
+cp $PFDIR/data_processing/parquet_tree.py ./
+cp $PFDIR/data_processing/mc_ancestry.py ./
 cp $K4RECTRACKER_dir/runIDEAtrackerDigitizer.py ./
 
 source /cvmfs/sw.hsf.org/key4hep/setup.sh -r 2024-10-03
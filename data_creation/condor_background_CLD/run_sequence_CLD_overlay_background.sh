@@ -19,6 +19,8 @@ cp -r /afs/cern.ch/work/m/mgarciam/private/CLD_Config_versions/CLDConfig_230924_
 cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/condor_background_CLD/runOverlayTiming.py .
 cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/condor_background_CLD/make_pftree_clic_bindings.py .
 cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/condor_background_CLD/tree_tools.py .
+cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/data_processing/mc_ancestry.py .
+cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/data_processing/edm4hep_index.py .
 
 if [[ "${SAMPLE}" == "Zcard_CLD" ]]
       then 
@@ -42,10 +42,13 @@ for event in reader.get("events"):
         e_pp,
         gen_part_coll,
         index_taus,
+        mc_table,
     ) = gen_particles_find(event, debug, store_tau)
     # if event_numbers == 8:
     clear_dic(dic)
     n_part[0] = 0
+    # parent links of the event, shared by the CDC and VTX hits
+    ancestry = mc_table.ancestry
     n_hit, dic, list_of_MCs1 = store_hit_col_CDC(
         event,
         n_hit,
@@ -54,6 +57,7 @@ for event in reader.get("events"):
         gen_part_coll,
         index_taus=index_taus,
         store_tau=store_tau,
+        ancestry=ancestry,
     )
     n_hit, dic, list_of_MCs2 = store_hit_col_VTX(
         event,
@@ -62,6 +66,7 @@ for event in reader.get("events"):
         gen_part_coll,
         index_taus=index_taus,
         store_tau=store_tau,
+        ancestry=ancestry,
     )
     unique_MCS = merge_list_MCS(list_of_MCs1, list_of_MCs2, store_tau, index_taus)
     n_part, dic = read_mc_collection(event, dic, n_part, debug, unique_MCS)
@@ -30,6 +30,8 @@ fi
 
 cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/condor_background_IDEA/process_tree_global.py .
 cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/condor_background_IDEA/tools_tree_global.py .
+cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/data_processing/cellid_decoder.py .
+cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/data_processing/mc_ancestry.py .
 cp /afs/cern.ch/work/m/mgarciam/private/Tracking_wcoc/data_creation/condor_background_IDEA/runIDEAtrackerDigitizer.py ./
 
 if [[ "${SAMPLE}" == "Zcard_CLD" ]]
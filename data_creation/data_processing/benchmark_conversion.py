@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+import uproot
+
+# events/s of process_tree_global.py (podio, one python call per hit) against
+# process_tree_global_columnar.py on the same digitized IDEA file, e.g.
+# python benchmark_conversion.py output_IDEA_DIGI.root --store-tau True
+
+
+def run(script, args, outfile):
+    t0 = time.time()
+    subprocess.run(
+        [sys.executable, script] + args,
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+    )
+    dt = time.time() - t0
+    with uproot.open(outfile) as f:
+        n_events = f["events"].num_entries
+    return n_events, dt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="digitized edm4hep file (output_IDEA_DIGI.root)")
+    parser.add_argument("--outdir", default=".", help="where to write the two ntuples")
+    parser.add_argument("--store-tau", default="False")
+    parser.add_argument("--step", default=500, type=int, help="events per chunk")
+    parser.add_argument("--skip-podio", action="store_true", default=False)
+    args = parser.parse_args()
+
+    input_file = os.path.abspath(args.input)
+    out_podio = os.path.abspath(os.path.join(args.outdir, "benchmark_podio.root"))
+    out_columnar = os.path.abspath(os.path.join(args.outdir, "benchmark_columnar.root"))
+
+    results = {}
+    if not args.skip_podio:
+        results["podio"] = run(
+            "process_tree_global.py", [input_file, out_podio, args.store_tau], out_podio
+        )
+    results["columnar"] = run(
+        "process_tree_global_columnar.py",
+        [input_file, out_columnar, args.store_tau, str(args.step)],
+        out_columnar,
+    )
+    for name, (n_events, dt) in results.items():
+        print(
+            "{:>10}: {} events in {:.1f} s -> {:.2f} events/s".format(
+                name, n_events, dt, n_events / dt
+            )
+        )
+    if "podio" in results:
+        speedup = (results["columnar"][0] / results["columnar"][1]) / (
+            results["podio"][0] / results["podio"][1]
+        )
+        print("columnar speed-up: {:.1f}x".format(speedup))
+
+
+if __name__ == "__main__":
+    main()
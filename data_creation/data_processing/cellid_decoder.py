@@ -0,0 +1,47 @@
+import numpy as np
+
+# numpy replacement of dd4hep.BitFieldCoder: the encoding string is parsed once
+# and whole arrays of cellIDs are decoded with shifts and masks
+
+
+class CellIDDecoder(object):
+    def __init__(self, cellid_encoding):
+        # dummy example, cellid_encoding = "foo:2,bar:3,baz:-4"
+        # a field is either name:width or name:offset:width, a negative width is signed
+        self.cellid_encoding = cellid_encoding
+        self.fields = {}
+        offset = 0
+        for field in cellid_encoding.split(","):
+            name, *spec = field.strip().split(":")
+            if len(spec) == 2:
+                offset = int(spec[0])
+            width = int(spec[-1])
+            self.fields[name] = (offset, abs(width), width < 0)
+            offset += abs(width)
+
+    def get(self, cellid, name):
+        offset, width, signed = self.fields[name]
+        cellid = np.asarray(cellid).astype(np.int64)
+        value = (cellid >> offset) & ((1 << width) - 1)
+        if signed:
+            value = np.where(value >= (1 << (width - 1)), value - (1 << width), value)
+        return value
+
+    def decode(self, cellid, names=None):
+        if names is None:
+            names = self.fields.keys()
+        return {name: self.get(cellid, name) for name in names}
+
+
+_decoders = {}
+
+
+def get_decoder(cellid_encoding):
+    # one decoder per encoding string, shared by all the events of a file
+    if cellid_encoding not in _decoders:
+        _decoders[cellid_encoding] = CellIDDecoder(cellid_encoding)
+    return _decoders[cellid_encoding]
+
+
+def decoder_from_metadata(metadata, collection="CDCHHits"):
+    return get_decoder(metadata.get_parameter(collection + "__CellIDEncoding"))
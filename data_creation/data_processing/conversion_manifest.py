@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+
+# bookkeeping of convert_parallel.py, one json record per line in
+# {outdir}/manifest.jsonl. Records are only appended, the last record of a key
+# wins, so an interrupted run leaves a valid manifest behind:
+# {"type": "input", "path", "size", "mtime", "content_hash"}
+# {"type": "task", "key", "input", "content_hash", "entry_start", "entry_stop",
+#  "output", "converter_version", "store_tau", "n_events"}
+# {"type": "shard", "key", "output", "tasks", "n_events"}
+
+# modules whose code changes the converted output
+converter_modules = ["tools_columnar.py", "cellid_decoder.py", "mc_ancestry.py"]
+
+
+def md5_of(values):
+    return hashlib.md5(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def file_hash(path, blocksize=1 << 24):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def converter_version():
+    here = os.path.dirname(os.path.abspath(__file__))
+    md5 = hashlib.md5()
+    for name in converter_modules:
+        with open(os.path.join(here, name), "rb") as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, path):
+        self.path = path
+        self.records = {"input": {}, "task": {}, "shard": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line of a run killed while writing
+                        continue
+                    self.records[record["type"]][self._key(record)] = record
+
+    @staticmethod
+    def _key(record):
+        return record["path"] if record["type"] == "input" else record["key"]
+
+    def add(self, record):
+        self.records[record["type"]][self._key(record)] = record
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def content_hash(self, path):
+        # the md5 of an input is recomputed only if its size or mtime changed
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        record = self.records["input"].get(path)
+        if record is None or record["size"] != stat.st_size or record["mtime"] != stat.st_mtime:
+            record = {
+                "type": "input",
+                "path": path,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "content_hash": file_hash(path),
+            }
+            self.add(record)
+        return record["content_hash"]
+
+    def done(self, kind, key, output):
+        record = self.records[kind].get(key)
+        return record is not None and record["output"] == output and os.path.exists(output)
@@ -0,0 +1,224 @@
+import os
+import re
+import glob
+import shutil
+import argparse
+import time
+import uproot
+from concurrent.futures import ProcessPoolExecutor
+from tools_columnar import convert_file, open_output, read_converted
+from conversion_manifest import Manifest, converter_version, md5_of
+
+# local (non-condor) driver for the columnar converter: the input files are
+# split in event ranges, converted in parallel by a process pool and merged
+# back in input order into training shards of a fixed number of events, e.g.
+# python convert_parallel.py "/path/to/output_IDEA_DIGI_*.root" --outdir out/ --workers 16
+# Every converted event range and every shard is recorded in {outdir}/manifest.jsonl:
+# running the same command again only converts the ranges and writes the shards
+# whose input content, converter code or options changed, or that were not
+# finished when the previous run stopped. The shards and converted ranges of a
+# previous run that are not part of this one (fewer input events, another
+# --format, ...) are removed.
+
+
+def plan_tasks(inputs, events_per_task, manifest, store_tau, version, partdir):
+    # event ranges in the order the events are written, with the key identifying
+    # their converted output
+    tasks = []
+    for rootfile in inputs:
+        content_hash = manifest.content_hash(rootfile)
+        with uproot.open(rootfile) as f:
+            num_entries = f["events"].num_entries
+        for start in range(0, num_entries, events_per_task):
+            stop = min(start + events_per_task, num_entries)
+            key = md5_of([content_hash, start, stop, version, store_tau])
+            tasks.append(
+                {
+                    "type": "task",
+                    "key": key,
+                    "input": os.path.abspath(rootfile),
+                    "content_hash": content_hash,
+                    "entry_start": start,
+                    "entry_stop": stop,
+                    "output": os.path.join(partdir, "task_%s.root" % key),
+                    "converter_version": version,
+                    "store_tau": store_tau,
+                }
+            )
+    return tasks
+
+
+def plan_shards(tasks, events_per_shard, outdir, prefix, fmt, row_group_size):
+    # pieces (task, start, stop) of the converted ranges going into each shard
+    shards = []
+    pieces = []
+    n_events = 0
+    for task in tasks:
+        start = 0
+        n_task = task["entry_stop"] - task["entry_start"]
+        while start < n_task:
+            stop = min(n_task, start + events_per_shard - n_events)
+            pieces.append((task["key"], start, stop))
+            n_events += stop - start
+            start = stop
+            if n_events == events_per_shard:
+                shards.append(pieces)
+                pieces = []
+                n_events = 0
+    if pieces:
+        shards.append(pieces)
+    records = []
+    for i, pieces in enumerate(shards):
+        output = os.path.join(outdir, "%s_%05d.%s" % (prefix, i, fmt))
+        records.append(
+            {
+                "type": "shard",
+                "key": md5_of([pieces, fmt, row_group_size]),
+                "output": output,
+                "tasks": pieces,
+                "n_events": sum(stop - start for _, start, stop in pieces),
+            }
+        )
+    return records
+
+
+def remove_stale(outdir, prefix, shards, partdir, tasks):
+    # {prefix}_NNNNN.{root,parquet} shards and converted ranges left by a
+    # previous run which are not outputs of this one
+    pattern = re.compile(r"^(\.tmp_)?%s_\d{5}\.(root|parquet)$" % re.escape(prefix))
+    outputs = set(os.path.abspath(s["output"]) for s in shards)
+    stale = [
+        os.path.join(outdir, name)
+        for name in os.listdir(outdir)
+        if pattern.match(name) and os.path.abspath(os.path.join(outdir, name)) not in outputs
+    ]
+    pattern = re.compile(r"^(\.tmp_)?task_[0-9a-f]{32}\.root$")
+    outputs = set(os.path.abspath(t["output"]) for t in tasks)
+    stale += [
+        os.path.join(partdir, name)
+        for name in os.listdir(partdir)
+        if pattern.match(name) and os.path.abspath(os.path.join(partdir, name)) not in outputs
+    ]
+    for path in stale:
+        os.remove(path)
+    return stale
+
+
+def tmp_name(output):
+    # same extension, so that open_output picks the same format
+    return os.path.join(os.path.dirname(output), ".tmp_" + os.path.basename(output))
+
+
+def convert_task(task, step):
+    # the converted range only appears under its final name once complete
+    n_events = convert_file(
+        task["input"],
+        tmp_name(task["output"]),
+        task["store_tau"],
+        step=step,
+        entry_start=task["entry_start"],
+        entry_stop=task["entry_stop"],
+        first_event_number=task["entry_start"] + 1,
+    )
+    os.replace(tmp_name(task["output"]), task["output"])
+    return n_events
+
+
+def write_shard(shard, tasks_by_key, row_group_size, step):
+    out = open_output(tmp_name(shard["output"]), row_group_size)
+    for key, start, stop in shard["tasks"]:
+        with uproot.open(tasks_by_key[key]["output"]) as f:
+            tree = f["events"]
+            for chunk_start in range(start, stop, step):
+                out.extend(read_converted(tree, chunk_start, min(chunk_start + step, stop)))
+    out.close()
+    os.replace(tmp_name(shard["output"]), shard["output"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="digitized edm4hep files (glob patterns allowed)")
+    parser.add_argument("--outdir", required=True, help="output directory of the training shards")
+    parser.add_argument("--prefix", default="reco", help="name of the output shards: {prefix}_00000.root")
+    parser.add_argument("--store-tau", default="False")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    parser.add_argument("--events-per-task", default=1000, type=int, help="large files are split in event ranges of this size")
+    parser.add_argument("--events-per-shard", default=1000, type=int, help="number of events per output file")
+    parser.add_argument("--format", default="root", choices=["root", "parquet"])
+    parser.add_argument(
+        "--row-group-size",
+        default=None,
+        type=float,
+        help="events per parquet row group, or fraction of the shard below 1 (fetch_step)",
+    )
+    parser.add_argument("--step", default=500, type=int, help="events per chunk read by the converter")
+    parser.add_argument(
+        "--keep-parts",
+        action="store_true",
+        default=False,
+        help="keep the converted event ranges once all the shards are written",
+    )
+    args = parser.parse_args()
+
+    row_group_size = args.row_group_size or args.events_per_shard
+    if row_group_size < 1:
+        row_group_size = row_group_size * args.events_per_shard
+    row_group_size = max(1, int(row_group_size))
+
+    os.makedirs(args.outdir, exist_ok=True)
+    partdir = os.path.join(args.outdir, "parts")
+    os.makedirs(partdir, exist_ok=True)
+    manifest = Manifest(os.path.join(args.outdir, "manifest.jsonl"))
+    version = converter_version()
+
+    inputs = sorted(set(sum([glob.glob(p) for p in args.inputs], [])))
+    tasks = plan_tasks(inputs, args.events_per_task, manifest, args.store_tau, version, partdir)
+    tasks_by_key = {task["key"]: task for task in tasks}
+    shards = plan_shards(
+        tasks, args.events_per_shard, args.outdir, args.prefix, args.format, row_group_size
+    )
+    stale = remove_stale(args.outdir, args.prefix, shards, partdir, tasks)
+    if stale:
+        print("removed {} stale shards and converted ranges of a previous run".format(len(stale)))
+    todo_shards = [s for s in shards if not manifest.done("shard", s["key"], s["output"])]
+    needed = set(key for s in todo_shards for key, _, _ in s["tasks"])
+    # a converted range is renamed to its final name only when complete, and its
+    # name contains its key, so its presence is enough to skip it
+    todo_tasks = [t for t in tasks if t["key"] in needed and not os.path.exists(t["output"])]
+    print(
+        "{} files, {}/{} tasks and {}/{} shards to do, {} workers".format(
+            len(inputs), len(todo_tasks), len(tasks), len(todo_shards), len(shards), args.workers
+        )
+    )
+
+    t0 = time.time()
+    n_events = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            task["key"]: executor.submit(convert_task, task, args.step)
+            for task in todo_tasks
+        }
+        # shards are written strictly in order, so the output does not depend on
+        # the number of workers or on which task finished first
+        for shard in todo_shards:
+            for key, _, _ in shard["tasks"]:
+                future = futures.pop(key, None)
+                if future is not None:
+                    task = dict(tasks_by_key[key])
+                    task["n_events"] = future.result()
+                    n_events += task["n_events"]
+                    manifest.add(task)
+            write_shard(shard, tasks_by_key, row_group_size, args.step)
+            manifest.add(shard)
+    if not args.keep_parts:
+        shutil.rmtree(partdir)
+    dt = time.time() - t0
+    print(
+        "converted {} events, wrote {} shards in {:.1f} s ({:.1f} events/s)".format(
+            n_events, len(todo_shards), dt, n_events / max(dt, 1e-9)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import numpy as np
+
+# per-event indexes of the edm4hep relations used by the CLD converters
+# (condor_CLD and condor_background_CLD), built in one pass over each
+# collection instead of scanning the collections for every hit:
+#   HitIndex   hit -> owner (cluster, track, pfo)
+#   LinkTable  rec -> sim links of a link collection
+
+
+class HitIndex(object):
+    # inverse of the owner -> hits relations of an event (clusters, tracks, pfos),
+    # built once: (collectionID, index) of a hit -> row of the owner that
+    # contains it, and the values stored for that owner. A hit shared by several
+    # owners goes to the first one, or to the last one with last_wins, as the
+    # per-hit scans it replaces did
+    def __init__(self, defaults, last_wins=False):
+        self.defaults = defaults
+        self.last_wins = last_wins
+        self.columns = {name: [] for name in defaults}
+        self.collection_ids = []
+        self.indices = []
+        self.rows = []
+        self.n_rows = 0
+        self.lookup = None
+
+    def add(self, hits, **values):
+        row = self.n_rows
+        self.n_rows += 1
+        for name, value in values.items():
+            self.columns[name].append(value)
+        for hit in hits:
+            object_id = hit.getObjectID()
+            self.collection_ids.append(object_id.collectionID)
+            self.indices.append(object_id.index)
+            self.rows.append(row)
+
+    def build(self):
+        # the last row of every column holds the default (hit without owner)
+        self.columns = {
+            name: np.asarray(values + [self.defaults[name]])
+            for name, values in self.columns.items()
+        }
+        collection_ids = np.asarray(self.collection_ids, dtype=np.int64)
+        indices = np.asarray(self.indices, dtype=np.int64)
+        rows = np.asarray(self.rows, dtype=np.int64)
+        self.lookup = {}
+        for collection_id in np.unique(collection_ids):
+            mask = collection_ids == collection_id
+            table = np.full(np.max(indices[mask]) + 1, -1, dtype=np.int64)
+            if self.last_wins:
+                table[indices[mask]] = rows[mask]
+            else:
+                # reversed so that the first owner wins
+                table[indices[mask][::-1]] = rows[mask][::-1]
+            self.lookup[int(collection_id)] = table
+        return self
+
+    def row(self, hit_index, collection_id):
+        table = self.lookup.get(collection_id)
+        if table is None or hit_index >= len(table):
+            return -1
+        return table[hit_index]
+
+    def get(self, hit_index, collection_id):
+        row = self.row(hit_index, collection_id)
+        return tuple(values[row].item() for values in self.columns.values())
+
+
+def index_cluster_hits(cluster_collection):
+    hit_index = HitIndex({"cluster": -1, "cluster_energy": 0.0})
+    for index_c, cluster in enumerate(cluster_collection):
+        hit_index.add(
+            cluster.getHits(), cluster=index_c, cluster_energy=cluster.getEnergy()
+        )
+    return hit_index.build()
+
+
+def index_track_hits(track_collection):
+    # the track scan kept looking at the next tracks: the last track of a hit wins
+    hit_index = HitIndex({"track": -1}, last_wins=True)
+    for index_track, track in enumerate(track_collection):
+        hit_index.add(track.getTrackerHits(), track=index_track)
+    return hit_index.build()
+
+
+def index_pfo_cluster_hits(pfo_collection):
+    hit_index = HitIndex(
+        {"cluster": -1, "cluster_energy": 0.0, "pfo_energy": 0.0, "pfo": -1}
+    )
+    for index_pfo, pfo in enumerate(pfo_collection):
+        pfo_energy = pfo.getEnergy()
+        for cluster in pfo.getClusters():
+            hit_index.add(
+                cluster.getHits(),
+                cluster=cluster.getObjectID().index,
+                cluster_energy=cluster.getEnergy(),
+                pfo_energy=pfo_energy,
+                pfo=index_pfo,
+            )
+    return hit_index.build()
+
+
+def index_pfo_tracks(pfo_collection):
+    # the "hits" of this index are the tracks of the pfos
+    hit_index = HitIndex({"pfo_energy": 0.0, "pfo": -1})
+    for index_pfo, pfo in enumerate(pfo_collection):
+        hit_index.add(pfo.getTracks(), pfo_energy=pfo.getEnergy(), pfo=index_pfo)
+    return hit_index.build()
+
+
+class LinkTable(object):
+    # sparse rec -> sim matrix of a link collection, read in one pass per event:
+    # the links of every (rec collectionID, rec index), in collection order
+    def __init__(self, link_collection):
+        rec_collection, rec_index, sim_collection, sim_index, weight = [], [], [], [], []
+        for link in link_collection:
+            rec_id = link.getRec().getObjectID()
+            sim_id = link.getSim().getObjectID()
+            rec_collection.append(rec_id.collectionID)
+            rec_index.append(rec_id.index)
+            sim_collection.append(sim_id.collectionID)
+            sim_index.append(sim_id.index)
+            weight.append(link.getWeight())
+        rec_collection = np.asarray(rec_collection, dtype=np.int64)
+        rec_index = np.asarray(rec_index, dtype=np.int64)
+        sim_collection = np.asarray(sim_collection, dtype=np.int64)
+        sim_index = np.asarray(sim_index, dtype=np.int64)
+        weight = np.asarray(weight, dtype=np.float64)
+        self.rows = {}
+        for collection_id in np.unique(rec_collection):
+            mask = rec_collection == collection_id
+            order = np.argsort(rec_index[mask], kind="stable")
+            offsets = np.zeros(np.max(rec_index[mask]) + 2, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(rec_index[mask]))
+            self.rows[int(collection_id)] = (
+                offsets,
+                sim_index[mask][order],
+                sim_collection[mask][order],
+                weight[mask][order],
+            )
+
+    def links(self, rec_index, rec_collection):
+        # sim indices, sim collectionIDs and weights of the links of a rec object
+        rows = self.rows.get(rec_collection)
+        if rows is None or rec_index + 1 >= len(rows[0]):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        offsets, sim_index, sim_collection, weight = rows
+        start, stop = offsets[rec_index], offsets[rec_index + 1]
+        return sim_index[start:stop], sim_collection[start:stop], weight[start:stop]
+
+
+def sim_hit_mc_links(sim_collection):
+    # collectionID of the sim hits and index of the MC particle of every sim hit
+    mc_of_sim = np.asarray(
+        [hit.getMCParticle().getObjectID().index for hit in sim_collection],
+        dtype=np.int64,
+    )
+    collection_id = sim_collection[0].getObjectID().collectionID if len(mc_of_sim) else -1
+    return collection_id, mc_of_sim
@@ -0,0 +1,140 @@
+import numpy as np
+
+# MC particles of an event as arrays: the podio collection is read once into a
+# MCParticleTable, and the ancestor of every particle is resolved for all
+# particles together by pointer jumping (log2 of the depth of the decay chains),
+# so that hits only have to gather the result of their MC particle
+
+
+def pointer_jump(next_node, value, resolved, max_iterations=64):
+    # value of the first resolved node on the chain i, next_node[i], next_node[next_node[i]]...
+    # chains ending without a resolved node keep value[i]
+    value = np.array(value, copy=True)
+    resolved = np.array(resolved, dtype=bool, copy=True)
+    next_node = np.where(resolved, -1, next_node)
+    for _ in range(max_iterations):
+        active = np.nonzero(~resolved & (next_node >= 0))[0]
+        if len(active) == 0:
+            break
+        jump = next_node[active]
+        value[active] = value[jump]
+        resolved[active] = resolved[jump]
+        next_node[active] = next_node[jump]
+    return value
+
+
+class MCAncestry(object):
+    def __init__(self, first_parent, n_parents, decayed_in_tracker=None):
+        # first_parent: index of the first parent of each particle (-1 if none)
+        self.first_parent = np.asarray(first_parent, dtype=np.int64)
+        self.n_parents = np.asarray(n_parents, dtype=np.int64)
+        self.decayed_in_tracker = decayed_in_tracker
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.first_parent)
+
+    def tau_ancestors(self, tau0, tau1):
+        # 0 or 1 if the first-parent chain of the particle reaches tau0 or tau1,
+        # -1 otherwise. The chain stops at particles with several parents, after
+        # checking their first parent (find_mother_particle_check_tau).
+        # tau0/tau1 are scalars or one value per particle (several events)
+        key = ("tau", np.asarray(tau0).tobytes(), np.asarray(tau1).tobytes())
+        if key not in self._cache:
+            parent = self.first_parent
+            value = np.where(parent == tau0, 0, np.where(parent == tau1, 1, -1))
+            resolved = (value >= 0) | (self.n_parents != 1)
+            self._cache[key] = pointer_jump(parent, value, resolved)
+        return self._cache[key]
+
+    def tau_index(self, index_taus):
+        # value stored in hit_genlink_tau for every particle of a single event
+        which = self.tau_ancestors(index_taus[0], index_taus[1])
+        return np.where(which == 0, index_taus[0], np.where(which == 1, index_taus[1], -1))
+
+    def tracker_mother(self):
+        # first parent that did not decay in the tracker, climbing through the
+        # parents that did; particles without a single parent are their own mother
+        if "tracker_mother" not in self._cache:
+            parent = self.first_parent
+            single = self.n_parents == 1
+            stop = single & ~self.decayed_in_tracker[np.maximum(parent, 0)]
+            value = np.where(stop, parent, np.arange(len(parent)))
+            resolved = stop | ~single
+            self._cache["tracker_mother"] = pointer_jump(parent, value, resolved)
+        return self._cache["tracker_mother"]
+
+
+class MCParticleTable(object):
+    def __init__(self, columns):
+        self.columns = columns
+        self._ancestry = None
+
+    @classmethod
+    def from_collection(cls, gen_part_coll):
+        # single pass over the podio collection, one entry per particle
+        names = [
+            "px", "py", "pz", "vx", "vy", "vz", "mass", "charge", "pdg",
+            "gen_status", "decayed_in_tracker", "first_parent", "n_parents",
+        ]
+        values = {name: [] for name in names}
+        for part in gen_part_coll:
+            momentum = part.getMomentum()
+            vertex = part.getVertex()
+            parents = part.getParents()
+            values["px"].append(momentum.x)
+            values["py"].append(momentum.y)
+            values["pz"].append(momentum.z)
+            values["vx"].append(vertex.x)
+            values["vy"].append(vertex.y)
+            values["vz"].append(vertex.z)
+            values["mass"].append(part.getMass())
+            values["charge"].append(part.getCharge())
+            values["pdg"].append(part.getPDG())
+            values["gen_status"].append(part.getGeneratorStatus())
+            values["decayed_in_tracker"].append(part.isDecayedInTracker())
+            values["n_parents"].append(len(parents))
+            values["first_parent"].append(
+                parents[0].getObjectID().index if len(parents) > 0 else -1
+            )
+        columns = {
+            name: np.asarray(values[name], dtype=np.float64)
+            for name in ["px", "py", "pz", "vx", "vy", "vz", "mass", "charge"]
+        }
+        for name in ["pdg", "gen_status", "first_parent", "n_parents"]:
+            columns[name] = np.asarray(values[name], dtype=np.int64)
+        columns["decayed_in_tracker"] = np.asarray(values["decayed_in_tracker"], dtype=bool)
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns["pdg"])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def p(self):
+        return np.sqrt(self["px"] ** 2 + self["py"] ** 2 + self["pz"] ** 2)
+
+    @property
+    def p_t(self):
+        return np.sqrt(self["px"] ** 2 + self["py"] ** 2)
+
+    @property
+    def theta(self):
+        # 0 for particles at rest, as in read_mc_collection
+        p = self.p
+        cos_theta = np.divide(self["pz"], p, out=np.ones_like(p), where=p > 0)
+        return np.arccos(np.clip(cos_theta, -1, 1))
+
+    @property
+    def phi(self):
+        return np.where(self.p > 0, np.arctan2(self["py"], self["px"]), 0.0)
+
+    @property
+    def ancestry(self):
+        if self._ancestry is None:
+            self._ancestry = MCAncestry(
+                self["first_parent"], self["n_parents"], self["decayed_in_tracker"]
+            )
+        return self._ancestry
@@ -0,0 +1,77 @@
+import numpy as np
+import awkward as ak
+
+# drop-in replacement of the ROOT.TTree filled by the podio converters: the
+# branches booked by initialize() are snapshot at every Fill() and written to
+# parquet in row groups of row_group_size events, e.g.
+# t = ParquetTree("tree.parquet", row_group_size=100)
+# event_number, n_hit, n_part, dic, t = initialize(t, store_tau)
+
+_dtypes = {
+    "float": np.float32,
+    "double": np.float64,
+    "int": np.int32,
+    "i": np.int32,
+    "f": np.float32,
+    "d": np.float64,
+}
+
+
+class ParquetTree(object):
+    def __init__(self, output_file, row_group_size=1000):
+        self.output_file = output_file
+        self.row_group_size = row_group_size
+        self.branches = {}
+        self.buffer = {}
+        self.n_buffered = 0
+        self.writer = None
+
+    def Branch(self, name, obj, leaflist=None):
+        if hasattr(obj, "typecode"):
+            # array("i", [0]) scalar branch
+            self.branches[name] = (obj, _dtypes[obj.typecode], False)
+        else:
+            # std::vector<T>
+            cpp_name = type(obj).__cpp_name__
+            value_type = cpp_name[cpp_name.index("<") + 1 : cpp_name.rindex(">")]
+            self.branches[name] = (obj, _dtypes[value_type.split(",")[0].strip()], True)
+        self.buffer[name] = []
+
+    def Fill(self):
+        for name, (obj, dtype, is_vector) in self.branches.items():
+            if is_vector:
+                self.buffer[name].append(np.fromiter(obj, dtype=dtype, count=len(obj)))
+            else:
+                self.buffer[name].append(obj[0])
+        self.n_buffered += 1
+        if self.n_buffered >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow.parquet as pq
+
+        columns = {}
+        for name, (obj, dtype, is_vector) in self.branches.items():
+            values = self.buffer[name]
+            if is_vector:
+                counts = np.array([len(v) for v in values], dtype=np.int64)
+                flat = np.concatenate(values) if len(values) else np.zeros(0, dtype)
+                columns[name] = ak.unflatten(flat.astype(dtype), counts)
+            else:
+                columns[name] = np.array(values, dtype=dtype)
+            self.buffer[name] = []
+        table = ak.to_arrow_table(ak.zip(columns, depth_limit=1), extensionarray=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_file, table.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.n_buffered = 0
+
+    def SetDirectory(self, directory):
+        pass
+
+    def Write(self):
+        if self.n_buffered > 0:
+            self._flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -15,6 +15,7 @@ from tools_tree_global import (
     merge_list_MCS,
     gen_particles_find,
 )
+from parquet_tree import ParquetTree
 
 debug = False
 rootfile = sys.argv[1]
@@ -22,11 +23,17 @@ rootfile = sys.argv[1]
 reader = root_io.Reader(rootfile)
 output_file = sys.argv[2]
 store_tau = sys.argv[3]
+# output.parquet is written as parquet in row groups of row_group_size events
+row_group_size = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
 # 1. Retrieve the cellid_encoding (a string) from the metadata tree in the ROOT file, by using podio
 metadata = reader.get("metadata")[0]
 
-out_root = TFile(output_file, "RECREATE")
-t = TTree("events", "pf tree lar")
+if output_file.endswith(".parquet"):
+    out_root = None
+    t = ParquetTree(output_file, row_group_size)
+else:
+    out_root = TFile(output_file, "RECREATE")
+    t = TTree("events", "pf tree lar")
 event_number, n_hit, n_part, dic, t = initialize(t, store_tau)
 
 
@@ -42,10 +49,13 @@ for event in reader.get("events"):
         e_pp,
         gen_part_coll,
         index_taus,
+        mc_table,
     ) = gen_particles_find(event, debug, store_tau)
     # if event_numbers == 8:
     clear_dic(dic)
     n_part[0] = 0
+    # parent links of the event, shared by the CDC and VTX hits
+    ancestry = mc_table.ancestry
     n_hit, dic, list_of_MCs1 = store_hit_col_CDC(
         event,
         n_hit,
@@ -54,6 +64,7 @@ for event in reader.get("events"):
         gen_part_coll,
         index_taus=index_taus,
         store_tau=store_tau,
+        ancestry=ancestry,
     )
     n_hit, dic, list_of_MCs2 = store_hit_col_VTX(
         event,
@@ -62,9 +73,12 @@ for event in reader.get("events"):
         gen_part_coll,
         index_taus=index_taus,
         store_tau=store_tau,
+        ancestry=ancestry,
     )
     unique_MCS = merge_list_MCS(list_of_MCs1, list_of_MCs2, store_tau, index_taus)
-    n_part, dic = read_mc_collection(event, dic, n_part, debug, unique_MCS)
+    n_part, dic = read_mc_collection(
+        event, dic, n_part, debug, unique_MCS, table=mc_table
+    )
 
     event_number[0] += 1
     t.Fill()
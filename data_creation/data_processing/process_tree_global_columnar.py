@@ -0,0 +1,20 @@
+import sys
+import time
+from tools_columnar import convert_file
+
+# columnar version of process_tree_global.py, same arguments and output branches:
+# python process_tree_global_columnar.py input.root output.root store_tau [events_per_chunk] [row_group_size]
+# an output ending in .parquet is written as parquet with row groups of row_group_size
+# events (or of that fraction of the file if below 1, e.g. the fetch_step of the training)
+rootfile = sys.argv[1]
+output_file = sys.argv[2]
+store_tau = sys.argv[3]
+step = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+row_group_size = float(sys.argv[5]) if len(sys.argv) > 5 else 1000
+
+t0 = time.time()
+n_events = convert_file(
+    rootfile, output_file, store_tau, step=step, row_group_size=row_group_size
+)
+dt = time.time() - t0
+print("converted {} events in {:.1f} s ({:.1f} events/s)".format(n_events, dt, n_events / dt))
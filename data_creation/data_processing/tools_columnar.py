@@ -0,0 +1,485 @@
+from functools import lru_cache
+import numpy as np
+import awkward as ak
+import uproot
+from cellid_decoder import get_decoder
+from mc_ancestry import MCAncestry
+
+# columnar version of tools_tree_global.py: the edm4hep collections are read
+# with uproot as whole arrays for a chunk of events and all the per hit
+# quantities are computed with array operations (no python loop over hits)
+
+cdc_hits = "CDCHHits"
+cdc_digis = "CDCHDigis"
+vtx_hits = ["VTXDCollection", "VTXIBCollection", "VTXOBCollection"]
+vtx_digis = ["VTXDDigis", "VTXIBDigis", "VTXOBDigis"]
+genparts = "MCParticles"
+cellid_encoding_name = "CDCHHits__CellIDEncoding"
+# edm4hep::SimTrackerHit::BITProducedBySecondary
+bit_produced_by_secondary = 30
+
+hit_branches = [
+    "hit_x",
+    "hit_y",
+    "hit_z",
+    "hit_px",
+    "hit_py",
+    "hit_pz",
+    "hit_type",
+    "hit_EDep",
+    "hit_time",
+    "hit_pathLength",
+    "hit_cellID",
+    "hit_genlink0",
+    "leftPosition_x",
+    "leftPosition_y",
+    "leftPosition_z",
+    "rightPosition_x",
+    "rightPosition_y",
+    "rightPosition_z",
+    "cluster_count",
+    "produced_by_secondary",
+    "superLayer",
+    "layer",
+    "phi",
+    "stereo",
+]
+part_branches = [
+    "part_p",
+    "part_p_t",
+    "part_theta",
+    "part_phi",
+    "part_m",
+    "part_pid",
+    "part_id",
+    "part_parent",
+    "gen_status",
+]
+
+
+def find_link_branch(available, coll, relation):
+    # the name of the relation branch changed between podio/edm4hep versions
+    for name in [
+        "_{}_{}".format(coll, relation),
+        "_{}_MCParticle".format(coll),
+        "{}#0".format(coll),
+    ]:
+        if name + ".index" in available:
+            return name + ".index"
+    raise RuntimeError("No MCParticle link branch found for collection %s" % coll)
+
+
+def find_relation_branch(available, coll, relation, podio_index):
+    for name in ["_{}_{}".format(coll, relation), "{}#{}".format(coll, podio_index)]:
+        if name + ".index" in available:
+            return name + ".index"
+    raise RuntimeError("No %s branch found for collection %s" % (relation, coll))
+
+
+def input_branches(tree, store_tau="False"):
+    available = set(tree.keys(full_paths=False))
+    branches = {
+        "cdc_cellID": cdc_hits + ".cellID",
+        "cdc_EDep": cdc_hits + ".EDep",
+        "cdc_time": cdc_hits + ".time",
+        "cdc_pathLength": cdc_hits + ".pathLength",
+        "cdc_quality": cdc_hits + ".quality",
+        "cdc_x": cdc_hits + ".position.x",
+        "cdc_y": cdc_hits + ".position.y",
+        "cdc_z": cdc_hits + ".position.z",
+        "cdc_px": cdc_hits + ".momentum.x",
+        "cdc_py": cdc_hits + ".momentum.y",
+        "cdc_pz": cdc_hits + ".momentum.z",
+        "cdc_link": find_link_branch(available, cdc_hits, "particle"),
+        "cdc_left_x": cdc_digis + ".leftPosition.x",
+        "cdc_left_y": cdc_digis + ".leftPosition.y",
+        "cdc_left_z": cdc_digis + ".leftPosition.z",
+        "cdc_right_x": cdc_digis + ".rightPosition.x",
+        "cdc_right_y": cdc_digis + ".rightPosition.y",
+        "cdc_right_z": cdc_digis + ".rightPosition.z",
+        "cdc_cluster_count": cdc_digis + ".clusterCount",
+        "mc_pdg": genparts + ".PDG",
+        "mc_status": genparts + ".generatorStatus",
+        "mc_mass": genparts + ".mass",
+        "mc_px": genparts + ".momentum.x",
+        "mc_py": genparts + ".momentum.y",
+        "mc_pz": genparts + ".momentum.z",
+        "mc_parents_begin": genparts + ".parents_begin",
+        "mc_parents_end": genparts + ".parents_end",
+        "mc_parents": find_relation_branch(available, genparts, "parents", 0),
+    }
+    if store_tau == "True":
+        branches["mc_daughters_begin"] = genparts + ".daughters_begin"
+        branches["mc_daughters_end"] = genparts + ".daughters_end"
+        branches["mc_daughters"] = find_relation_branch(
+            available, genparts, "daughters", 1
+        )
+    for i, (coll, coll_digi) in enumerate(zip(vtx_hits, vtx_digis)):
+        branches["vtx%d_cellID" % i] = coll + ".cellID"
+        branches["vtx%d_pathLength" % i] = coll + ".pathLength"
+        branches["vtx%d_quality" % i] = coll + ".quality"
+        branches["vtx%d_px" % i] = coll + ".momentum.x"
+        branches["vtx%d_py" % i] = coll + ".momentum.y"
+        branches["vtx%d_pz" % i] = coll + ".momentum.z"
+        branches["vtx%d_link" % i] = find_link_branch(available, coll, "particle")
+        branches["vtx%d_x" % i] = coll_digi + ".position.x"
+        branches["vtx%d_y" % i] = coll_digi + ".position.y"
+        branches["vtx%d_z" % i] = coll_digi + ".position.z"
+        branches["vtx%d_EDep" % i] = coll_digi + ".eDep"
+        branches["vtx%d_time" % i] = coll_digi + ".time"
+    return branches
+
+
+def read_chunk(tree, branches, entry_start, entry_stop):
+    arrays = tree.arrays(
+        filter_name=list(branches.values()),
+        entry_start=entry_start,
+        entry_stop=entry_stop,
+        how=dict,
+    )
+    return {k: arrays[v] for k, v in branches.items()}
+
+
+@lru_cache(maxsize=None)
+def read_cellid_encoding(rootfile):
+    # same parameter as metadata.get_parameter("CDCHHits__CellIDEncoding"),
+    # read from the GPStringKeys/GPStringValues branches of the metadata frame
+    with uproot.open(rootfile) as f:
+        metadata = f["metadata"]
+        keys = metadata["GPStringKeys"].array(library="ak")[0].tolist()
+        values = metadata["GPStringValues"].array(library="ak")[0].tolist()
+    for key, value in zip(keys, values):
+        if key == cellid_encoding_name:
+            return value[0]
+    raise RuntimeError(
+        "%s not found in the metadata of %s" % (cellid_encoding_name, rootfile)
+    )
+
+
+def _flat(a):
+    return ak.to_numpy(ak.flatten(a, axis=None))
+
+
+def _event_of_item(counts):
+    return np.repeat(np.arange(len(counts)), counts)
+
+
+def _global_index(local_index, counts):
+    # event-local collection indices -> index in the flattened chunk
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    flat = _flat(local_index)
+    event = _event_of_item(ak.to_numpy(ak.num(local_index)))
+    return np.where(flat >= 0, flat + offsets[event], -1), offsets, event
+
+
+def first_relation(begin, end, relation, counts):
+    # first entry of a OneToMany relation (e.g. first parent) as a flat global index
+    n_rel = ak.to_numpy(ak.num(relation))
+    rel_offsets = np.concatenate([[0], np.cumsum(n_rel)[:-1]])
+    mc_offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    event = _event_of_item(counts)
+    begin = _flat(begin)
+    end = _flat(end)
+    rel = _flat(relation)
+    has_rel = end > begin
+    first = np.full(len(begin), -1, dtype=np.int64)
+    first[has_rel] = rel[rel_offsets[event[has_rel]] + begin[has_rel]]
+    first_global = np.where(first >= 0, first + mc_offsets[event], -1)
+    return first, first_global
+
+
+def find_taus(arrays, counts):
+    # the last Z with exactly two daughters in the event, as in gen_particles_find
+    n_events = len(counts)
+    index_taus = np.zeros((n_events, 2), dtype=np.int64)
+    pdg = _flat(arrays["mc_pdg"])
+    begin = _flat(arrays["mc_daughters_begin"])
+    end = _flat(arrays["mc_daughters_end"])
+    n_rel = ak.to_numpy(ak.num(arrays["mc_daughters"]))
+    rel_offsets = np.concatenate([[0], np.cumsum(n_rel)[:-1]])
+    rel = _flat(arrays["mc_daughters"])
+    event = _event_of_item(counts)
+    is_z = np.where((pdg == 23) & (end - begin == 2))[0]
+    # later Z overwrite earlier ones
+    index_taus[event[is_z], 0] = rel[rel_offsets[event[is_z]] + begin[is_z]]
+    index_taus[event[is_z], 1] = rel[rel_offsets[event[is_z]] + begin[is_z] + 1]
+    return index_taus
+
+
+def store_hits(arrays, decoder, store_tau="False"):
+    dc_link = arrays["cdc_link"]
+    dic = {
+        "hit_x": arrays["cdc_x"],
+        "hit_y": arrays["cdc_y"],
+        "hit_z": arrays["cdc_z"],
+        "hit_px": arrays["cdc_px"],
+        "hit_py": arrays["cdc_py"],
+        "hit_pz": arrays["cdc_pz"],
+        "hit_type": ak.zeros_like(arrays["cdc_x"]),
+        "hit_EDep": arrays["cdc_EDep"],
+        "hit_time": arrays["cdc_time"],
+        "hit_pathLength": arrays["cdc_pathLength"],
+        "hit_cellID": arrays["cdc_cellID"],
+        "hit_genlink0": dc_link,
+        "leftPosition_x": arrays["cdc_left_x"],
+        "leftPosition_y": arrays["cdc_left_y"],
+        "leftPosition_z": arrays["cdc_left_z"],
+        "rightPosition_x": arrays["cdc_right_x"],
+        "rightPosition_y": arrays["cdc_right_y"],
+        "rightPosition_z": arrays["cdc_right_z"],
+        "cluster_count": arrays["cdc_cluster_count"],
+        "produced_by_secondary": (arrays["cdc_quality"] >> bit_produced_by_secondary)
+        & 1,
+    }
+    counts = ak.num(arrays["cdc_cellID"])
+    decoded = decoder.decode(
+        _flat(arrays["cdc_cellID"]), ["superLayer", "layer", "phi", "stereo"]
+    )
+    for name, value in decoded.items():
+        dic[name] = ak.unflatten(value, counts)
+
+    parts = [dic]
+    for i in range(len(vtx_hits)):
+        zeros = ak.zeros_like(arrays["vtx%d_x" % i])
+        vtx = {
+            "hit_x": arrays["vtx%d_x" % i],
+            "hit_y": arrays["vtx%d_y" % i],
+            "hit_z": arrays["vtx%d_z" % i],
+            "hit_px": arrays["vtx%d_px" % i],
+            "hit_py": arrays["vtx%d_py" % i],
+            "hit_pz": arrays["vtx%d_pz" % i],
+            "hit_type": zeros + 1,
+            "hit_EDep": arrays["vtx%d_EDep" % i],
+            "hit_time": arrays["vtx%d_time" % i],
+            "hit_pathLength": arrays["vtx%d_pathLength" % i],
+            "hit_cellID": arrays["vtx%d_cellID" % i],
+            "hit_genlink0": arrays["vtx%d_link" % i],
+            "produced_by_secondary": (
+                arrays["vtx%d_quality" % i] >> bit_produced_by_secondary
+            )
+            & 1,
+        }
+        for name in [
+            "leftPosition_x",
+            "leftPosition_y",
+            "leftPosition_z",
+            "rightPosition_x",
+            "rightPosition_y",
+            "rightPosition_z",
+            "cluster_count",
+            "superLayer",
+            "layer",
+            "phi",
+            "stereo",
+        ]:
+            vtx[name] = zeros
+        parts.append(vtx)
+    # CDC hits first, then VTXD, VTXIB and VTXOB as in the podio converter
+    return {k: ak.concatenate([p[k] for p in parts], axis=1) for k in hit_branches}
+
+
+def store_particles(arrays, hits, store_tau="False"):
+    mc_counts = ak.to_numpy(ak.num(arrays["mc_pdg"]))
+    link_global, mc_offsets, _ = _global_index(hits["hit_genlink0"], mc_counts)
+    mc_event = _event_of_item(mc_counts)
+    # only store particles that have hits
+    used = np.zeros(np.sum(mc_counts), dtype=bool)
+    used[link_global[link_global >= 0]] = True
+
+    parent, parent_global = first_relation(
+        arrays["mc_parents_begin"],
+        arrays["mc_parents_end"],
+        arrays["mc_parents"],
+        mc_counts,
+    )
+    if store_tau == "True":
+        index_taus = find_taus(arrays, mc_counts)
+        used[index_taus[:, 0] + mc_offsets] = True
+        used[index_taus[:, 1] + mc_offsets] = True
+        n_parents = _flat(arrays["mc_parents_end"]) - _flat(arrays["mc_parents_begin"])
+        ancestry = MCAncestry(parent_global, n_parents)
+        which = ancestry.tau_ancestors(
+            index_taus[mc_event, 0] + mc_offsets[mc_event],
+            index_taus[mc_event, 1] + mc_offsets[mc_event],
+        )
+        tau_of_particle = np.where(
+            which == 0,
+            index_taus[mc_event, 0],
+            np.where(which == 1, index_taus[mc_event, 1], -1),
+        )
+        tau_of_hit = np.where(
+            link_global >= 0, tau_of_particle[np.maximum(link_global, 0)], -1
+        )
+        hits["hit_genlink_tau"] = ak.unflatten(
+            tau_of_hit, ak.num(hits["hit_genlink0"])
+        )
+
+    px = _flat(arrays["mc_px"]).astype(np.float64)
+    py = _flat(arrays["mc_py"]).astype(np.float64)
+    pz = _flat(arrays["mc_pz"]).astype(np.float64)
+    p = np.sqrt(px**2 + py**2 + pz**2)
+    p_t = np.sqrt(px**2 + py**2)
+    has_p = p > 0
+    theta = np.where(has_p, np.arccos(np.divide(pz, p, where=has_p, out=np.zeros_like(p))), 0.0)
+    phi = np.where(has_p, np.arctan2(py, px), 0.0)
+    dic = {
+        "part_p": p,
+        "part_p_t": p_t,
+        "part_theta": theta,
+        "part_phi": phi,
+        "part_m": _flat(arrays["mc_mass"]),
+        "part_pid": _flat(arrays["mc_pdg"]),
+        "part_id": np.arange(len(p)) - mc_offsets[mc_event],
+        "part_parent": parent,
+        "gen_status": _flat(arrays["mc_status"]),
+    }
+    n_part = np.bincount(mc_event[used], minlength=len(mc_counts))
+    return {k: ak.unflatten(v[used], n_part) for k, v in dic.items()}
+
+
+def convert_chunk(arrays, decoder, store_tau="False", first_event_number=1):
+    hits = store_hits(arrays, decoder, store_tau)
+    parts = store_particles(arrays, hits, store_tau)
+    n_events = len(hits["hit_x"])
+    hit_record = {}
+    for k, v in hits.items():
+        dtype = np.int32 if k == "hit_cellID" else np.float32
+        hit_record[k] = ak.values_astype(v, dtype)
+    part_record = {k: ak.values_astype(v, np.float32) for k, v in parts.items()}
+    return {
+        "event_number": np.arange(
+            first_event_number, first_event_number + n_events, dtype=np.int32
+        ),
+        "hits": ak.zip(hit_record),
+        "parts": ak.zip(part_record),
+    }
+
+
+def create_output_tree(fout, chunk, treename="events"):
+    # n_hit/n_part are the counters of the jagged hit_*/part_* branches, so the
+    # output has the same branch names as the TTree filled in tools_tree_global
+    counters = {"hits": "n_hit", "parts": "n_part"}
+    return fout.mktree(
+        treename,
+        {k: v.type if isinstance(v, ak.Array) else v.dtype for k, v in chunk.items()},
+        counter_name=lambda counted: counters[counted],
+        field_name=lambda outer, inner: inner,
+    )
+
+
+class RootOutput(object):
+    def __init__(self, output_file):
+        self.fout = uproot.recreate(output_file)
+        self.tree = None
+
+    def extend(self, chunk):
+        if self.tree is None:
+            self.tree = create_output_tree(self.fout, chunk)
+        self.tree.extend(chunk)
+
+    def close(self):
+        self.fout.close()
+
+
+def flatten_chunk(chunk):
+    # one column per branch, same names and order as the ROOT output
+    columns = {"event_number": chunk["event_number"]}
+    for counter, record in (("n_hit", chunk["hits"]), ("n_part", chunk["parts"])):
+        columns[counter] = ak.values_astype(ak.num(record, axis=1), np.int32)
+        for field in record.fields:
+            columns[field] = record[field]
+    return columns
+
+
+class ParquetOutput(object):
+    # events are buffered and written in row groups of exactly row_group_size
+    # events, so that the loader can read a fetch_step worth of events with
+    # as few row groups as possible
+    def __init__(self, output_file, row_group_size=1000):
+        self.output_file = output_file
+        self.row_group_size = row_group_size
+        self.writer = None
+        self.buffer = []
+        self.n_buffered = 0
+
+    def _write(self, columns):
+        import pyarrow.parquet as pq
+
+        table = ak.to_arrow_table(ak.zip(columns, depth_limit=1), extensionarray=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_file, table.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    def _flush(self, n):
+        columns = {
+            k: ak.concatenate([c[k] for c in self.buffer]) for k in self.buffer[0]
+        }
+        self._write({k: v[:n] for k, v in columns.items()})
+        rest = {k: v[n:] for k, v in columns.items()}
+        self.n_buffered -= n
+        self.buffer = [rest] if self.n_buffered > 0 else []
+
+    def extend(self, chunk):
+        self.buffer.append(flatten_chunk(chunk))
+        self.n_buffered += len(chunk["event_number"])
+        while self.n_buffered >= self.row_group_size:
+            self._flush(self.row_group_size)
+
+    def close(self):
+        if self.n_buffered > 0:
+            self._flush(self.n_buffered)
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_output(output_file, row_group_size=1000):
+    if output_file.endswith(".parquet"):
+        return ParquetOutput(output_file, row_group_size)
+    return RootOutput(output_file)
+
+
+def convert_file(
+    rootfile,
+    output_file,
+    store_tau="False",
+    step=500,
+    entry_start=None,
+    entry_stop=None,
+    first_event_number=1,
+    row_group_size=1000,
+):
+    # output_file ending in .parquet is written as parquet, anything else as ROOT.
+    # row_group_size is a number of events, or a fraction of the converted
+    # events below 1 (same meaning as fetch_step in the training)
+    decoder = get_decoder(read_cellid_encoding(rootfile))
+    with uproot.open(rootfile) as f:
+        tree = f["events"]
+        branches = input_branches(tree, store_tau)
+        start = 0 if entry_start is None else entry_start
+        stop = tree.num_entries if entry_stop is None else min(entry_stop, tree.num_entries)
+        if row_group_size < 1:
+            row_group_size = max(1, int(np.ceil(row_group_size * (stop - start))))
+        out = open_output(output_file, int(row_group_size))
+        n_events = 0
+        while start < stop:
+            arrays = read_chunk(tree, branches, start, min(start + step, stop))
+            chunk = convert_chunk(
+                arrays, decoder, store_tau, first_event_number + n_events
+            )
+            out.extend(chunk)
+            n_events += len(chunk["event_number"])
+            start += step
+        out.close()
+    return n_events
+
+
+def read_converted(tree, entry_start=None, entry_stop=None):
+    # read back a converted tree in the layout expected by create_output_tree
+    arrays = tree.arrays(entry_start=entry_start, entry_stop=entry_stop, how=dict)
+    hit_names = [k for k in arrays if k in hit_branches or k == "hit_genlink_tau"]
+    part_names = [k for k in arrays if k in part_branches]
+    return {
+        "event_number": ak.to_numpy(arrays["event_number"]),
+        "hits": ak.zip({k: arrays[k] for k in hit_names}),
+        "parts": ak.zip({k: arrays[k] for k in part_names}),
+    }
@@ -4,39 +4,9 @@ import ROOT
 from ROOT import TFile, TTree
 from array import array
 import math
-import dd4hep as dd4hepModule
-from ROOT import dd4hep
 import numpy as np
-
-
-def find_mother_particle_check_tau(j, gen_part_coll, tau_index0, tau_index1):
-    parent_p = j
-    counter = 0
-    belongs_to_tau1 = False
-    belongs_to_tau2 = False
-    while len(np.reshape(np.array(parent_p), -1)) < 1.5:
-        if type(parent_p) == list:
-            if len(parent_p) > 0:
-                parent_p = parent_p[0]
-            else:
-                break
-        parent_p_r = get_genparticle_parents(
-            parent_p,
-            gen_part_coll,
-        )
-        if len(parent_p_r) == 0:
-            break
-        if parent_p_r[0] == tau_index0:
-            belongs_to_tau1 = True
-        if parent_p_r[0] == tau_index1:
-            belongs_to_tau2 = True
-        pp_old = parent_p
-        counter = counter + 1
-        parent_p = parent_p_r
-        if belongs_to_tau1 or belongs_to_tau2:
-            break
-
-    return pp_old, belongs_to_tau1, belongs_to_tau2
+from cellid_decoder import decoder_from_metadata
+from mc_ancestry import MCParticleTable
 
 
 def get_genparticle_daughters(i, mcparts):
@@ -76,100 +46,60 @@ def gen_particles_find(event, debug, store_tau="False"):
     index_of_tau1 = 0
     index_of_tau2 = 0
     genparts = "MCParticles"
-    genparts_parents = "_MCParticles_parents"
-    genparts_daughters = "_MCParticles_daughters"
-    # gen_parent_link_indexmc = event.get(genparts_parents)
-    # gen_daughter_link_indexmc = event.get(genparts_daughters)
     gen_part_coll = event.get(genparts)
-    genpart_indexes_pre = (
-        dict()
-    )  ## key: index in gen particle collection, value: position in stored gen particle array
-    indexes_genpart_pre = (
-        dict()
-    )  ## key: position in stored gen particle array, value: index in gen particle collection
-    total_e = 0
-    n_part_pre = 0
+    # all the particles of the event as arrays, shared with read_mc_collection
+    # and with the tau ancestry of the hits
+    table = MCParticleTable.from_collection(gen_part_coll)
+    n_part_pre = len(table)
+    ## store all gen parts for now, both maps are the identity
+    genpart_indexes_pre = np.arange(n_part_pre)
+    indexes_genpart_pre = np.arange(n_part_pre)
+    p = table.p
     e_pp = np.zeros(11)
-    for j, part in enumerate(gen_part_coll):
-        momentum = part.getMomentum()
-        p = math.sqrt(momentum.x**2 + momentum.y**2 + momentum.z**2)
-        if debug:
-            if j < 11 and j > 1:
-                e_pp[j] = p
-                total_e = total_e + p
-        theta = math.acos(momentum.z / p)
-        phi = math.atan2(momentum.y, momentum.x)
-
-        if store_tau == "True":
-            if part.getPDG() == 23:
-                daughters = get_genparticle_daughters(
+    total_e = 0
+    if debug:
+        n = min(11, len(p))
+        e_pp[2:n] = p[2:n]
+        total_e = np.sum(e_pp)
+
+    if store_tau == "True":
+        # the last Z decaying into two particles
+        for j in np.nonzero(table["pdg"] == 23)[0][::-1]:
+            daughters = get_genparticle_daughters(j, gen_part_coll)
+            if len(daughters) == 2:
+                index_of_Z = j
+                index_of_tau1 = daughters[0]
+                index_of_tau2 = daughters[1]
+                break
+    if debug:
+        theta = table.theta
+        phi = table.phi
+        for j in np.nonzero(table["gen_status"] == 1)[0]:
+            print(
+                "all genparts: N: {}, PID: {}, Q: {}, P: {:.2e}, Theta: {:.2e}, Phi: {:.2e}, M: {:.2e}, X(m): {:.3f}, Y(m): {:.3f}, R(m): {:.3f}, Z(m): {:.3f}, status: {}, parents: {}, daughters: {}, decayed_traacker: {}".format(
                     j,
-                    gen_part_coll,
-                )
-                if len(daughters) == 2:
-                    index_of_Z = j
-                    index_of_tau1 = daughters[0]
-                    index_of_tau2 = daughters[1]
-        if debug:
-            if part.getGeneratorStatus() == 1:
-                print(
-                    "all genparts: N: {}, PID: {}, Q: {}, P: {:.2e}, Theta: {:.2e}, Phi: {:.2e}, M: {:.2e}, X(m): {:.3f}, Y(m): {:.3f}, R(m): {:.3f}, Z(m): {:.3f}, status: {}, parents: {}, daughters: {}, decayed_traacker: {}".format(
+                    table["pdg"][j],
+                    table["charge"][j],
+                    p[j],
+                    theta[j],
+                    phi[j],
+                    table["mass"][j],
+                    table["vx"][j] * 1e-03,
+                    table["vy"][j] * 1e-03,
+                    math.sqrt(table["vx"][j] ** 2 + table["vy"][j] ** 2) * 1e-03,
+                    table["vz"][j] * 1e-03,
+                    table["gen_status"][j],
+                    get_genparticle_parents(
+                        j,
+                        gen_part_coll,
+                    ),
+                    get_genparticle_daughters(
                         j,
-                        part.getPDG(),
-                        part.getCharge(),
-                        p,
-                        theta,
-                        phi,
-                        part.getMass(),
-                        part.getVertex().x * 1e-03,
-                        part.getVertex().y * 1e-03,
-                        math.sqrt(part.getVertex().x ** 2 + part.getVertex().y ** 2)
-                        * 1e-03,
-                        part.getVertex().z * 1e-03,
-                        part.getGeneratorStatus(),
-                        get_genparticle_parents(
-                            j,
-                            gen_part_coll,
-                        ),
-                        get_genparticle_daughters(
-                            j,
-                            gen_part_coll,
-                        ),
-                        part.isDecayedInTracker() * 1,
-                    )
+                        gen_part_coll,
+                    ),
+                    table["decayed_in_tracker"][j] * 1,
                 )
-
-            # part.daughters_begin,  part.daughters_end, part.parents_begin,  part.parents_end, D1: {}, D2: {}, M1: {}, M2: {}
-
-        ## store all gen parts for now
-        genpart_indexes_pre[j] = n_part_pre
-        indexes_genpart_pre[n_part_pre] = j
-        n_part_pre += 1
-
-        """
-        # exclude neutrinos (and pi0 for now)
-        if part.generatorStatus == 1 and abs(part.PDG) not in [12, 14, 16, 111]:
-
-            genpart_indexes_pre[j] = n_part_pre
-            indexes_genpart_pre[n_part_pre] = j
-            n_part_pre += 1
-
-        # extract the photons from the pi0
-        elif part.generatorStatus == 1 and part.PDG == 111:
-
-            daughters = get_genparticle_daughters(
-                j, gen_part_coll, gen_daughter_link_indexmc
             )
-
-            if len(daughters) != 2:
-                print("STRANGE PI0 DECAY")
-
-            for d in daughters:
-                a = gen_part_coll[d]
-                genpart_indexes_pre[d] = n_part_pre
-                indexes_genpart_pre[n_part_pre] = d
-                n_part_pre += 1
-        """
     return (
         genpart_indexes_pre,
         indexes_genpart_pre,
@@ -178,31 +108,10 @@ def gen_particles_find(event, debug, store_tau="False"):
         e_pp,
         gen_part_coll,
         [index_of_tau1, index_of_tau2],
+        table,
     )
 
 
-def find_mother_particle(mc_particle):
-    parent_p = mc_particle.getObjectID().index
-    counter = 0
-    decayed_in_tracker = 1
-    while decayed_in_tracker == 1:
-        if type(parent_p) == list:
-            parent_p = parent_p[0]
-        parents = mc_particle.getParents()
-        parent_p_r = []
-        for parent in parents:
-            parent_p_r.append(parent.getObjectID().index)
-            decayed_in_tracker = parent.isDecayedInTracker() * 1
-        pp_old = parent_p
-        counter = counter + 1
-        parent_p = parent_p_r
-        if len(np.reshape(np.array(parent_p), -1)) > 1.5:
-            parent_p = pp_old
-            decayed_in_tracker = 0
-        # print("found parent", parent_p, pp_old)
-    return parent_p
-
-
 def initialize(t, store_tau):
     if store_tau == "True":
         hit_genlink_tau = ROOT.std.vector("float")()
@@ -332,67 +241,63 @@ def initialize(t, store_tau):
     return (event_number, n_hit, n_part, dic, t)
 
 
-def read_mc_collection(event, dic, n_part, debug, unique_MCS):
+_vector_dtypes = {"float": np.float32, "double": np.float64, "int": np.int32}
+
+
+def fill_vector(vector, values):
+    # append a numpy array to a std::vector in one copy, through its data buffer
+    values = np.asarray(values)
+    if len(values) == 0:
+        return
+    cpp_name = type(vector).__cpp_name__
+    value_type = cpp_name[cpp_name.index("<") + 1 : cpp_name.rindex(">")]
+    dtype = _vector_dtypes[value_type.split(",")[0].strip()]
+    start = len(vector)
+    vector.resize(start + len(values))
+    buffer = vector.data()
+    buffer.reshape((len(vector),))
+    np.frombuffer(buffer, dtype=dtype, count=len(vector))[start:] = values
+
+
+def read_mc_collection(event, dic, n_part, debug, unique_MCS, table=None):
     mc_particles = event.get("MCParticles")
-    for jj, mc_particle in enumerate(mc_particles):
-
-        pdg = mc_particle.getPDG()
-        m = mc_particle.getMass()
-        p_ = mc_particle.getMomentum()
-        p = math.sqrt(p_.x**2 + p_.y**2 + p_.z**2)
-        p_t = math.sqrt(p_.x**2 + p_.y**2)
-        object_id_particle = mc_particle.getObjectID()
-        genlink0_particle = object_id_particle.index
-        # only store particles that have hits
-        if np.sum(unique_MCS == jj) > 0:
-            if p > 0:
-                theta = math.acos(p_.z / p)
-                phi = math.atan2(p_.y, p_.x)
-                dic["part_p"].push_back(p)
-                dic["part_p_t"].push_back(p_t)
-                dic["part_theta"].push_back(theta)
-                dic["part_phi"].push_back(phi)
-                dic["part_m"].push_back(m)
-                dic["part_pid"].push_back(pdg)
-                dic["part_id"].push_back(genlink0_particle)
-                # jjz = jjz + 1
-            else:
-                theta = 0.0
-                phi = 0.0
-                dic["part_p"].push_back(p)
-                dic["part_p_t"].push_back(p_t)
-                dic["part_theta"].push_back(theta)
-                dic["part_phi"].push_back(phi)
-                dic["part_m"].push_back(m)
-                dic["part_pid"].push_back(pdg)
-                dic["part_id"].push_back(genlink0_particle)
-            parents = mc_particle.getParents()
-            dic["part_parent"].push_back(parents[0].getObjectID().index)
-            dic["gen_status"].push_back(mc_particle.getGeneratorStatus())
-        if debug and  np.sum(unique_MCS == jj) > 0:
-            if mc_particle.getGeneratorStatus() ==1:
-                print("gen status 1 part")
-                print(
-                    "all genparts: N: {}, PID: {}, Q: {}, P: {:.2e}, status: {}, parents: {}, daughters: {}, decayed_traacker: {}".format(
+    if table is None:
+        table = MCParticleTable.from_collection(mc_particles)
+    # only store particles that have hits
+    unique_MCS = np.asarray(unique_MCS, dtype=np.int64)
+    selected = np.unique(unique_MCS[(unique_MCS >= 0) & (unique_MCS < len(table))])
+    fill_vector(dic["part_p"], table.p[selected])
+    fill_vector(dic["part_p_t"], table.p_t[selected])
+    fill_vector(dic["part_theta"], table.theta[selected])
+    fill_vector(dic["part_phi"], table.phi[selected])
+    fill_vector(dic["part_m"], table["mass"][selected])
+    fill_vector(dic["part_pid"], table["pdg"][selected])
+    fill_vector(dic["part_id"], selected)
+    fill_vector(dic["part_parent"], table["first_parent"][selected])
+    fill_vector(dic["gen_status"], table["gen_status"][selected])
+    if debug:
+        p = table.p
+        for jj in selected[table["gen_status"][selected] == 1]:
+            print("gen status 1 part")
+            print(
+                "all genparts: N: {}, PID: {}, Q: {}, P: {:.2e}, status: {}, parents: {}, daughters: {}, decayed_traacker: {}".format(
+                    jj,
+                    table["pdg"][jj],
+                    table["charge"][jj],
+                    p[jj],
+                    table["gen_status"][jj],
+                    get_genparticle_parents(
                         jj,
-                        mc_particle.getPDG(),
-                        mc_particle.getCharge(),
-                        p,
-
-                        mc_particle.getGeneratorStatus(),
-                        get_genparticle_parents(
-                            genlink0_particle,
-                            mc_particles,
-                        ),
-                        get_genparticle_daughters(
-                            genlink0_particle,
-                            mc_particles,
-                        ),
-                        mc_particle.isDecayedInTracker() * 1,
-                    )
+                        mc_particles,
+                    ),
+                    get_genparticle_daughters(
+                        jj,
+                        mc_particles,
+                    ),
+                    table["decayed_in_tracker"][jj] * 1,
                 )
-        if np.sum(unique_MCS == jj) > 0:
-            n_part[0] += 1
+            )
+    n_part[0] += len(selected)
 
     return n_part, dic
 
@@ -403,6 +308,15 @@ def clear_dic(dic):
     return dic
 
 
+def store_genlink_tau(dic, genlinks, gen_part_coll, index_taus, ancestry=None):
+    # tau ancestor of the MC particle of every hit, resolved once per particle
+    if ancestry is None:
+        ancestry = MCParticleTable.from_collection(gen_part_coll).ancestry
+    tau_of_particle = ancestry.tau_index(index_taus)
+    for index_tau in tau_of_particle[np.asarray(genlinks, dtype=np.int64)].tolist():
+        dic["hit_genlink_tau"].push_back(index_tau)
+
+
 def store_hit_col_CDC(
     event,
     n_hit,
@@ -411,6 +325,7 @@ def store_hit_col_CDC(
     gen_part_coll,
     index_taus,
     store_tau="False",
+    ancestry=None,
 ):
 
     dc_hits_digi = event.get("CDCHDigis")
@@ -420,6 +335,9 @@ def store_hit_col_CDC(
     ii = 0
     number_of_hits_p_seatched = 0
     list_of_MCs1 = []
+    cellIDs = []
+    # the encoding is parsed once per file, the cellIDs of the event are decoded together
+    decoder = decoder_from_metadata(metadata, "CDCHHits")
     for num_hit, dc_hit in enumerate(dc_hits):
         # if i > 2:
         #     break
@@ -458,24 +376,13 @@ def store_hit_col_CDC(
         dic["hit_py"].push_back(py)
         dic["hit_pz"].push_back(pz)
         htype = 0
-        # dummy example, cellid_encoding = "foo:2,bar:3,baz:-4"
-        cellid_encoding = metadata.get_parameter("CDCHHits__CellIDEncoding")
-        # 2. Use DD4hep (Andre's magic) to create a decoder object, and then retrieve the field value by using the get method of the decoder object
-        decoder = dd4hep.BitFieldCoder(cellid_encoding)
-        superLayer = decoder.get(cellID, "superLayer")
-        layer = decoder.get(cellID, "layer")
-        phi = decoder.get(cellID, "phi")
-        stereo = decoder.get(cellID, "stereo")
 
         dic["hit_cellID"].push_back(cellID)
+        cellIDs.append(cellID)
         dic["hit_EDep"].push_back(EDep)
         dic["hit_time"].push_back(time)
         dic["hit_pathLength"].push_back(pathLength)
         dic["hit_type"].push_back(htype)
-        dic["superLayer"].push_back(superLayer)
-        dic["layer"].push_back(layer)
-        dic["phi"].push_back(phi)
-        dic["stereo"].push_back(stereo)
 
         mcParticle = dc_hit.getMCParticle()
         # print(dir(mcParticle))
@@ -484,27 +391,21 @@ def store_hit_col_CDC(
         object_id = mcParticle.getObjectID()
         # # print(object_id.index)
         genlink0 = object_id.index
-        if store_tau == "True":
-            p, belongs_to_tau_1, belongs_to_tau_2 = find_mother_particle_check_tau(
-                genlink0, gen_part_coll, index_taus[0], index_taus[1]
-            )
-            if belongs_to_tau_1:
-                index_tau = index_taus[0]
-            elif belongs_to_tau_2:
-                index_tau = index_taus[1]
-            else:
-                index_tau = -1
-            dic["hit_genlink_tau"].push_back(index_tau)
 
         if genlink0 == 74:
             number_of_hits_p_seatched = number_of_hits_p_seatched + 1
         # print(pdg_particle, genlink0, object_id.index)
-        # mcParticle_mother_index = find_mother_particle(mcParticle)
+        # mcParticle_mother_index = ancestry.tracker_mother()[genlink0]
         dic["hit_genlink0"].push_back(genlink0)
         list_of_MCs1.append(genlink0)
         # hit_pdg_particle.push_back(pdg_particle)
         ii += 1
         n_hit[0] += 1
+    decoded = decoder.decode(cellIDs, ["superLayer", "layer", "phi", "stereo"])
+    for name, values in decoded.items():
+        fill_vector(dic[name], values)
+    if store_tau == "True":
+        store_genlink_tau(dic, list_of_MCs1, gen_part_coll, index_taus, ancestry)
     print("number_of_hits_p_seatched", number_of_hits_p_seatched)
     return n_hit, dic, list_of_MCs1
 
@@ -516,6 +417,7 @@ def store_hit_col_VTX(
     gen_part_coll,
     index_taus,
     store_tau="False",
+    ancestry=None,
 ):
     number_of_hits_p_seatched = 0
     vtx_hits = event.get("VTXDCollection")
@@ -581,20 +483,9 @@ def store_hit_col_VTX(
             genlink0 = object_id.index
             if genlink0 == 74:
                 number_of_hits_p_seatched = number_of_hits_p_seatched + 1
-            if store_tau == "True":
-                p, belongs_to_tau_1, belongs_to_tau_2 = find_mother_particle_check_tau(
-                    genlink0, gen_part_coll, index_taus[0], index_taus[1]
-                )
-                if belongs_to_tau_1:
-                    index_tau = index_taus[0]
-                elif belongs_to_tau_2:
-                    index_tau = index_taus[1]
-                else:
-                    index_tau = -1
-                dic["hit_genlink_tau"].push_back(index_tau)
 
             # print("VTX")
-            # mcParticle_mother_index = find_mother_particle(mcParticle)
+            # mcParticle_mother_index = ancestry.tracker_mother()[genlink0]
             # if genlink0 == 69:
             #     print("genlink0", genlink0)
             #     print("position1", x, y, z)
@@ -609,19 +500,14 @@ def store_hit_col_VTX(
             list_of_MCs1.append(genlink0)
             ii += 1
             n_hit[0] += 1
+    if store_tau == "True":
+        store_genlink_tau(dic, list_of_MCs1, gen_part_coll, index_taus, ancestry)
     print("number_of_hits_p_seatched   VTX",number_of_hits_p_seatched )
     return n_hit, dic, list_of_MCs1
 
 
-def merge_list_MCS(list_1, list_2,store_tau, index_taus):
-    list_1 = np.array(list_1)
-    list_2 = np.array(list_2)
-    unique_m1 = np.unique(list_1)
-    unique_m2 = np.unique(list_2)
+def merge_list_MCS(list_1, list_2, store_tau, index_taus):
+    unique_mc = np.union1d(np.asarray(list_1, dtype=np.int64), np.asarray(list_2, dtype=np.int64))
     if store_tau == "True":
-        unique_mc = np.concatenate((unique_m1, unique_m2, index_taus), axis=0)
-    else:
-        unique_mc = np.concatenate((unique_m1, unique_m2), axis=0)
-    
-    print("unique_mc", unique_mc)
+        unique_mc = np.union1d(unique_mc, index_taus)
     return unique_mc
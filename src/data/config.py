@@ -3,7 +3,7 @@ import yaml
 import copy
 
 from src.logger.logger import _logger
-from src.data.tools import _get_variable_names
+from src.data.tools import _compile_expr
 
 
 def _as_list(x):
@@ -42,7 +42,11 @@ class DataConfig(object):
             'monitor_variables': [],
             'weights': None,
             'graph_config': {},
-            'custom_model_kwargs': {}
+            'custom_model_kwargs': {},
+            'overlay': None,
+            'synthetic': None,
+            'ragged': False,
+            'numexpr': False,
         }
         for k, v in kwargs.items():
             if v is not None:
@@ -95,6 +99,13 @@ class DataConfig(object):
                         self._missing_standardization_info = True
                     self.preprocess_params[v[0]] = params
         
+        # ragged inputs: flat values and event offsets instead of padding to `length`,
+        # the number of hits and particles is then known and the masks are not needed
+        if opts['ragged']:
+            self.input_names = tuple(k for k in self.input_names if not k.endswith('_mask'))
+            self.input_dicts = {k: self.input_dicts[k] for k in self.input_names}
+            self.input_shapes = {k: (-1, self.input_shapes[k][1], None) for k in self.input_names}
+
         # observers
         self.observer_names = tuple(opts['observers'])
         # monitor variables
@@ -130,19 +141,25 @@ class DataConfig(object):
                               'reweight_discard_under_overflow']:
                         _log('%s: %s' % (k, getattr(self, k)))
 
+        # expressions compiled once, see src/data/tools.py
+        self.selection_expr = _compile_expr(self.selection, opts['numexpr']) if self.selection else None
+        self.test_time_selection_expr = _compile_expr(
+            self.test_time_selection, opts['numexpr']) if self.test_time_selection else None
+        self.var_funcs_expr = {k: _compile_expr(v, opts['numexpr']) for k, v in self.var_funcs.items()}
+
         # parse config
         self.keep_branches = set()
         aux_branches = set()
         # selection
         if self.selection:
-            aux_branches.update(_get_variable_names(self.selection))
+            aux_branches.update(self.selection_expr.names)
         # test time selection
         if self.test_time_selection:
-            aux_branches.update(_get_variable_names(self.test_time_selection))
+            aux_branches.update(self.test_time_selection_expr.names)
         # var_funcs
         self.keep_branches.update(self.var_funcs.keys())
-        for expr in self.var_funcs.values():
-            aux_branches.update(_get_variable_names(expr))
+        for expr in self.var_funcs_expr.values():
+            aux_branches.update(expr.names)
         # inputs
         for names in self.input_dicts.values():
             self.keep_branches.update(names)
@@ -161,6 +178,9 @@ class DataConfig(object):
         # keep and drop
         self.drop_branches = (aux_branches - self.keep_branches)
         self.load_branches = (aux_branches | self.keep_branches) - set(self.var_funcs.keys()) #- {self.weight_name, }
+        if opts['overlay']:
+            # produced by the background overlay (src/data/overlay.py)
+            self.load_branches = self.load_branches - {'isoverlay'}
         if print_info:
             _logger.debug('drop_branches:\n  %s', ','.join(self.drop_branches))
             _logger.debug('load_branches:\n  %s', ','.join(self.load_branches))
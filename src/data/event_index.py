@@ -0,0 +1,138 @@
+import os
+import json
+import tempfile
+import numpy as np
+import awkward as ak
+
+from src.data.fileio import _read_file, _branch_names, _entry_range
+from src.logger.logger import _logger
+
+# index of every event of a dataset: file, entry, number of hits and of
+# particles, persisted in a .npz so that it is built once. Files whose size or
+# mtime changed since are indexed again when the index is loaded.
+
+
+def _count_events(filepath, treename=None):
+    # hits and particles of each event, from n_hit/n_part or the length of the hit
+    # and particle vectors in files without them (e.g. shards exported with --data-config)
+    names = _branch_names(filepath, treename)
+    if names is None or ('n_hit' in names and 'n_part' in names):
+        a = _read_file(filepath, 0, ['n_hit', 'n_part'], treename=treename)
+        if a is None:
+            return None
+        if 'n_hit' in a.fields and 'n_part' in a.fields:
+            return ak.to_numpy(a['n_hit']).astype(np.int64), ak.to_numpy(a['n_part']).astype(np.int64)
+    a = _read_file(filepath, 0, ['hit_x', 'part_p'], treename=treename)
+    if a is None:
+        return None
+    return ak.to_numpy(ak.num(a['hit_x'])).astype(np.int64), ak.to_numpy(ak.num(a['part_p'])).astype(np.int64)
+
+
+class EventIndex(object):
+    def __init__(self, files, n_hits, n_particles):
+        # n_hits/n_particles: one array per file
+        self.files = list(files)
+        self.file_index = np.concatenate(
+            [np.full(len(n), i, dtype=np.int64) for i, n in enumerate(n_hits)] + [np.zeros(0, dtype=np.int64)])
+        self.entry = np.concatenate([np.arange(len(n), dtype=np.int64) for n in n_hits] + [np.zeros(0, dtype=np.int64)])
+        self.n_hits = np.concatenate(list(n_hits) + [np.zeros(0, dtype=np.int64)])
+        self.n_particles = np.concatenate(list(n_particles) + [np.zeros(0, dtype=np.int64)])
+
+    def __len__(self):
+        return len(self.entry)
+
+    @classmethod
+    def build(cls, filelist, path=None, treename=None):
+        # the files of the persisted index which are not in filelist are kept in it
+        stored = cls._load(path) if path is not None and os.path.exists(path) else {}
+        n_read = 0
+        n_hits, n_particles = [], []
+        files = []
+        for filepath in filelist:
+            stat = os.stat(filepath)
+            record = stored.get(filepath)
+            if record is None or record['size'] != stat.st_size or record['mtime'] != stat.st_mtime:
+                counts = _count_events(filepath, treename)
+                if counts is None:
+                    _logger.error('Could not index file %s, skipping it' % filepath)
+                    continue
+                stored[filepath] = record = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                                             'n_hits': counts[0], 'n_particles': counts[1]}
+                n_read += 1
+            files.append(filepath)
+            n_hits.append(record['n_hits'])
+            n_particles.append(record['n_particles'])
+        _logger.info('Event index: %d events in %d files, %d files indexed now' % (
+            sum(len(n) for n in n_hits), len(files), n_read))
+        if path is not None and n_read > 0:
+            cls._save(path, stored)
+        return cls(files, n_hits, n_particles)
+
+    @staticmethod
+    def _load(path):
+        stored = {}
+        with np.load(path) as npz:
+            header = json.loads(str(npz['header']))
+            offsets = np.cumsum([0] + [h['num_entries'] for h in header])
+            for i, h in enumerate(header):
+                stored[h['path']] = {'size': h['size'], 'mtime': h['mtime'],
+                                     'n_hits': npz['n_hits'][offsets[i]:offsets[i + 1]],
+                                     'n_particles': npz['n_particles'][offsets[i]:offsets[i + 1]]}
+        return stored
+
+    @staticmethod
+    def _save(path, stored):
+        header = [{'path': f, 'size': r['size'], 'mtime': r['mtime'], 'num_entries': len(r['n_hits'])}
+                  for f, r in stored.items()]
+        # temporary file of this process, the DDP ranks building the same index concurrently
+        fd, tmp = tempfile.mkstemp(suffix='.npz', prefix='.' + os.path.basename(path),
+                                   dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, header=json.dumps(header),
+                     n_hits=np.concatenate([r['n_hits'] for r in stored.values()]),
+                     n_particles=np.concatenate([r['n_particles'] for r in stored.values()]))
+        os.replace(tmp, path)
+
+    def subset(self, files):
+        # index of the given files, in their order
+        position = {f: i for i, f in enumerate(self.files)}
+        files = [f for f in files if f in position]
+        n_hits = [self.n_hits[self.file_index == position[f]] for f in files]
+        n_particles = [self.n_particles[self.file_index == position[f]] for f in files]
+        return EventIndex(files, n_hits, n_particles)
+
+    def select(self, load_range):
+        # events of each file within the fractional load_range, as read by _read_files
+        keep = np.zeros(len(self), dtype=bool)
+        for i in range(len(self.files)):
+            in_file = np.nonzero(self.file_index == i)[0]
+            start, stop = _entry_range(len(in_file), load_range)
+            keep[in_file[start:stop]] = True
+        return np.nonzero(keep)[0]
+
+    def hits_per_file(self):
+        return np.bincount(self.file_index, weights=self.n_hits, minlength=len(self.files))
+
+
+def _balanced_file_shards(files, weights, n_shards):
+    # greedy assignment of the heaviest remaining file to the lightest shard;
+    # each shard keeps the files in their original order
+    shards = [[] for _ in range(n_shards)]
+    load = np.zeros(n_shards)
+    for i in sorted(range(len(files)), key=lambda i: -weights[i]):
+        s = int(np.argmin(load))
+        shards[s].append(i)
+        load[s] += weights[i]
+    return [[files[i] for i in sorted(shard)] for shard in shards]
+
+
+def _balanced_event_shards(n_hits, n_shards, rng=None):
+    # equal number of events per shard (so that DDP ranks run the same number of
+    # steps) with balanced hits: the events are sorted by number of hits and dealt
+    # in rounds of n_shards, reversing the order of the shards at every round
+    rng = np.random if rng is None else rng
+    order = np.argsort(n_hits + rng.uniform(0, 0.5, size=len(n_hits)), kind='stable')[::-1]
+    n_rounds = len(order) // n_shards
+    rounds = order[:n_rounds * n_shards].reshape(n_rounds, n_shards)
+    rounds[1::2] = rounds[1::2, ::-1]
+    return [rounds[:, s] for s in range(n_shards)]
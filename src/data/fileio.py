@@ -1,8 +1,10 @@
 import math
+import numpy as np
 import awkward as ak
 import tqdm
 import traceback
 from src.data.tools import _concat
+from src.data.staging import _read_staged
 from src.logger.logger import _logger
 
 
@@ -20,7 +22,7 @@ def _read_hdf5(filepath, branches, load_range=None):
     return ak.Array(outputs)
 
 
-def _read_root(filepath, branches, load_range=None, treename=None):
+def _read_root(filepath, branches, load_range=None, treename=None, executor=None):
     import uproot
     with uproot.open(filepath) as f:
         if treename is None:
@@ -37,7 +39,8 @@ def _read_root(filepath, branches, load_range=None, treename=None):
             stop = max(start + 1, math.trunc(load_range[1] * tree.num_entries))
         else:
             start, stop = None, None
-        outputs = tree.arrays(filter_name=branches, entry_start=start, entry_stop=stop)
+        outputs = tree.arrays(filter_name=branches, entry_start=start, entry_stop=stop,
+                              decompression_executor=executor, interpretation_executor=executor)
     return outputs
 
 
@@ -55,39 +58,163 @@ def _read_awkd(filepath, branches, load_range=None):
 
 
 def _read_parquet(filepath, branches, load_range=None):
-    outputs = ak.from_parquet(filepath, columns=branches)
-    if load_range is not None:
-        start = math.trunc(load_range[0] * len(outputs))
-        stop = max(start + 1, math.trunc(load_range[1] * len(outputs)))
-        outputs = outputs[start:stop]
-    return outputs
+    if load_range is None:
+        return ak.from_parquet(filepath, columns=branches)
+    # only decode the row groups overlapping with load_range
+    metadata = ak.metadata_from_parquet(filepath)
+    num_rows = metadata['num_rows']
+    start = math.trunc(load_range[0] * num_rows)
+    stop = max(start + 1, math.trunc(load_range[1] * num_rows))
+    bounds = np.cumsum([0] + list(metadata['col_counts']))
+    first = np.searchsorted(bounds, start, side='right') - 1
+    last = np.searchsorted(bounds, stop, side='left')
+    outputs = ak.from_parquet(filepath, columns=branches, row_groups=range(first, last))
+    return outputs[start - bounds[first]:stop - bounds[first]]
+
+
+def _read_shard(filepath, branches, load_range=None):
+    # compact training format, see src/data/shards.py
+    from src.data.shards import _read_shard
+    return _read_shard(filepath, branches, load_range=load_range)
+
+
+def _entry_range(num_entries, load_range=None):
+    # entries read by the readers above for a given load_range
+    if load_range is None:
+        return 0, num_entries
+    start = math.trunc(load_range[0] * num_entries)
+    stop = max(start + 1, math.trunc(load_range[1] * num_entries))
+    return start, min(stop, num_entries)
+
 
+def _load_range_of_entries(start, stop, num_entries):
+    # fractional load_range reading exactly the entries [start, stop), the half
+    # entry margins absorbing the rounding of the products in _entry_range
+    return ((start + 0.5) / num_entries, (stop + 0.5) / num_entries)
 
-def _read_files(filelist, branches, load_range=None, show_progressbar=False, **kwargs):
+
+def _num_entries(filepath, treename=None):
+    # number of events of a root, parquet or shard file, None for the other formats
     import os
-    branches = list(branches)
-    table = []
-    if show_progressbar:
-        filelist = tqdm.tqdm(filelist)
-    for filepath in filelist:
+
+    def read(filepath):
+        ext = os.path.splitext(filepath)[1]
+        if ext == '.root':
+            import uproot
+            with uproot.open(filepath) as f:
+                name = treename
+                if name is None:
+                    treenames = set([k.split(';')[0] for k, v in f.items() if getattr(v, 'classname', '') == 'TTree'])
+                    if len(treenames) != 1:
+                        return None
+                    name = treenames.pop()
+                return f[name].num_entries
+        elif ext == '.parquet':
+            return ak.metadata_from_parquet(filepath)['num_rows']
+        elif ext == '.shard':
+            from src.data.shards import _shard_num_entries
+            return _shard_num_entries(filepath)
+        return None
+
+    return _read_staged(filepath, read)
+
+
+def _branch_names(filepath, treename=None):
+    # branches of a root, parquet or shard file, read from its metadata only, None for the other formats
+    import os
+
+    def read(filepath):
         ext = os.path.splitext(filepath)[1]
-        if ext not in ('.h5', '.root', '.awkd', '.parquet'):
-            raise RuntimeError('File %s of type `%s` is not supported!' % (filepath, ext))
-        try:
-            if ext == '.h5':
-                a = _read_hdf5(filepath, branches, load_range=load_range)
-            elif ext == '.root':
-                a = _read_root(filepath, branches, load_range=load_range, treename=kwargs.get('treename', None))
-            elif ext == '.awkd':
-                a = _read_awkd(filepath, branches, load_range=load_range)
-            elif ext == '.parquet':
-                a = _read_parquet(filepath, branches, load_range=load_range)
-        except Exception as e:
-            a = None
-            _logger.error('When reading file %s:', filepath)
-            _logger.error(traceback.format_exc())
-        if a is not None:
-            table.append(a)
+        if ext == '.root':
+            import uproot
+            with uproot.open(filepath) as f:
+                name = treename
+                if name is None:
+                    treenames = set([k.split(';')[0] for k, v in f.items() if getattr(v, 'classname', '') == 'TTree'])
+                    if len(treenames) != 1:
+                        return None
+                    name = treenames.pop()
+                return list(f[name].keys())
+        elif ext == '.parquet':
+            return list(ak.metadata_from_parquet(filepath)['form'].fields)
+        elif ext == '.shard':
+            from src.data.shards import _read_header
+            return list(_read_header(filepath)['columns'])
+        return None
+
+    return _read_staged(filepath, read)
+
+
+def _read_file(filepath, file_index, branches, load_range=None, with_entries=False, executor=None, **kwargs):
+    import os
+    ext = os.path.splitext(filepath)[1]
+    if ext not in ('.h5', '.root', '.awkd', '.parquet', '.shard'):
+        raise RuntimeError('File %s of type `%s` is not supported!' % (filepath, ext))
+
+    def read(filepath):
+        if ext == '.h5':
+            return _read_hdf5(filepath, branches, load_range=load_range)
+        elif ext == '.root':
+            return _read_root(filepath, branches, load_range=load_range, treename=kwargs.get('treename', None),
+                              executor=executor)
+        elif ext == '.awkd':
+            return _read_awkd(filepath, branches, load_range=load_range)
+        elif ext == '.parquet':
+            return _read_parquet(filepath, branches, load_range=load_range)
+        elif ext == '.shard':
+            return _read_shard(filepath, branches, load_range=load_range)
+
+    try:
+        # local copy if the file is staged (--copy-inputs)
+        a = _read_staged(filepath, read)
+    except Exception as e:
+        a = None
+        _logger.error('When reading file %s:', filepath)
+        _logger.error(traceback.format_exc())
+    if a is not None and with_entries:
+        num_entries = _num_entries(filepath, kwargs.get('treename', None))
+        if num_entries is None:
+            a['_entry'] = np.full(len(a), -1, dtype=np.int64)
+        else:
+            start = _entry_range(num_entries, load_range)[0]
+            a['_entry'] = np.arange(start, start + len(a), dtype=np.int64)
+        a['_file_index'] = np.full(len(a), file_index, dtype=np.int64)
+    return a
+
+
+def _read_files(filelist, branches, load_range=None, show_progressbar=False, with_entries=False, num_threads=1,
+                **kwargs):
+    # with_entries: add the index of the file in filelist (`_file_index`) and the
+    # entry of each event in its file (`_entry`, -1 if unknown)
+    # num_threads: files read concurrently, sharing as many threads to decompress
+    # the root baskets; the files are concatenated in the order of filelist
+    from concurrent.futures import ThreadPoolExecutor
+    branches = list(branches)
+    executor = None
+    if num_threads > 1:
+        import uproot
+        executor = uproot.ThreadPoolExecutor(num_threads)
+
+    def read(args):
+        file_index, filepath = args
+        return _read_file(filepath, file_index, branches, load_range=load_range, with_entries=with_entries,
+                          executor=executor, **kwargs)
+
+    try:
+        if num_threads > 1 and len(filelist) > 1:
+            with ThreadPoolExecutor(max_workers=min(num_threads, len(filelist))) as pool:
+                results = pool.map(read, enumerate(filelist))
+                if show_progressbar:
+                    results = tqdm.tqdm(results, total=len(filelist))
+                table = [a for a in results if a is not None]
+        else:
+            results = enumerate(filelist)
+            if show_progressbar:
+                results = tqdm.tqdm(results, total=len(filelist))
+            table = [a for a in map(read, results) if a is not None]
+    finally:
+        if executor is not None:
+            executor.shutdown()
     table = _concat(table)  # ak.Array
     if len(table) == 0:
         raise RuntimeError(f'Zero entries loaded when reading files {filelist} with `load_range`={load_range}.')
@@ -0,0 +1,157 @@
+import glob
+import numpy as np
+import awkward as ak
+
+from src.data.fileio import _read_files
+from src.logger.logger import _logger
+
+# background overlay at loading time, replacing the OverlayTiming job: events of
+# a pool of pre-converted background ntuples are sampled for each signal event,
+# their hits outside the time windows of each detector are dropped and the rest
+# is appended to the hits and particles of the signal event, with isoverlay=1.
+# yaml:
+# overlay:
+#    files: [/path/to/background/*.root]
+#    number_background: 20        # or [min, max], sampled for every signal event
+#    time_windows: {0: [0, 400], 1: [0, 19]}   # ns, per hit_type (0: CDCH, 1: VTX)
+#    max_background_events: 2000  # size of the pool
+#    hit_branches: [hit_x, ...]   # branches with one value per hit, default: the ones of the converters
+#    part_branches: [part_p, ...] # branches with one value per MC particle
+# The pool is read from the first files until max_background_events events and
+# kept in memory by every process loading data, i.e. by every DataLoader worker:
+# each of them holds about max_background_events x hits per event x hit
+# branches x 4 bytes, so max_background_events should be lowered with many
+# workers or large background events (null reads all the files).
+
+_overlay_defaults = {
+    'files': [],
+    'treename': None,
+    'number_background': 20,
+    'time_windows': {0: [0, 400], 1: [0, 19]},
+    'max_background_events': 2000,
+    'hit_branches': [
+        'hit_x', 'hit_y', 'hit_z', 'hit_px', 'hit_py', 'hit_pz', 'hit_EDep', 'hit_time', 'hit_pathLength',
+        'hit_type', 'hit_cellID', 'hit_genlink0', 'hit_genlink_tau', 'superLayer', 'layer', 'phi', 'stereo',
+        'leftPosition_x', 'leftPosition_y', 'leftPosition_z', 'rightPosition_x', 'rightPosition_y',
+        'rightPosition_z', 'cluster_count', 'produced_by_secondary',
+    ],
+    'part_branches': [
+        'part_p', 'part_p_t', 'part_theta', 'part_phi', 'part_m', 'part_pid', 'part_id', 'part_parent', 'gen_status',
+    ],
+}
+
+# fields holding indices of MC particles, shifted for the background particles
+_mc_index_fields = ('hit_genlink0', 'part_id', 'part_parent')
+
+_background_cache = {}
+
+
+def _overlay_options(overlay):
+    options = dict(_overlay_defaults)
+    options.update(overlay)
+    options['time_windows'] = {int(k): v for k, v in options['time_windows'].items()}
+    return options
+
+
+def _load_background(options, branches):
+    # the pool is read once per process and kept in memory, see above
+    files = sorted(set(sum([glob.glob(f) for f in options['files']], [])))
+    max_events = options['max_background_events']
+    key = (tuple(files), tuple(sorted(branches)), max_events)
+    if key not in _background_cache:
+        tables = []
+        n_events = 0
+        for filepath in files:
+            if max_events is not None and n_events >= max_events:
+                break
+            try:
+                table = _read_files([filepath], branches, treename=options['treename'])
+            except RuntimeError:
+                # empty or unreadable file, already reported by _read_files
+                continue
+            tables.append(table)
+            n_events += len(table)
+        if len(tables) == 0:
+            raise RuntimeError('No background event for the overlay in %s' % options['files'])
+        table = ak.concatenate(tables)
+        if max_events is not None:
+            table = table[:max_events]
+        _logger.info('Loaded %d background events for the overlay from %d files' % (len(table), len(tables)))
+        _background_cache[key] = table
+    return _background_cache[key]
+
+
+def _apply_time_windows(background, time_windows):
+    keep = ak.ones_like(background['hit_time'], dtype=bool)
+    for hit_type, (t_min, t_max) in time_windows.items():
+        in_window = (background['hit_time'] >= t_min) & (background['hit_time'] <= t_max)
+        keep = keep & ((background['hit_type'] != hit_type) | in_window)
+    return keep
+
+
+def _n_mc(table):
+    # size of the MC collection seen by the hits and particles of every event
+    n_mc = np.zeros(len(table), dtype=np.int64)
+    for name in _mc_index_fields:
+        if name in table.fields:
+            n_mc = np.maximum(n_mc, ak.to_numpy(ak.fill_none(ak.max(table[name], axis=1), -1)).astype(np.int64) + 1)
+    return n_mc
+
+
+def _apply_overlay(table, data_config):
+    options = _overlay_options(data_config.overlay)
+    hit_fields = [k for k in table.fields if k in options['hit_branches']]
+    part_fields = [k for k in table.fields if k in options['part_branches']]
+    unknown = [k for k in table.fields if table[k].ndim > 1 and k not in hit_fields and k not in part_fields]
+    if unknown:
+        raise RuntimeError('Branches %s are neither in `hit_branches` nor in `part_branches` of the overlay config, '
+                           'the overlay does not know how to extend them' % unknown)
+    branches = set(hit_fields + part_fields) | {'hit_x', 'hit_time', 'hit_type'}
+    pool = _load_background(options, branches)
+    branches = [k for k in branches if k in pool.fields]
+
+    # number of background events for every signal event
+    n_bkg = options['number_background']
+    if isinstance(n_bkg, (list, tuple)):
+        counts = np.random.randint(n_bkg[0], n_bkg[1] + 1, size=len(table))
+    else:
+        counts = np.full(len(table), n_bkg)
+    background = pool[np.random.randint(0, len(pool), size=np.sum(counts))]
+
+    # the MC particles of each background event are appended after the ones of the
+    # signal event and of the previous background events
+    n_mc_bkg = _n_mc(background)
+    first_mc = np.repeat(_n_mc(table), counts)
+    group_start = np.repeat(np.cumsum(counts) - counts, counts)
+    cumulative = np.cumsum(n_mc_bkg) - n_mc_bkg
+    offset = first_mc + cumulative - cumulative[group_start]
+
+    keep = _apply_time_windows(background, options['time_windows'])
+    part_ref = [k for k in part_fields if k in branches]
+    outputs = {}
+    for name in table.fields:
+        if name not in hit_fields and name not in part_fields:
+            outputs[name] = table[name]
+            continue
+        if name in branches:
+            values = background[name]
+            if name in _mc_index_fields:
+                values = ak.where(values >= 0, values + offset, values)
+        else:
+            # e.g. hit_genlink_tau: no tau in the background
+            values = ak.full_like(background['hit_x' if name in hit_fields else part_ref[0]], -1)
+        if name in hit_fields:
+            values = values[keep]
+        grouped = ak.flatten(ak.unflatten(values, counts), axis=2)
+        outputs[name] = ak.concatenate([table[name], grouped], axis=1)
+    n_kept = ak.to_numpy(ak.sum(ak.unflatten(ak.num(background['hit_x'][keep]), counts), axis=1))
+    isoverlay = ak.concatenate(
+        [ak.zeros_like(table['hit_x'], dtype=np.float32),
+         ak.unflatten(np.ones(int(ak.sum(n_kept)), dtype=np.float32), n_kept)],
+        axis=1)
+    outputs['isoverlay'] = isoverlay
+    if 'n_hit' in outputs:
+        outputs['n_hit'] = ak.num(outputs['hit_x'])
+    if 'n_part' in outputs and len(part_fields):
+        outputs['n_part'] = ak.num(outputs[part_fields[0]])
+    return ak.Array(outputs)
@@ -1,11 +1,18 @@
+import os
 import time
 import glob
 import copy
+import json
+import hashlib
+import tqdm
 import numpy as np
 import awkward as ak
 
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
 from src.logger.logger import _logger
-from src.data.tools import _get_variable_names, _eval_expr
+from src.data.tools import _eval_expr, _expr_key
 from src.data.fileio import _read_files
 
 
@@ -71,12 +78,57 @@ def _build_weights(table, data_config, reweight_hists=None, warn=_logger.warning
         return wgt
 
 
+# the standardization statistics are computed file by file: each file is
+# summarized by the number of values of every variable and their values at
+# _n_quantiles evenly spaced quantiles, and the percentiles of all the files
+# are the weighted percentiles of these quantiles, weighted by the number of
+# values of their file. The summaries are cached per file, keyed by its path,
+# size and mtime, the load range, the selection and the variable definitions,
+# so that adding files only reads the new ones.
+_n_quantiles = 1001
+
+
+def _file_summary(filepath, load_branches, keep_branches, var_funcs, selection, load_range, treename):
+    try:
+        table = _read_files([filepath], load_branches, load_range, treename=treename)
+    except RuntimeError:
+        return None
+    table = _apply_selection(table, selection)
+    table = _build_new_variables(table, {k: v for k, v in var_funcs.items() if k in keep_branches})
+    summary = {'n_events': len(table), 'vars': {}}
+    for k in keep_branches:
+        a = ak.to_numpy(ak.flatten(table[k], axis=None)).astype(np.float64)
+        n_nan = int(np.sum(np.isnan(a)))
+        a = np.nan_to_num(a)
+        summary['vars'][k] = {
+            'count': len(a),
+            'n_nan': n_nan,
+            'quantiles': np.quantile(a, np.linspace(0, 1, _n_quantiles)).tolist() if len(a) else [],
+        }
+    return summary
+
+
+def _merged_percentiles(summaries, percentiles):
+    # percentiles of the union of the values summarized by (count, quantiles),
+    # each quantile of a file standing for count / _n_quantiles of its values
+    summaries = [s for s in summaries if s['count'] > 0]
+    points = np.concatenate([s['quantiles'] for s in summaries])
+    weights = np.concatenate([np.full(len(s['quantiles']), s['count'] / len(s['quantiles'])) for s in summaries])
+    order = np.argsort(points, kind='stable')
+    points, weights = points[order], weights[order]
+    cdf = (np.cumsum(weights) - 0.5 * weights) / np.sum(weights)
+    return np.interp(np.asarray(percentiles) / 100., cdf, points)
+
+
 class AutoStandardizer(object):
     r"""AutoStandardizer.
     Class to compute the variable standardization information.
     Arguments:
         filelist (list): list of files to be loaded.
         data_config (DataConfig): object containing data format information.
+    The ``preprocess`` section of the data config may set ``workers``, the number of processes reading the
+    files (default: up to 8), and ``stats_cache``, the directory of the per-file statistics (default:
+    ``.standardizer_cache`` next to the output YAML file).
     """
 
     def __init__(self, filelist, data_config):
@@ -86,57 +138,100 @@ class AutoStandardizer(object):
             filelist, (list, tuple)) else glob.glob(filelist)
         self._data_config = data_config.copy()
         self.load_range = (0, data_config.preprocess.get('data_fraction', 0.1))
+        self.num_workers = data_config.preprocess.get('workers', min(8, os.cpu_count() or 1))
+        self.cache_dir = data_config.preprocess.get('stats_cache', None)
 
-    def read_file(self, filelist):
+    def _set_branches(self):
         self.keep_branches = set()
         self.load_branches = set()
         for k, params in self._data_config.preprocess_params.items():
             if params['center'] == 'auto':
+                if k.endswith('_mask'):
+                    continue
                 self.keep_branches.add(k)
-                if k in self._data_config.var_funcs:
-                    expr = self._data_config.var_funcs[k]
-                    self.load_branches.update(_get_variable_names(expr))
+                if k in self._data_config.var_funcs_expr:
+                    self.load_branches.update(self._data_config.var_funcs_expr[k].names)
                 else:
                     self.load_branches.add(k)
-        if self._data_config.selection:
-            self.load_branches.update(_get_variable_names(self._data_config.selection))
+        if self._data_config.selection_expr is not None:
+            self.load_branches.update(self._data_config.selection_expr.names)
         _logger.debug('[AutoStandardizer] keep_branches:\n  %s', ','.join(self.keep_branches))
         _logger.debug('[AutoStandardizer] load_branches:\n  %s', ','.join(self.load_branches))
 
-        table = _read_files(filelist, self.load_branches, self.load_range,
-                            show_progressbar=True, treename=self._data_config.treename)
-        table = _apply_selection(table, self._data_config.selection)
-        table = _build_new_variables(
-            table, {k: v for k, v in self._data_config.var_funcs.items() if k in self.keep_branches})
-        table = _clean_up(table, self.load_branches - self.keep_branches)
-        return table
+    def _cache_path(self, filepath):
+        stat = os.stat(filepath)
+        key = [os.path.abspath(filepath), stat.st_size, stat.st_mtime, list(self.load_range),
+               self._data_config.treename, _expr_key(self._data_config.selection_expr),
+               {k: _expr_key(self._data_config.var_funcs_expr.get(k)) for k in sorted(self.keep_branches)},
+               _n_quantiles]
+        key = hashlib.md5(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
 
-    def make_preprocess_params(self, table):
-        _logger.info('Using %d events to calculate standardization info', len(table))
+    def read_file(self, filelist):
+        # summaries of the files, from the cache or computed in parallel
+        self._set_branches()
+        summaries = {}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for filepath in filelist:
+                path = self._cache_path(filepath)
+                if os.path.exists(path):
+                    with open(path) as f:
+                        summaries[filepath] = json.load(f)
+        todo = [f for f in filelist if f not in summaries]
+        _logger.info('[AutoStandardizer] %d/%d files in the cache, reading %d files with %d processes',
+                     len(summaries), len(filelist), len(todo), self.num_workers)
+        compute = partial(_file_summary, load_branches=self.load_branches, keep_branches=self.keep_branches,
+                          var_funcs=self._data_config.var_funcs_expr, selection=self._data_config.selection_expr,
+                          load_range=self.load_range, treename=self._data_config.treename)
+        if self.num_workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.num_workers, len(todo))) as executor:
+                results = list(tqdm.tqdm(executor.map(compute, todo), total=len(todo)))
+        else:
+            results = [compute(f) for f in tqdm.tqdm(todo)]
+        for filepath, summary in zip(todo, results):
+            if summary is None:
+                continue
+            summaries[filepath] = summary
+            if self.cache_dir is not None:
+                path = self._cache_path(filepath)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(summary, f)
+                os.replace(path + '.tmp', path)
+        if len(summaries) == 0:
+            raise RuntimeError(f'Zero entries loaded when reading files {filelist} with `load_range`={self.load_range}.')
+        return [summaries[f] for f in filelist if f in summaries]
+
+    def make_preprocess_params(self, summaries):
+        _logger.info('Using %d events to calculate standardization info', sum(s['n_events'] for s in summaries))
         preprocess_params = copy.deepcopy(self._data_config.preprocess_params)
         for k, params in self._data_config.preprocess_params.items():
             if params['center'] == 'auto':
                 if k.endswith('_mask'):
                     params['center'] = None
                 else:
-                    a = ak.to_numpy(ak.flatten(table[k], axis=None))
+                    stats = [s['vars'][k] for s in summaries]
                     # check for NaN
-                    if np.any(np.isnan(a)):
+                    if sum(s['n_nan'] for s in stats) > 0:
                         _logger.warning('[AutoStandardizer] Found NaN in `%s`, will convert it to 0.', k)
                         time.sleep(10)
-                        a = np.nan_to_num(a)
-                    low, center, high = np.percentile(a, [16, 50, 84])
+                    if sum(s['count'] for s in stats) == 0:
+                        raise RuntimeError('[AutoStandardizer] No value of `%s` to compute its standardization' % k)
+                    low, center, high = _merged_percentiles(stats, [16, 50, 84])
                     scale = max(high - center, center - low)
                     scale = 1 if scale == 0 else 1. / scale
                     params['center'] = float(center)
                     params['scale'] = float(scale)
+                    _logger.info('[AutoStandardizer] %s low=%s, center=%s, high=%s, scale=%s',
+                                 k, low, center, high, scale)
                 preprocess_params[k] = params
-                _logger.info('[AutoStandardizer] %s low=%s, center=%s, high=%s, scale=%s', k, low, center, high, scale)
         return preprocess_params
 
     def produce(self, output=None):
-        table = self.read_file(self._filelist)
-        preprocess_params = self.make_preprocess_params(table)
+        if self.cache_dir is None and output:
+            self.cache_dir = os.path.join(os.path.dirname(os.path.abspath(output)), '.standardizer_cache')
+        summaries = self.read_file(self._filelist)
+        preprocess_params = self.make_preprocess_params(summaries)
         self._data_config.preprocess_params = preprocess_params
         # must also propogate the changes to `data_config.options` so it can be persisted
         self._data_config.options['preprocess']['params'] = preprocess_params
@@ -166,19 +261,18 @@ class WeightMaker(object):
                                  (self._data_config.basewgt_name,))
         self.load_branches = set()
         for k in self.keep_branches:
-            if k in self._data_config.var_funcs:
-                expr = self._data_config.var_funcs[k]
-                self.load_branches.update(_get_variable_names(expr))
+            if k in self._data_config.var_funcs_expr:
+                self.load_branches.update(self._data_config.var_funcs_expr[k].names)
             else:
                 self.load_branches.add(k)
-        if self._data_config.selection:
-            self.load_branches.update(_get_variable_names(self._data_config.selection))
+        if self._data_config.selection_expr is not None:
+            self.load_branches.update(self._data_config.selection_expr.names)
         _logger.debug('[WeightMaker] keep_branches:\n  %s', ','.join(self.keep_branches))
         _logger.debug('[WeightMaker] load_branches:\n  %s', ','.join(self.load_branches))
         table = _read_files(filelist, self.load_branches, show_progressbar=True, treename=self._data_config.treename)
-        table = _apply_selection(table, self._data_config.selection)
+        table = _apply_selection(table, self._data_config.selection_expr)
         table = _build_new_variables(
-            table, {k: v for k, v in self._data_config.var_funcs.items() if k in self.keep_branches})
+            table, {k: v for k, v in self._data_config.var_funcs_expr.items() if k in self.keep_branches})
         table = _clean_up(table, self.load_branches - self.keep_branches)
         return table
 
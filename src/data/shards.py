@@ -0,0 +1,265 @@
+import os
+import json
+import glob
+import math
+import time
+import zlib
+import fnmatch
+import argparse
+import numpy as np
+import awkward as ak
+
+from src.logger.logger import _logger
+
+# compact training format: one .shard file per block of events, holding the
+# flat values of every branch at its native dtype, little endian, and for the
+# jagged branches the offsets of the events in them (shared by the branches of
+# a same collection, e.g. all the hit_* branches):
+#   magic | column and offsets blobs, 64-byte aligned | json header | header size (uint64) | magic
+# The reader memory-maps the file and slices the values of the events of the
+# load range, without copy or decompression, unless the exporter compressed a
+# column: compressed columns are split in blocks of events compressed
+# separately, and only the blocks overlapping the load range are decompressed.
+# Export with e.g.
+# python -m src.data.shards --data "/path/to/reco_*.root" --output /path/to/shards \
+#     --data-config config_files/config_tracking_global_vector.yaml
+
+_magic = b"TDCSHRD1"
+_align = 64
+# branches stored as integers when their values are, e.g. the float hit_type of the ntuples
+_int_branches = ("hit_type", "hit_genlink*")
+
+
+def _codecs():
+    # name: (compress, decompress) of the available codecs
+    codecs = {"zlib": (lambda b: zlib.compress(b, 1), zlib.decompress)}
+    try:
+        import lz4.frame
+
+        codecs["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+
+        codecs["zstd"] = (
+            lambda b: zstandard.ZstdCompressor(level=3).compress(b),
+            lambda b: zstandard.ZstdDecompressor().decompress(b),
+        )
+    except ImportError:
+        pass
+    return codecs
+
+
+def _choose_codec(values, codecs, read_mbps, sample_bytes=1 << 23):
+    # codec minimizing the time to read (at read_mbps) and decode the column,
+    # None if reading it uncompressed is faster
+    sample = values[: max(1, sample_bytes // max(values.itemsize, 1))].tobytes()
+    best, best_time = None, len(sample) / (read_mbps * 1e6)
+    for name, (compress, decompress) in codecs.items():
+        compressed = compress(sample)
+        t0 = time.perf_counter()
+        decompress(compressed)
+        t = len(compressed) / (read_mbps * 1e6) + time.perf_counter() - t0
+        if t < best_time:
+            best, best_time = name, t
+    return best
+
+
+def _column(array, name, int_branches):
+    # flat values and per-event counts (None for one value per event) of a branch
+    layout = ak.to_layout(array)
+    counts = None
+    if array.ndim == 2:
+        counts = np.asarray(ak.num(array, axis=1), dtype=np.int64)
+        array = ak.flatten(array)
+    elif array.ndim != 1:
+        raise RuntimeError("Branch %s with %d dimensions cannot be written to a shard" % (name, layout.purelist_depth))
+    values = ak.to_numpy(array)
+    if values.dtype.kind == "f" and any(fnmatch.fnmatch(name, p) for p in int_branches):
+        as_int = values.astype(np.int32)
+        if np.array_equal(as_int, values):
+            values = as_int
+    return np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("<")), counts
+
+
+def _write_shard(filepath, table, compression=None, read_mbps=500, block_events=1024, int_branches=_int_branches):
+    r"""Writes the branches of ``table`` (ak.Array of one or two dimensional branches) to ``filepath``.
+    ``compression``: None, a codec of ``_codecs``, or ``auto`` to compress the columns whose read (at
+    ``read_mbps`` MB/s) and decompression is faster than the read of the uncompressed values.
+    """
+    codecs = _codecs()
+    if compression not in (None, "auto") and compression not in codecs:
+        raise RuntimeError("Unknown compression %s, expected one of %s" % (compression, sorted(codecs)))
+    num_entries = len(table)
+    header = {"num_entries": num_entries, "columns": {}, "offsets": {}}
+    tmp = filepath + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_magic)
+
+        def write_blob(data):
+            f.write(b"\0" * (-f.tell() % _align))
+            pos = f.tell()
+            f.write(data)
+            return pos
+
+        offsets_of = {}
+        for name in table.fields:
+            values, counts = _column(table[name], name, int_branches)
+            column = {"dtype": values.dtype.str, "length": len(values), "offsets": None}
+            if counts is not None:
+                offsets = np.zeros(num_entries + 1, dtype="<i8")
+                np.cumsum(counts, out=offsets[1:])
+                key = offsets.tobytes()
+                if key not in offsets_of:
+                    offsets_of[key] = "o%d" % len(offsets_of)
+                    header["offsets"][offsets_of[key]] = write_blob(key)
+                column["offsets"] = offsets_of[key]
+            else:
+                offsets = np.arange(num_entries + 1, dtype="<i8")
+            codec = compression
+            if compression == "auto" and len(values) > 0:
+                codec = _choose_codec(values, codecs, read_mbps)
+            column["codec"] = codec
+            if codec is None:
+                column["position"] = write_blob(values.tobytes())
+            else:
+                compress = codecs[codec][0]
+                column["blocks"] = []
+                for first in range(0, num_entries, block_events):
+                    block = values[offsets[first] : offsets[min(first + block_events, num_entries)]]
+                    data = compress(block.tobytes())
+                    column["blocks"].append([write_blob(data), len(data)])
+                column["block_events"] = block_events
+            header["columns"][name] = column
+        data = json.dumps(header).encode("utf-8")
+        f.write(data)
+        f.write(np.uint64(len(data)).tobytes())
+        f.write(_magic)
+    os.replace(tmp, filepath)
+    return header
+
+
+def _read_header(filepath):
+    with open(filepath, "rb") as f:
+        f.seek(-8 - len(_magic), os.SEEK_END)
+        size = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        if f.read(len(_magic)) != _magic:
+            raise RuntimeError("File %s is not a shard" % filepath)
+        f.seek(-8 - len(_magic) - size, os.SEEK_END)
+        return json.loads(f.read(size))
+
+
+def _shard_num_entries(filepath):
+    return _read_header(filepath)["num_entries"]
+
+
+def _read_shard(filepath, branches, load_range=None):
+    header = _read_header(filepath)
+    num_entries = header["num_entries"]
+    missing = set(branches) - set(header["columns"])
+    if missing:
+        raise RuntimeError("Branches %s not found in shard %s" % (sorted(missing), filepath))
+    if load_range is None:
+        load_range = (0, 1)
+    start = math.trunc(load_range[0] * num_entries)
+    stop = min(max(start + 1, math.trunc(load_range[1] * num_entries)), num_entries)
+    # copy-on-write, so that the arrays can be modified in place without touching the file
+    buffer = np.memmap(filepath, dtype=np.uint8, mode="c")
+
+    def offsets_of(column):
+        if column["offsets"] is None:
+            return np.arange(num_entries + 1, dtype=np.int64)
+        pos = header["offsets"][column["offsets"]]
+        return buffer[pos : pos + 8 * (num_entries + 1)].view("<i8")
+
+    outputs = {}
+    for name in branches:
+        column = header["columns"][name]
+        dtype = np.dtype(column["dtype"])
+        offsets = offsets_of(column)
+        if column["codec"] is None:
+            pos = column["position"]
+            values = buffer[pos : pos + dtype.itemsize * column["length"]].view(dtype)
+            values = values[offsets[start] : offsets[stop]]
+        else:
+            # only the blocks of events overlapping [start, stop)
+            decompress = _codecs()[column["codec"]][1]
+            block_events = column["block_events"]
+            first, last = start // block_events, (stop - 1) // block_events + 1
+            values = np.concatenate(
+                [
+                    np.frombuffer(decompress(buffer[pos : pos + size].tobytes()), dtype=dtype)
+                    for pos, size in column["blocks"][first:last]
+                ]
+                + [np.zeros(0, dtype=dtype)]
+            )
+            base = offsets[first * block_events]
+            values = values[offsets[start] - base : offsets[stop] - base]
+        if column["offsets"] is None:
+            outputs[name] = ak.Array(ak.contents.NumpyArray(values))
+        else:
+            event_offsets = ak.index.Index64(np.asarray(offsets[start : stop + 1]) - offsets[start])
+            outputs[name] = ak.Array(ak.contents.ListOffsetArray(event_offsets, ak.contents.NumpyArray(values)))
+    return ak.Array(outputs)
+
+
+def export_shards(files, output, branches=None, events_per_shard=10000, compression=None, read_mbps=500,
+                  treename=None):
+    r"""Converts the ``files`` (any format read by ``_read_files``) to shards of ``events_per_shard`` events
+    written to the directory ``output``, as ``<file name>.<i>.shard``. Returns the list of the shards.
+    """
+    from src.data.fileio import _read_files
+
+    os.makedirs(output, exist_ok=True)
+    shards = []
+    for filepath in files:
+        table = _read_files([filepath], branches if branches is not None else _all_branches(filepath, treename),
+                            treename=treename)
+        stem = os.path.splitext(os.path.basename(filepath))[0]
+        for i, start in enumerate(range(0, len(table), events_per_shard)):
+            shard = os.path.join(output, "%s.%d.shard" % (stem, i))
+            header = _write_shard(shard, table[start : start + events_per_shard], compression=compression,
+                                  read_mbps=read_mbps)
+            codecs = {k: c["codec"] for k, c in header["columns"].items() if c["codec"] is not None}
+            _logger.info("Wrote %s, %d events, %.1f MB%s" % (
+                shard, header["num_entries"], os.path.getsize(shard) / 1e6,
+                (", compressed columns: %s" % codecs) if codecs else ""))
+            shards.append(shard)
+    return shards
+
+
+def _all_branches(filepath, treename=None):
+    import uproot
+
+    with uproot.open(filepath) as f:
+        if treename is None:
+            treename = [k.split(';')[0] for k, v in f.items() if getattr(v, 'classname', '') == 'TTree'][0]
+        return list(f[treename].keys())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", nargs="+", required=True, help="input files (glob patterns allowed)")
+    parser.add_argument("--output", required=True, help="output directory of the shards")
+    parser.add_argument("--data-config", default=None, help="only export the branches loaded with this config")
+    parser.add_argument("--events-per-shard", type=int, default=10000)
+    parser.add_argument("--compression", default=None,
+                        help="codec of all the columns (zlib, lz4, zstd), or `auto` to compress the columns "
+                        "which are faster to read compressed at --read-mbps (default: no compression)")
+    parser.add_argument("--read-mbps", type=float, default=500, help="read throughput of the shard storage")
+    parser.add_argument("--treename", default=None)
+    args = parser.parse_args()
+
+    files = sorted(set(sum([glob.glob(f) for f in args.data], [])))
+    branches = None
+    if args.data_config is not None:
+        from src.data.config import DataConfig
+
+        branches = sorted(DataConfig.load(args.data_config).load_branches)
+    export_shards(files, args.output, branches, args.events_per_shard, args.compression, args.read_mbps,
+                  args.treename)
+
+
+if __name__ == "__main__":
+    main()
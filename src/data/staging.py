@@ -0,0 +1,215 @@
+import os
+import time
+import fcntl
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.logger.logger import _logger
+
+# local copies of the input files (--copy-inputs), kept across runs in a
+# staging directory bounded in size, one directory per file keyed by its path,
+# size and mtime:
+#   <staging_dir>/<key>/<file name>
+# The files are copied in the background while training starts: _read_file
+# reads the local copy of a file once it is complete and the original file
+# until then, so the file lists keep the original paths (and the keys of the
+# graph cache and event index do not depend on the staging). The least
+# recently used copies are removed to make room for new ones, except the
+# files of the runs in progress and the copies being written: every run
+# writes the keys of its files to a lease file
+#   <staging_dir>/.leases/<pid>_<id>
+# which it keeps locked until it exits, and a copy is written under the lock
+# of <staging_dir>/<key>/.lock. The leases which are no longer locked are
+# left by runs that exited and are removed.
+
+_staging_dir = None
+# lease files of this process, open and locked until it exits
+_leases = []
+
+
+def _key(filepath, stat):
+    return hashlib.md5(
+        ("%s:%d:%s" % (os.path.abspath(filepath), stat.st_size, stat.st_mtime)).encode("utf-8")
+    ).hexdigest()
+
+
+def _local_path(staging_dir, filepath, stat=None):
+    stat = os.stat(filepath) if stat is None else stat
+    return os.path.join(staging_dir, _key(filepath, stat), os.path.basename(filepath))
+
+
+def _staged(filepath):
+    # local copy of filepath if it is complete, filepath otherwise
+    if _staging_dir is None:
+        return filepath
+    try:
+        local = _local_path(_staging_dir, filepath)
+    except OSError:
+        return filepath
+    return local if os.path.exists(local) else filepath
+
+
+def _read_staged(filepath, read):
+    # read(local copy of filepath), or read(filepath) if the copy is not
+    # complete or was removed between _staged() and the read
+    local = _staged(filepath)
+    if local == filepath:
+        return read(filepath)
+    try:
+        return read(local)
+    except OSError:
+        if os.path.exists(local):
+            raise
+        return read(filepath)
+
+
+class StagingCache(object):
+    r"""Background copy of input files to a persistent local staging directory.
+    Arguments:
+        staging_dir (str): local directory of the copies, ``<tmp>/tracking_dc_staging`` if None.
+        max_bytes (float): maximum size of the staging directory, the least recently used copies being removed
+            to make room for new ones (files which still do not fit are read remotely).
+        num_threads (int): files copied concurrently.
+    """
+
+    def __init__(self, staging_dir=None, max_bytes=100e9, num_threads=4):
+        if staging_dir is None:
+            staging_dir = os.path.join(tempfile.gettempdir(), "tracking_dc_staging")
+        self.staging_dir = staging_dir
+        self.max_bytes = max_bytes
+        self.num_threads = num_threads
+        self._lock = threading.Lock()
+        self.futures = []
+
+    def stage(self, files):
+        global _staging_dir
+        os.makedirs(self.staging_dir, exist_ok=True)
+        _staging_dir = self.staging_dir
+        self._lease([_key(filepath, os.stat(filepath)) for filepath in files])
+        _logger.info("Staging %d files to %s with %d threads" % (len(files), self.staging_dir, self.num_threads))
+        executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        # submitted in the order of the files, which are read in that order
+        self.futures = [executor.submit(self._copy, filepath) for filepath in files]
+        executor.shutdown(wait=False)
+        return self
+
+    def wait(self):
+        return [f.result() for f in self.futures]
+
+    def _lease(self, keys):
+        directory = os.path.join(self.staging_dir, ".leases")
+        os.makedirs(directory, exist_ok=True)
+        # written under a temporary name, so that it is never seen unlocked
+        fd, tmp = tempfile.mkstemp(prefix=".", dir=directory)
+        lease = os.fdopen(fd, "w")
+        fcntl.flock(lease, fcntl.LOCK_EX)
+        lease.write("\n".join(keys))
+        lease.flush()
+        os.replace(tmp, os.path.join(directory, "%d_%s" % (os.getpid(), uuid.uuid4().hex)))
+        _leases.append(lease)
+
+    def _leased_keys(self):
+        # keys of the files of the runs in progress, removing the leases of the runs that exited
+        directory = os.path.join(self.staging_dir, ".leases")
+        keys = set()
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if name.startswith("."):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                lease = open(path)
+            except FileNotFoundError:
+                continue
+            with lease:
+                try:
+                    fcntl.flock(lease, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    keys.update(lease.read().split())
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return keys
+
+    def _copy(self, filepath):
+        stat = os.stat(filepath)
+        local = _local_path(self.staging_dir, filepath, stat)
+        if os.path.exists(local):
+            # used again: most recently used
+            os.utime(local)
+            return local
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(os.path.join(os.path.dirname(local), ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # being copied by another process
+                return None
+            try:
+                if not os.path.exists(local):
+                    if not self._make_room(stat.st_size):
+                        return None
+                    t0 = time.time()
+                    tmp = os.path.join(os.path.dirname(local), ".tmp_" + os.path.basename(local))
+                    shutil.copyfile(filepath, tmp)
+                    os.replace(tmp, local)
+                    _logger.info(
+                        "Staged %s (%.1f MB/s)" % (filepath, stat.st_size / 1e6 / max(time.time() - t0, 1e-6))
+                    )
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return local
+
+    def _make_room(self, nbytes):
+        with self._lock:
+            entries = []
+            for key in os.listdir(self.staging_dir):
+                directory = os.path.join(self.staging_dir, key)
+                if key.startswith(".") or not os.path.isdir(directory):
+                    continue
+                try:
+                    names = os.listdir(directory)
+                except FileNotFoundError:
+                    continue
+                for name in names:
+                    if not name.startswith("."):
+                        path = os.path.join(directory, name)
+                        try:
+                            st = os.stat(path)
+                        except FileNotFoundError:
+                            continue
+                        entries.append((st.st_mtime, st.st_size, key, directory))
+            total = sum(e[1] for e in entries)
+            leased = self._leased_keys()
+            for _, size, key, directory in sorted(entries):
+                if total + nbytes <= self.max_bytes:
+                    break
+                if key in leased or not self._remove(directory):
+                    continue
+                total -= size
+            if total + nbytes > self.max_bytes:
+                _logger.warning(
+                    "Staging directory %s is full (%.1f GB), reading the remaining files of this run remotely"
+                    % (self.staging_dir, self.max_bytes / 1e9)
+                )
+                return False
+            return True
+
+    def _remove(self, directory):
+        # remove the copy in directory unless it is being written
+        try:
+            lock = open(os.path.join(directory, ".lock"), "w")
+        except FileNotFoundError:
+            return False
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            shutil.rmtree(directory, ignore_errors=True)
+        return True
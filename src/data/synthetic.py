@@ -0,0 +1,239 @@
+import numpy as np
+import awkward as ak
+
+from src.data.fileio import _entry_range
+
+# synthetic events replacing the input files, to load-test and profile the data
+# loading, models and losses without ntuples: charged helices from the origin
+# in a solenoid field, with a hit on every drift chamber layer and vertex
+# detector barrel they cross before curling back (IDEA-like geometry, mm),
+# and overlay-like background hits from low momentum particles (isoverlay=1).
+# The drift chamber hits have the left/right positions of the ntuples, at the
+# drift distance of the track on either side of the wire. The file lists hold
+# virtual files ("synthetic:<i>", see synthetic_files) of events_per_file
+# events each, every event being generated from (seed, file, entry), so that
+# the load ranges, fetches and DataLoader workers behave as with real files.
+# Enabled by the `synthetic` flag of SimpleIterDataset, the parameters are
+# taken from the data config:
+# synthetic:
+#    events_per_file: 1000
+#    number_particles: [2, 5]     # sampled for every event
+#    noise_hits: 0                # or [min, max], background hits per event
+#    hit_efficiency: 1.0
+#    p_t: [0.1, 5.0]              # GeV
+#    theta: [0.3, 2.84]           # rad
+#    field: 2.0                   # T
+#    seed: 0
+# The preprocessing parameters of the data config must be given (method: manual).
+
+_synthetic_defaults = {
+    'events_per_file': 1000,
+    'number_particles': [2, 5],
+    'noise_hits': 0,
+    'hit_efficiency': 1.0,
+    'p_t': [0.1, 5.0],
+    'theta': [0.3, 2.84],
+    'field': 2.0,
+    'seed': 0,
+}
+
+# drift chamber: 14 superlayers of 8 layers, with 192 cells in the first
+# superlayer and 48 more in each of the next ones
+_dc_radii = np.linspace(345.0, 1926.0, 112)
+_dc_cells = 192 + 48 * (np.arange(112) // 8)
+_dc_half_length = 2000.0
+_dc_resolution = 0.1
+# vertex detector barrels
+_vtx_radii = np.array([13.7, 22.7, 34.8, 130.0, 315.0])
+_vtx_half_lengths = np.array([140.0, 140.0, 140.0, 320.0, 470.0])
+_vtx_resolution = 0.003
+
+_int_branches = ('n_hit', 'n_part', 'hit_cellID')
+
+_pion_mass = 0.13957
+_electron_mass = 0.000511
+
+
+def _synthetic_options(synthetic, npart_min=None, npart_max=None):
+    options = dict(_synthetic_defaults)
+    options.update(synthetic or {})
+    if npart_min and npart_max:
+        options['number_particles'] = [npart_min, npart_max]
+    return options
+
+
+def synthetic_files(n, offset=0):
+    r"""Names of ``n`` virtual files of synthetic events, for the file lists of ``SimpleIterDataset``."""
+    return ['synthetic:%d' % i for i in range(offset, offset + n)]
+
+
+def _is_synthetic(filepath):
+    return filepath.startswith('synthetic:')
+
+
+def _sample(rng, value):
+    # a number, or an integer in [min, max]
+    if isinstance(value, (list, tuple)):
+        return int(rng.integers(value[0], value[1] + 1))
+    return int(value)
+
+
+def _crossings(radii, radius, charge, phi0, cot_theta):
+    # positions and directions of a helix from the origin where it crosses the
+    # cylinders of the given radii, on its way out
+    crossed = radii < 2 * radius
+    r = radii[crossed]
+    alpha = 2 * np.arcsin(r / (2 * radius))
+    phi = phi0 - charge * alpha
+    x = charge * radius * (np.sin(phi0) - np.sin(phi))
+    y = charge * radius * (np.cos(phi) - np.cos(phi0))
+    z = alpha * radius * cot_theta
+    return np.nonzero(crossed)[0], x, y, z, phi, alpha * radius * np.sqrt(1 + cot_theta ** 2)
+
+
+def _hits(rng, index, layers, x, y, z, momentum, path, beta, hit_type, overlay=0):
+    # block of hits of a particle, on the given layers of the drift chamber
+    # (hit_type 0) or of the vertex detector (hit_type 1)
+    n = len(layers)
+    hits = {
+        'x': x, 'y': y, 'z': z,
+        'px': momentum[0], 'py': momentum[1], 'pz': momentum[2],
+        'type': np.full(n, hit_type),
+        'time': path / (beta * 299.792458),
+        'path': path,
+        'link': np.full(n, index),
+        'layer': layers,
+        'overlay': np.full(n, overlay),
+    }
+    if hit_type == 0:
+        r = _dc_radii[layers]
+        n_cells = _dc_cells[layers]
+        cell = np.round(np.arctan2(y, x) / (2 * np.pi) * n_cells).astype(np.int64) % n_cells
+        wire_phi = 2 * np.pi * cell / n_cells
+        # drift distance, measured on both sides of the wire (left/right ambiguity)
+        tangent = np.stack([-np.sin(wire_phi), np.cos(wire_phi)], axis=1)
+        wire = r[:, None] * np.stack([np.cos(wire_phi), np.sin(wire_phi)], axis=1)
+        drift = np.abs(
+            np.sum((np.stack([x, y], axis=1) - wire) * tangent, axis=1) + rng.normal(0, _dc_resolution, n)
+        )
+        hits['left'] = np.concatenate([wire + drift[:, None] * tangent, z[:, None]], axis=1)
+        hits['right'] = np.concatenate([wire - drift[:, None] * tangent, z[:, None]], axis=1)
+        hits['cell'] = (layers + 1) * 100000 + cell
+        hits['cellphi'] = cell
+    else:
+        hits['left'] = hits['right'] = np.zeros((n, 3))
+        hits['cell'] = layers + 1
+        hits['cellphi'] = np.zeros(n)
+    return hits
+
+
+def _event(rng, options):
+    blocks = []
+    particles = []
+    n_particles = _sample(rng, options['number_particles'])
+    n_noise = _sample(rng, options['noise_hits'])
+
+    for index in range(n_particles):
+        p_t = rng.uniform(*options['p_t'])
+        theta = rng.uniform(*options['theta'])
+        phi0 = rng.uniform(-np.pi, np.pi)
+        charge = rng.choice([-1, 1])
+        cot_theta = 1 / np.tan(theta)
+        p = p_t / np.sin(theta)
+        beta = p / np.sqrt(p ** 2 + _pion_mass ** 2)
+        # radius of curvature in mm
+        radius = p_t / (0.3 * options['field']) * 1000
+        particles.append((p, p_t, theta, phi0, _pion_mass, 211 * charge, index, -1, 1))
+        for radii, half_lengths, hit_type in ((_vtx_radii, _vtx_half_lengths, 1), (_dc_radii, None, 0)):
+            layers, x, y, z, phi, path = _crossings(radii, radius, charge, phi0, cot_theta)
+            limit = _dc_half_length if half_lengths is None else half_lengths[layers]
+            keep = (np.abs(z) <= limit) & (rng.uniform(size=len(layers)) <= options['hit_efficiency'])
+            layers, x, y, z, phi, path = (v[keep] for v in (layers, x, y, z, phi, path))
+            if hit_type == 1:
+                x, y, z = (v + rng.normal(0, _vtx_resolution, len(v)) for v in (x, y, z))
+            momentum = (p_t * np.cos(phi), p_t * np.sin(phi), np.full(len(phi), p_t * cot_theta))
+            blocks.append(_hits(rng, index, layers, x, y, z, momentum, path, beta, hit_type))
+
+    # background: low momentum particles leaving a few hits in neighbouring layers
+    index = n_particles
+    while n_noise > 0:
+        n = min(n_noise, int(rng.integers(1, 5)))
+        first = int(rng.integers(0, len(_dc_radii) - n + 1))
+        phi = rng.uniform(-np.pi, np.pi) + rng.normal(0, 0.002, n)
+        z = np.full(n, rng.uniform(-_dc_half_length, _dc_half_length))
+        p = rng.uniform(0.005, 0.05)
+        particles.append((p, p, np.pi / 2, phi[0], _electron_mass, 11, index, -1, 0))
+        layers = np.arange(first, first + n)
+        r = _dc_radii[layers]
+        momentum = (np.zeros(n), np.zeros(n), np.zeros(n))
+        blocks.append(_hits(rng, index, layers, r * np.cos(phi), r * np.sin(phi), z, momentum, r, 1.0, 0, overlay=1))
+        n_noise -= n
+        index += 1
+    if not blocks:
+        empty = np.zeros(0)
+        blocks.append(_hits(rng, 0, np.zeros(0, dtype=np.int64), empty, empty, empty, (empty,) * 3, empty, 1.0, 1))
+    hits = {k: np.concatenate([b[k] for b in blocks]) for k in blocks[0]}
+    return hits, particles
+
+
+def _event_columns(hits, particles):
+    n = len(hits['x'])
+    left = hits['left'].reshape(n, 3)
+    right = hits['right'].reshape(n, 3)
+    parts = np.asarray(particles, dtype=np.float32).reshape(len(particles), 9)
+    layer = hits['layer']
+    is_dc = hits['type'] == 0
+    columns = {
+        'n_hit': n,
+        'hit_x': hits['x'], 'hit_y': hits['y'], 'hit_z': hits['z'],
+        'hit_px': hits['px'], 'hit_py': hits['py'], 'hit_pz': hits['pz'],
+        'hit_type': hits['type'],
+        'hit_EDep': np.full(n, 1e-6),
+        'hit_time': hits['time'],
+        'hit_pathLength': hits['path'],
+        'hit_cellID': hits['cell'],
+        'hit_genlink0': hits['link'],
+        'leftPosition_x': left[:, 0], 'leftPosition_y': left[:, 1], 'leftPosition_z': left[:, 2],
+        'rightPosition_x': right[:, 0], 'rightPosition_y': right[:, 1], 'rightPosition_z': right[:, 2],
+        'cluster_count': np.where(is_dc, 1, 0),
+        'produced_by_secondary': np.zeros(n),
+        'superLayer': np.where(is_dc, layer // 8, 0),
+        'layer': np.where(is_dc, layer % 8, layer),
+        'phi': hits['cellphi'],
+        'stereo': np.zeros(n),
+        'isoverlay': hits['overlay'],
+        'n_part': len(particles),
+    }
+    for i, name in enumerate(('part_p', 'part_p_t', 'part_theta', 'part_phi', 'part_m', 'part_pid', 'part_id',
+                              'part_parent', 'gen_status')):
+        columns[name] = parts[:, i]
+    return columns
+
+
+def _read_synthetic(filelist, branches, load_range, options):
+    # table of the events of the load range of the virtual files, as _read_files
+    events = {k: [] for k in branches}
+    for filepath in filelist:
+        if not _is_synthetic(filepath):
+            raise RuntimeError('File %s is not a virtual file of synthetic events (synthetic_files)' % filepath)
+        file_index = int(filepath.rsplit(':', 1)[1])
+        start, stop = _entry_range(options['events_per_file'], load_range)
+        for entry in range(start, stop):
+            rng = np.random.default_rng([options['seed'], file_index, entry])
+            columns = _event_columns(*_event(rng, options))
+            unknown = set(branches) - set(columns)
+            if unknown:
+                raise RuntimeError('Branches %s are not produced by the synthetic events' % sorted(unknown))
+            for k in branches:
+                events[k].append(columns[k])
+    table = {}
+    for k, v in events.items():
+        # dtypes of the ntuples
+        dtype = np.int32 if k in _int_branches else np.float32
+        if k in ('n_hit', 'n_part'):
+            table[k] = np.asarray(v, dtype=dtype)
+        else:
+            counts = np.array([len(x) for x in v], dtype=np.int64)
+            flat = np.concatenate([np.asarray(x, dtype=dtype) for x in v] + [np.zeros(0, dtype=dtype)])
+            table[k] = ak.unflatten(flat, counts)
+    return ak.Array(table)
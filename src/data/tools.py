@@ -2,6 +2,9 @@ import numpy as np
 import math
 
 import awkward as ak
+from functools import lru_cache
+
+from src.logger.logger import warn_once
 
 
 def _concat(arrays, axis=0):
@@ -136,6 +139,16 @@ def _p4_from_ptetaphim(pt, eta, phi, mass):
     return vector.zip({"pt": pt, "eta": eta, "phi": phi, "mass": mass})
 
 
+def _decode_cellid(cellid, field, cellid_encoding):
+    # the encoding is parsed by the decoder of the data_creation converters
+    from data_creation.data_processing.cellid_decoder import get_decoder
+
+    counts = ak.num(cellid) if isinstance(cellid, ak.Array) and cellid.ndim > 1 else None
+    flat = ak.to_numpy(ak.flatten(cellid)) if counts is not None else np.asarray(cellid)
+    value = get_decoder(cellid_encoding).get(flat, field)
+    return ak.unflatten(value, counts) if counts is not None else value
+
+
 def _get_variable_names(expr, exclude=["awkward", "ak", "np", "numpy", "math"]):
     import ast
 
@@ -150,27 +163,136 @@ def _get_variable_names(expr, exclude=["awkward", "ak", "np", "numpy", "math"]):
     )
 
 
-def _eval_expr(expr, table):
-    tmp = {k: table[k] for k in _get_variable_names(expr)}
-    tmp.update(
-        {
-            "math": math,
-            "np": np,
-            "numpy": np,
-            "ak": ak,
-            "awkward": ak,
-            "_concat": _concat,
-            "_stack": _stack,
-            "_pad": _pad,
-            "_repeat_pad": _repeat_pad,
-            "_clip": _clip,
-            "_batch_knn": _batch_knn,
-            "_batch_permute_indices": _batch_permute_indices,
-            "_batch_argsort": _batch_argsort,
-            "_batch_gather": _batch_gather,
-            "_p4_from_pxpypze": _p4_from_pxpypze,
-            "_p4_from_ptetaphie": _p4_from_ptetaphie,
-            "_p4_from_ptetaphim": _p4_from_ptetaphim,
-        }
+# expressions of the data config (selection, new_variables) are parsed and
+# compiled once into _Expr objects. Masks defined as ak.ones_like(x) are built
+# from the offsets of x without evaluating the expression, and with
+# numexpr=True the arithmetic expressions of flat arrays, or of jagged arrays
+# with the same structure, are evaluated by numexpr if it is installed.
+_expr_globals = {
+    "math": math,
+    "np": np,
+    "numpy": np,
+    "ak": ak,
+    "awkward": ak,
+    "_concat": _concat,
+    "_stack": _stack,
+    "_pad": _pad,
+    "_repeat_pad": _repeat_pad,
+    "_clip": _clip,
+    "_batch_knn": _batch_knn,
+    "_batch_permute_indices": _batch_permute_indices,
+    "_batch_argsort": _batch_argsort,
+    "_batch_gather": _batch_gather,
+    "_p4_from_pxpypze": _p4_from_pxpypze,
+    "_p4_from_ptetaphie": _p4_from_ptetaphie,
+    "_p4_from_ptetaphim": _p4_from_ptetaphim,
+    "_decode_cellid": _decode_cellid,
+}
+
+
+def _ones_like_arg(root):
+    # x for ak.ones_like(x), np.ones_like(x) or awkward.JaggedArray.ones_like(x)
+    import ast
+
+    node = root.body
+    if not (
+        isinstance(node, ast.Call)
+        and len(node.args) == 1
+        and not node.keywords
+        and isinstance(node.args[0], ast.Name)
+        and isinstance(node.func, ast.Attribute)
+        and node.func.attr == "ones_like"
+    ):
+        return None
+    owner = node.func.value
+    if isinstance(owner, ast.Attribute) and owner.attr == "JaggedArray":
+        owner = owner.value
+    if isinstance(owner, ast.Name) and owner.id in ("ak", "awkward", "np", "numpy"):
+        return node.args[0].id
+    return None
+
+
+def _is_numexpr_compatible(root):
+    # arithmetic, comparisons and bitwise operations of variables and numbers
+    import ast
+
+    allowed = (
+        ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Constant, ast.Load,
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.BitAnd, ast.BitOr, ast.Invert,
+        ast.USub, ast.UAdd, ast.Lt, ast.Gt, ast.LtE, ast.GtE, ast.Eq, ast.NotEq,
     )
-    return eval(expr, tmp)
+    for node in ast.walk(root):
+        if not isinstance(node, allowed):
+            return False
+        if isinstance(node, ast.Compare) and len(node.ops) > 1:
+            return False
+        if isinstance(node, ast.Name) and node.id in _expr_globals:
+            return False
+    return True
+
+
+class _Expr(object):
+    def __init__(self, expr, use_numexpr=False):
+        import ast
+
+        self.expr = expr
+        root = ast.parse(expr, mode="eval")
+        self.code = compile(root, "<expr>", "eval")
+        self.names = _get_variable_names(expr)
+        self.ones_like = _ones_like_arg(root)
+        self.use_numexpr = use_numexpr and _is_numexpr_compatible(root)
+        self._numexpr = None
+        if self.use_numexpr:
+            try:
+                import numexpr
+
+                self._numexpr = numexpr
+            except ImportError:
+                warn_once("numexpr is not installed, evaluating the expressions with eval")
+
+    def __getstate__(self):
+        # code objects cannot be pickled
+        return {"expr": self.expr, "use_numexpr": self.use_numexpr}
+
+    def __setstate__(self, state):
+        self.__init__(state["expr"], state["use_numexpr"])
+
+    def _eval_numexpr(self, table):
+        arrays = {k: table[k] for k in self.names}
+        if all(isinstance(a, np.ndarray) or a.ndim == 1 for a in arrays.values()):
+            values = {k: np.asarray(a) for k, a in arrays.items()}
+            return ak.Array(self._numexpr.evaluate(self.expr, local_dict=values))
+        if all(isinstance(a, ak.Array) and a.ndim == 2 for a in arrays.values()):
+            counts = [ak.to_numpy(ak.num(a)) for a in arrays.values()]
+            if all(np.array_equal(counts[0], c) for c in counts[1:]):
+                values = {k: ak.to_numpy(ak.flatten(a)) for k, a in arrays.items()}
+                return ak.unflatten(self._numexpr.evaluate(self.expr, local_dict=values), counts[0])
+        return None
+
+    def __call__(self, table):
+        if self.ones_like is not None:
+            # same offsets as x, only the content of ones is allocated
+            return ak.ones_like(table[self.ones_like])
+        if self._numexpr is not None and len(self.names):
+            result = self._eval_numexpr(table)
+            if result is not None:
+                return result
+        env = dict(_expr_globals)
+        env.update({k: table[k] for k in self.names})
+        return eval(self.code, env)
+
+
+@lru_cache(maxsize=None)
+def _compile_expr(expr, use_numexpr=False):
+    return _Expr(expr, use_numexpr)
+
+
+def _expr_key(expr):
+    # what defines the result of a compiled expression, for the cache keys
+    return None if expr is None else expr.__getstate__()
+
+
+def _eval_expr(expr, table):
+    if isinstance(expr, str):
+        expr = _compile_expr(expr)
+    return expr(table)
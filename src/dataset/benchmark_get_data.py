@@ -0,0 +1,79 @@
+import glob
+import time
+import argparse
+import numpy as np
+
+import src.dataset.functions_graph_tracking as functions_graph_tracking
+import src.dataset.functions_graph_tracking_CLD as functions_graph_tracking_CLD
+from src.dataset.dataset import _load_data_config, _load_next, _event_inputs, _graph_from_inputs
+
+# bytes copied per event between the loaded table and the graph builders, and
+# events/s of the graph building, when every input group of the event is first
+# copied (copy of the padded rows, then torch.tensor of the hits, as before)
+# and with views of the table (only the hits copied, by _event_tensor), e.g.
+# python -m src.dataset.benchmark_get_data --data-config config_files/config_tracking_global_vector.yaml \
+#     --data "/path/to/reco_*.root" --events 500
+
+
+class _Counter(object):
+    def __init__(self, make_tensor):
+        self.make_tensor = make_tensor
+        self.nbytes = 0
+
+    def __call__(self, a):
+        t = self.make_tensor(a)
+        if not np.may_share_memory(t.numpy(), a):
+            self.nbytes += t.untyped_storage().nbytes()
+        return t
+
+
+def run(table, indices, data_config, copy_rows, make_tensor):
+    counter = _Counter(make_tensor)
+    functions_graph_tracking._event_tensor = counter
+    functions_graph_tracking_CLD._event_tensor = counter
+    row_bytes = 0
+    t0 = time.time()
+    for i in indices:
+        X = _event_inputs(table, i, data_config)
+        if copy_rows:
+            X = {k: v.copy() for k, v in X.items()}
+            row_bytes += sum(v.nbytes for v in X.values())
+        _graph_from_inputs(X, data_config)
+    dt = time.time() - t0
+    return (row_bytes + counter.nbytes) / len(indices), len(indices) / dt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-config", required=True)
+    parser.add_argument("--data", nargs="+", required=True, help="input files (glob patterns allowed)")
+    parser.add_argument("--events", type=int, default=500, help="number of events to build")
+    parser.add_argument("--load-range", type=float, default=1, help="fraction of each file to load")
+    args = parser.parse_args()
+
+    files = sorted(set(sum([glob.glob(f) for f in args.data], [])))
+    data_config, _ = _load_data_config(args.data_config, {"_": files}, for_training=False)
+    options = {"training": False, "shuffle": False, "reweight": False}
+    table, indices = _load_next(data_config, files, (0, args.load_range), options)
+    indices = indices[: args.events]
+
+    import torch
+
+    event_tensor = functions_graph_tracking._event_tensor
+    results = {
+        "copies": run(table, indices, data_config, True, torch.tensor),
+        "views": run(table, indices, data_config, False, event_tensor),
+    }
+    functions_graph_tracking._event_tensor = event_tensor
+    functions_graph_tracking_CLD._event_tensor = event_tensor
+    for name, (nbytes, rate) in results.items():
+        print("{:>7}: {:.3f} MB copied per event, {:.1f} events/s".format(name, nbytes / 1e6, rate))
+    print(
+        "{:.1f}x fewer bytes copied per event".format(
+            results["copies"][0] / max(results["views"][0], 1)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
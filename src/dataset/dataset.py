@@ -5,13 +5,22 @@ import numpy as np
 import awkward as ak
 import torch.utils.data
 import time
+import weakref
 
 from functools import partial
+from collections import OrderedDict
 from concurrent.futures.thread import ThreadPoolExecutor
 from src.logger.logger import _logger, warn_once
 from src.data.tools import _pad, _repeat_pad, _clip, _pad_vector
-from src.data.fileio import _read_files
+from src.data.fileio import _read_files, _load_range_of_entries
+from src.data.event_index import _balanced_file_shards
 from src.data.config import DataConfig, _md5
+from src.data.overlay import _apply_overlay
+from src.data.synthetic import _read_synthetic, _synthetic_options, _is_synthetic
+from src.dataset.graph_cache import GraphCache, _selection_key, _md5_of
+from src.dataset.shared_table import shared_table
+from src.dataset.pipeline import StagedPipeline
+from src.dataset.iter_state import _Records
 from src.data.preprocess import (
     _apply_selection,
     _build_new_variables,
@@ -28,7 +37,33 @@ from src.dataset.functions_graph_tracking import (
 from src.dataset.functions_graph_tracking_CLD import create_graph_tracking_CLD
 
 
+def _finalize_ragged_inputs(table, data_config):
+    # one (n_vars, n_values) buffer per input group, with the offsets of every
+    # event in it, so that memory scales with the actual number of hits
+    output = {}
+    for k, names in data_config.input_dicts.items():
+        arrays = [table[n] if table[n].ndim > 1 else ak.unflatten(table[n], 1) for n in names]
+        counts = ak.to_numpy(ak.num(arrays[0]))
+        for n, a in zip(names[1:], arrays[1:]):
+            if not np.array_equal(ak.to_numpy(ak.num(a)), counts):
+                raise ValueError(
+                    "Variables %s and %s of the ragged input %s have different lengths"
+                    % (names[0], n, k)
+                )
+        output["_" + k] = np.stack(
+            [ak.to_numpy(ak.flatten(a)).astype("float32") for a in arrays], axis=0
+        )
+        output["_" + k + "_offsets"] = np.concatenate([[0], np.cumsum(counts)])
+    # copy monitor variables
+    for k in data_config.z_variables:
+        if k not in output:
+            output[k] = ak.to_numpy(table[k])
+    return output
+
+
 def _finalize_inputs(table, data_config):
+    if data_config.ragged:
+        return _finalize_ragged_inputs(table, data_config)
     # transformation
     output = {}
     # transformation
@@ -77,15 +112,15 @@ def _preprocess(table, data_config, options):
     # apply selection
     table = _apply_selection(
         table,
-        data_config.selection
+        data_config.selection_expr
         if options["training"]
-        else data_config.test_time_selection,
+        else data_config.test_time_selection_expr,
     )
     if len(table) == 0:
         return []
     # table = _padlabel(table,data_config)
     # define new variables
-    table = _build_new_variables(table, data_config.var_funcs)
+    table = _build_new_variables(table, data_config.var_funcs_expr)
 
     # else:
     indices = np.arange(
@@ -94,19 +129,167 @@ def _preprocess(table, data_config, options):
     # shuffle
     if options["shuffle"]:
         np.random.shuffle(indices)
+    # source of each event, for the graph cache
+    sources = {k: ak.to_numpy(table[k]) for k in ("_file_index", "_entry") if k in table.fields}
     # perform input variable standardization, clipping, padding and stacking
     table = _finalize_inputs(table, data_config)
+    table.update(sources)
     return table, indices
 
 
-def _load_next(data_config, filelist, load_range, options):
-    table = _read_files(
-        filelist, data_config.load_branches, load_range, treename=data_config.treename
-    )
+def _read_next(data_config, filelist, load_range, options, graph_cache=None, read_threads=1):
+    # read stage: the table of the fetch, and whether it is the list of the
+    # cached events of the fetch, which needs no reading nor preprocessing
+    if graph_cache is not None:
+        selection = _selection_key(data_config, options)
+        # all the graphs of this load range are cached: nothing to read
+        table = graph_cache.load(filelist, load_range, selection, treename=data_config.treename)
+        if table is not None:
+            return table, True
+    if options.get("synthetic") is not None:
+        # virtual files of synthetic events, see src/data/synthetic.py
+        table = _read_synthetic(filelist, data_config.load_branches, load_range, options["synthetic"])
+    else:
+        table = _read_files(
+            filelist,
+            data_config.load_branches,
+            load_range,
+            treename=data_config.treename,
+            with_entries=graph_cache is not None,
+            num_threads=read_threads,
+        )
+    if data_config.overlay:
+        table = _apply_overlay(table, data_config)
+    return table, False
+
+
+def _preprocess_next(data_config, filelist, table, cached, options, graph_cache=None):
+    if cached:
+        indices = np.arange(len(table["_entry"]))
+        if options["shuffle"]:
+            np.random.shuffle(indices)
+        table["_files"] = filelist
+        return table, indices
+    if graph_cache is not None:
+        selection = _selection_key(data_config, options)
+        read = (ak.to_numpy(table["_file_index"]), ak.to_numpy(table["_entry"]))
     table, indices = _preprocess(table, data_config, options)
+    if graph_cache is not None:
+        graph_cache.add_loaded(
+            filelist, *read, table["_file_index"], table["_entry"], selection
+        )
+        table["_files"] = filelist
     return table, indices
 
 
+def _load_next(data_config, filelist, load_range, options, graph_cache=None, read_threads=1):
+    table, cached = _read_next(data_config, filelist, load_range, options, graph_cache, read_threads)
+    return _preprocess_next(data_config, filelist, table, cached, options, graph_cache)
+
+
+def _event_inputs(table, i, data_config):
+    # views of the inputs of event i in the buffers of the table; the graph
+    # builders copy the values they use once (_event_tensor)
+    if data_config.ragged:
+        X = {}
+        for k in data_config.input_names:
+            offsets = table["_" + k + "_offsets"]
+            X[k] = table["_" + k][:, offsets[i] : offsets[i + 1]]
+    else:
+        X = {k: table["_" + k][i] for k in data_config.input_names}
+    return X
+
+
+def _build_graph(table, i, data_config):
+    return _graph_from_inputs(_event_inputs(table, i, data_config), data_config)
+
+
+def _graph_from_inputs(X, data_config):
+    get_vtx = data_config.graph_config.get("VTX", False)
+    vector = data_config.graph_config.get("vector", False)
+    CLD = data_config.graph_config.get("tracking_CLD", False)
+    predict = data_config.graph_config.get("predict", False)
+    tau = data_config.graph_config.get("tau", False)
+    overlay = data_config.graph_config.get("overlay", False)
+    if CLD:
+        [g, features_partnn], graph_empty = create_graph_tracking_CLD(X, predict, tau, overlay)
+    else:
+        [g, features_partnn], graph_empty = create_graph_tracking_global(
+            X, get_vtx, vector, tau, overlay
+        )
+    return [g, features_partnn], graph_empty
+
+
+def _load_data_config(data_config_file, file_dict, for_training, extra_selection=None):
+    # discover auto-generated reweight file
+    if ".auto.yaml" in data_config_file:
+        data_config_autogen_file = data_config_file
+    else:
+        data_config_md5 = _md5(data_config_file)
+        data_config_autogen_file = data_config_file.replace(
+            ".yaml", ".%s.auto.yaml" % data_config_md5
+        )
+        if os.path.exists(data_config_autogen_file):
+            data_config_file = data_config_autogen_file
+            _logger.info(
+                "Found file %s w/ auto-generated preprocessing information, will use that instead!"
+                % data_config_file
+            )
+
+    # load data config (w/ observers now -- so they will be included in the auto-generated yaml)
+    data_config = DataConfig.load(data_config_file)
+
+    if for_training:
+        # produce variable standardization info if needed
+        if data_config._missing_standardization_info:
+            s = AutoStandardizer(file_dict, data_config)
+            data_config = s.produce(data_config_autogen_file)
+
+        # produce reweight info if needed
+        # if self._sampler_options['reweight'] and data_config.weight_name and not data_config.use_precomputed_weights:
+        #    if remake_weights or data_config.reweight_hists is None:
+        #        w = WeightMaker(file_dict, data_config)
+        #        data_config = w.produce(data_config_autogen_file)
+
+        # reload data_config w/o observers for training
+        if (
+            os.path.exists(data_config_autogen_file)
+            and data_config_file != data_config_autogen_file
+        ):
+            data_config_file = data_config_autogen_file
+            _logger.info(
+                "Found file %s w/ auto-generated preprocessing information, will use that instead!"
+                % data_config_file
+            )
+        data_config = DataConfig.load(
+            data_config_file, load_observers=False, extra_selection=extra_selection
+        )
+    else:
+        data_config = DataConfig.load(
+            data_config_file,
+            load_reweight_info=False,
+            extra_test_selection=extra_selection,
+        )
+    return data_config, data_config_file
+
+
+def _pipeline_fetches(it):
+    # source of the pipeline of the _SimpleIter it (a weak proxy), run in its read thread
+    n_fetches = 0
+    while True:
+        if it._end_of_list():
+            if not it._infinity_mode:
+                return
+            it._log_pipeline()
+            it._reset()
+            if it._end_of_list():
+                return
+        if n_fetches > 0 and n_fetches % 10 == 0:
+            it._log_pipeline()
+        n_fetches += 1
+        yield it._next_fetch()
+
+
 class _SimpleIter(object):
     r"""_SimpleIter
     Iterator object for ``SimpleIterDataset''.
@@ -126,8 +309,20 @@ class _SimpleIter(object):
         # executor to read files and run preprocessing asynchronously
         self.executor = ThreadPoolExecutor(max_workers=1) if self._async_load else None
 
+        # graphs cached on disk, see src/dataset/graph_cache.py
+        self.graph_cache = None
+        if self._graph_cache_dir is not None:
+            self.graph_cache = GraphCache(
+                self._graph_cache_dir,
+                self._data_config_md5,
+                self._data_config.graph_config,
+                max_bytes=self._graph_cache_max_bytes,
+            )
+
         # init: prefetch holds table and indices for the next fetch
         self.prefetch = None
+        # staged read -> preprocess -> build pipeline replacing prefetch, see src/dataset/pipeline.py
+        self.pipeline = None
         self.table = None
         self.indices = []
         self.cursor = 0
@@ -140,25 +335,61 @@ class _SimpleIter(object):
             self._name += "_worker%d" % worker_info.id
             self._seed = worker_info.seed & 0xFFFFFFFF
             np.random.seed(self._seed)
-            # split workload by files
-            new_file_dict = {}
-            for name, files in file_dict.items():
-                new_files = files[worker_info.id :: worker_info.num_workers]
-                assert len(new_files) > 0
-                new_file_dict[name] = new_files
-            file_dict = new_file_dict
+            # split workload by files, balancing the number of hits if they are known
+            # (the shared table holds all the files, and is split by events)
+            if self._shared_memory is None:
+                new_file_dict = {}
+                for name, files in file_dict.items():
+                    if self._file_hits is not None:
+                        new_files = _balanced_file_shards(
+                            files,
+                            [self._file_hits.get(f, 0) for f in files],
+                            worker_info.num_workers,
+                        )[worker_info.id]
+                    else:
+                        new_files = files[worker_info.id :: worker_info.num_workers]
+                    assert len(new_files) > 0
+                    new_file_dict[name] = new_files
+                file_dict = new_file_dict
         self.worker_file_dict = file_dict
         self.worker_filelist = sum(file_dict.values(), [])
         self.worker_info = worker_info
 
-        self.restart()
+        # position of the iterator, see src/dataset/iter_state.py
+        self.records = None
+        if self._iter_state_dir is not None:
+            self.records = _Records(self._iter_state_dir, self._name)
+        # files and load range of the current table
+        self.fetch = None
+        self._prefetch_fetch = None
+        state = None
+        if self._resume_state is not None:
+            state = self._resume_state.get(self._name)
+            if state is None:
+                _logger.warning("No saved position for DataIter %s, starting from the beginning" % self._name)
+        if state is not None:
+            self._restore(state)
+        else:
+            self.restart()
 
     def restart(self):
+        self._reset()
+        if self._pipeline_config is not None:
+            self._start_pipeline()
+        else:
+            # prefetch the first entry asynchronously
+            self._try_get_next(init=True)
+
+    def _reset(self):
         print("=== Restarting DataIter %s, seed=%s ===" % (self._name, self._seed))
-        # re-shuffle filelist and load range if for training
+        # re-shuffle filelist and load range if for training, but not those of
+        # the shared table, which must be the same for all the workers
+        shuffle = self._sampler_options["shuffle"] and self._shared_memory is None
         filelist = self.worker_filelist.copy()
-        if self._sampler_options["shuffle"]:
+        if shuffle:
             np.random.shuffle(filelist)
+        elif self._shared_memory is not None:
+            filelist = sorted(filelist)
         if self._file_fraction < 1:
             num_files = int(len(filelist) * self._file_fraction)
             filelist = filelist[:num_files]
@@ -169,7 +400,7 @@ class _SimpleIter(object):
         else:
             (start_pos, end_pos), load_frac = self._init_load_range_and_fraction
             interval = (end_pos - start_pos) * load_frac
-            if self._sampler_options["shuffle"]:
+            if shuffle:
                 offset = np.random.uniform(start_pos, end_pos - interval)
                 self.load_range = (offset, offset + interval)
             else:
@@ -197,14 +428,14 @@ class _SimpleIter(object):
 
         # reset file fetching cursor
         self.ipos = 0 if self._fetch_by_files else self.load_range[0]
-        # prefetch the first entry asynchronously
-        self._try_get_next(init=True)
 
     def __next__(self):
         graph_empty = True
         self.iter_count += 1
         if self.dataset_cap is not None and self.iter_count > self.dataset_cap:
             raise StopIteration
+        if self.pipeline is not None:
+            return self._next_from_pipeline()
         while graph_empty:
             if len(self.filelist) == 0:
                 raise StopIteration
@@ -218,7 +449,10 @@ class _SimpleIter(object):
                         # only need to re-shuffle the indices, if this is not the first entry
                         if self._sampler_options["shuffle"]:
                             np.random.shuffle(self.indices)
+                        self._record_table(self.fetch)
                         break
+                    if self.graph_cache is not None:
+                        self.graph_cache.flush()
                     if self.prefetch is None:
                         # reaching the end as prefetch got nothing
                         self.table = None
@@ -230,6 +464,9 @@ class _SimpleIter(object):
                         self.table, self.indices = self.prefetch.result()
                     else:
                         self.table, self.indices = self.prefetch
+                    if len(self.indices) > 0:
+                        # recorded with the random state before the next fetch
+                        self._record_table(self._prefetch_fetch)
                     # try to load the next ones asynchronously
                     self._try_get_next()
                     # check if any entries are fetched (i.e., passing selection) -- if not, do another fetch
@@ -240,15 +477,82 @@ class _SimpleIter(object):
                 i = self.indices[self.cursor]
             self.cursor += 1
             data, graph_empty = self.get_data(i)
+            if self.records is not None:
+                self.records.event(self.cursor - 1, graph_empty)
         return data
 
-    def _try_get_next(self, init=False):
-        end_of_list = (
+    def _fetch_info(self, fetch):
+        # what the records need to load the table of a fetch again
+        return dict(
+            fetch=None if fetch is None else [fetch[0], list(fetch[1])],
+            filelist=self.filelist,
+            load_range=list(self.load_range),
+            ipos=self.ipos,
+        )
+
+    def _record_table(self, fetch, cursor=0):
+        self.fetch = fetch
+        if self.records is not None:
+            self.records.new_table(fetch, self.indices, cursor)
+
+    def _new_epoch(self):
+        # the dataset iterated again over the same (infinity mode or in memory) iterator
+        if self.records is not None:
+            self.records.new_epoch()
+
+    def _restore(self, state):
+        # resume at the table and the next event saved by IterStateCheckpoint
+        self._reset()
+        self.filelist = state["filelist"]
+        self.load_range = tuple(state["load_range"])
+        self.ipos = state["ipos"]
+        if state["fetch"] is None:
+            table, _ = self._load_shared()
+        else:
+            table, _ = _load_next(
+                self._data_config,
+                state["fetch"][0],
+                tuple(state["fetch"][1]),
+                self._sampler_options,
+                self.graph_cache,
+                self._read_threads,
+            )
+        self.table = table
+        self.indices = state["indices"]
+        self.cursor = state["cursor"]
+        np.random.set_state(state["rng"])
+        self._record_table(
+            {k: state[k] for k in ("fetch", "filelist", "load_range", "ipos")}, self.cursor
+        )
+        _logger.info(
+            "Resumed DataIter %s at event %d/%d of the table of %s, load_range=%s"
+            % (self._name, self.cursor, len(self.indices), state["fetch"], str(self.load_range))
+        )
+        self._try_get_next()
+
+    def _end_of_list(self):
+        return (
             self.ipos >= len(self.filelist)
             if self._fetch_by_files
             else self.ipos >= self.load_range[1]
         )
-        if end_of_list:
+
+    def _next_fetch(self):
+        # files and load range of the next fetch, advancing the cursor
+        if self._fetch_by_files:
+            filelist = self.filelist[int(self.ipos) : int(self.ipos + self._fetch_step)]
+            load_range = self.load_range
+        else:
+            filelist = self.filelist
+            load_range = (
+                self.ipos,
+                min(self.ipos + self._fetch_step, self.load_range[1]),
+            )
+        self.ipos += self._fetch_step
+        return filelist, load_range
+
+    def _try_get_next(self, init=False):
+        if self._end_of_list():
             if init:
                 raise RuntimeError(
                     "Nothing to load for worker %d" % 0
@@ -263,15 +567,17 @@ class _SimpleIter(object):
                 # finite mode: set prefetch to None, exit
                 self.prefetch = None
                 return
-        if self._fetch_by_files:
-            filelist = self.filelist[int(self.ipos) : int(self.ipos + self._fetch_step)]
-            load_range = self.load_range
-        else:
-            filelist = self.filelist
-            load_range = (
-                self.ipos,
-                min(self.ipos + self._fetch_step, self.load_range[1]),
-            )
+        if self._shared_memory is not None:
+            # the whole load range at once
+            self.ipos = len(self.filelist) if self._fetch_by_files else self.load_range[1]
+            self._prefetch_fetch = self._fetch_info(None)
+            if self._async_load:
+                self.prefetch = self.executor.submit(self._load_shared)
+            else:
+                self.prefetch = self._load_shared()
+            return
+        filelist, load_range = self._next_fetch()
+        self._prefetch_fetch = self._fetch_info((filelist, load_range))
         # _logger.info('Start fetching next batch, len(filelist)=%d, load_range=%s'%(len(filelist), load_range))
         if self._async_load:
             self.prefetch = self.executor.submit(
@@ -280,28 +586,136 @@ class _SimpleIter(object):
                 filelist,
                 load_range,
                 self._sampler_options,
+                self.graph_cache,
+                self._read_threads,
             )
         else:
             self.prefetch = _load_next(
-                self._data_config, filelist, load_range, self._sampler_options
+                self._data_config,
+                filelist,
+                load_range,
+                self._sampler_options,
+                self.graph_cache,
+                self._read_threads,
             )
-        self.ipos += self._fetch_step
 
-    def get_data(self, i):
-        # inputs
-        X = {k: self.table["_" + k][i].copy() for k in self._data_config.input_names}
-        get_vtx = self._data_config.graph_config.get("VTX", False)
-        vector = self._data_config.graph_config.get("vector", False)
-        CLD = self._data_config.graph_config.get("tracking_CLD", False)
-        predict = self._data_config.graph_config.get("predict", False)
-        tau = self._data_config.graph_config.get("tau", False)
-        overlay = self._data_config.graph_config.get("overlay", False)
-        if CLD:
-            [g, features_partnn], graph_empty = create_graph_tracking_CLD(X, predict, tau, overlay)
-        else:
-            [g, features_partnn], graph_empty = create_graph_tracking_global(
-                X, get_vtx, vector, tau, overlay
+    def _load_shared(self):
+        # table of the files over the load range, shared by all the workers and
+        # processes of the node, each of them iterating over its own share of the
+        # events
+        key = _md5_of(
+            [
+                self._data_config_md5,
+                [(f, os.stat(f).st_size, os.stat(f).st_mtime) for f in self.filelist],
+                list(self.load_range),
+                _selection_key(self._data_config, self._sampler_options),
+                self.graph_cache is not None,
+            ]
+        )
+
+        def build():
+            table, indices = _load_next(
+                self._data_config,
+                self.filelist,
+                self.load_range,
+                self._sampler_options,
+                self.graph_cache,
+                self._read_threads,
             )
+            table["_n_events"] = len(indices)
+            return table
+
+        table = shared_table(self._shared_memory, key, build)
+        num_workers, worker_id = (
+            (1, 0) if self.worker_info is None else (self.worker_info.num_workers, self.worker_info.id)
+        )
+        num_replicas, rank = (1, 0) if self._rank is None else (self._num_replicas, self._rank)
+        indices = np.arange(table["_n_events"])[rank * num_workers + worker_id :: num_replicas * num_workers]
+        if self._sampler_options["shuffle"]:
+            np.random.shuffle(indices)
+        return table, indices
+
+    def _start_pipeline(self):
+        if self._end_of_list():
+            raise RuntimeError(
+                "Nothing to load for worker %d" % 0
+                if self.worker_info is None
+                else self.worker_info.id
+            )
+        if self.pipeline is not None:
+            self._close_pipeline()
+        config = self._pipeline_config
+        # the threads of the pipeline only hold a weak reference to the iterator,
+        # whose pipeline is closed when it is garbage collected, e.g. a validation
+        # iterator abandoned after limit_val_batches
+        it = weakref.proxy(self)
+        self.pipeline = StagedPipeline(
+            _pipeline_fetches(it),
+            [
+                dict(
+                    name="read",
+                    fn=lambda fetch: (fetch[0],)
+                    + _read_next(
+                        it._data_config,
+                        *fetch,
+                        it._sampler_options,
+                        it.graph_cache,
+                        it._read_threads,
+                    ),
+                    **config["read"],
+                ),
+                dict(
+                    name="preprocess",
+                    fn=lambda read: _preprocess_next(
+                        it._data_config, *read, it._sampler_options, it.graph_cache
+                    ),
+                    **config["preprocess"],
+                ),
+                dict(
+                    name="build",
+                    fn=lambda event: it._get_data(*event),
+                    expand=lambda loaded: [(loaded[0], i) for i in loaded[1]],
+                    **config["build"],
+                ),
+            ],
+        )
+        self._close_pipeline = weakref.finalize(self, self.pipeline.close)
+
+    def _next_from_pipeline(self):
+        while True:
+            try:
+                data, graph_empty = self.pipeline.get()
+            except StopIteration:
+                self._log_pipeline()
+                if self.graph_cache is not None:
+                    self.graph_cache.flush()
+                self._close_pipeline()
+                raise
+            if not graph_empty:
+                return data
+
+    def _log_pipeline(self):
+        # queue occupancy of every stage, the bottleneck being the first stage
+        # whose output queue is mostly empty
+        if self.pipeline is not None:
+            _logger.info("Pipeline of DataIter %s: %s" % (self._name, self.pipeline.summary()))
+
+    def pipeline_stats(self):
+        return None if self.pipeline is None else self.pipeline.stats()
+
+    def get_data(self, i):
+        return self._get_data(self.table, i)
+
+    def _get_data(self, table, i):
+        if self.graph_cache is not None:
+            source = table["_files"][table["_file_index"][i]]
+            entry = int(table["_entry"][i])
+            cached = self.graph_cache.get(source, entry)
+            if cached is not None:
+                return cached
+        [g, features_partnn], graph_empty = _build_graph(table, i, self._data_config)
+        if self.graph_cache is not None:
+            self.graph_cache.put(source, entry, ([g, features_partnn], graph_empty))
         return [g, features_partnn], graph_empty
 
 
@@ -325,6 +739,32 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
             So set this to a large enough value to avoid getting an imbalanced minibatch (due to reweighting/sampling), especially when ``fetch_by_files`` set to ``True``.
             Will load all events (files) at once if set to non-positive value.
         file_fraction (float): fraction of files to load.
+        synthetic (bool): generate the events of the virtual files of the file lists (``synthetic_files``) instead
+            of reading files, with the parameters of the ``synthetic`` section of the data config, see
+            ``src/data/synthetic.py``; ``synthetic_npart_min`` and ``synthetic_npart_max`` give the range of
+            the number of particles of every event.
+        graph_cache (str): directory where the graphs are cached after they are built the first time, keyed by
+            the data config, the graph_config flags and the input files. Later passes over the same events only
+            read the graphs back from it. Not used with the background overlay, which is sampled at every load.
+        graph_cache_max_bytes (float): maximum size of the graph cache, the least recently used files being
+            removed to make room for new ones (unbounded if None).
+        read_threads (int): number of files read (and root baskets decompressed) concurrently by each
+            DataLoader worker at every fetch.
+        event_index (EventIndex): index of the events of the files, used to give the DataLoader workers
+            files with the same total number of hits instead of the same number of files.
+        shared_memory (str): with ``in_memory``, directory (``""``: ``/dev/shm``) where the preprocessed table of
+            all the files is written once per node and memory-mapped by every DataLoader worker of every process,
+            each of them iterating over its share of the events (the files are not split between workers).
+        rank (int), num_replicas (int): process of the node and number of processes sharing the events of the
+            shared table; all the processes iterate over all the events if ``rank`` is None.
+        pipeline (dict): workers and queue depth of the ``read``, ``preprocess`` and ``build`` (graph) stages
+            of each DataLoader worker (``src.dataset.pipeline._parse_pipeline``), replacing the single prefetch.
+            The occupancy of the queues is logged, see ``StagedPipeline``. Not used with ``in_memory``.
+        iter_state_dir (str): directory where every DataLoader worker records the tables it iterates over, from
+            which ``IterStateCheckpoint`` saves the position of the workers with the checkpoints.
+        resume_state (dict): position of the workers saved with a checkpoint (``load_iter_state``), the first
+            epoch resuming at the next unread event instead of at the start of the files.
+            Neither is used with ``pipeline``, see ``src/dataset/iter_state.py``.
     """
 
     def __init__(
@@ -353,6 +793,16 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
         synthetic=False,
         synthetic_npart_min=2,
         synthetic_npart_max=5,
+        graph_cache=None,
+        graph_cache_max_bytes=None,
+        read_threads=1,
+        event_index=None,
+        shared_memory=None,
+        rank=None,
+        num_replicas=1,
+        pipeline=None,
+        iter_state_dir=None,
+        resume_state=None,
     ):
         self._iters = {} if infinity_mode or in_memory else None
         _init_args = set(self.__dict__.keys())
@@ -373,6 +823,24 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
         self.synthetic_npart_max = synthetic_npart_max
         self.dataset_cap = dataset_cap  # used to cap the dataset to some fixed number of events - used for debugging purposes
         self.n_noise = n_noise
+        self._graph_cache_dir = graph_cache
+        self._graph_cache_max_bytes = graph_cache_max_bytes
+        self._read_threads = read_threads
+        self._shared_memory = shared_memory if in_memory else None
+        self._rank = rank
+        self._num_replicas = num_replicas
+        self._pipeline_config = pipeline
+        if pipeline is not None and in_memory:
+            _logger.warning("The staged pipeline is not used with in_memory datasets")
+            self._pipeline_config = None
+        self._iter_state_dir = iter_state_dir
+        self._resume_state = resume_state
+        if self._pipeline_config is not None and (iter_state_dir is not None or resume_state is not None):
+            _logger.warning("The position of the iterators is not saved nor restored with the staged pipeline")
+            self._iter_state_dir = self._resume_state = None
+        self._file_hits = None
+        if event_index is not None:
+            self._file_hits = dict(zip(event_index.files, event_index.hits_per_file()))
         # ==== sampling parameters ====
         self._sampler_options = {
             "up_sample": up_sample,
@@ -385,55 +853,26 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
         else:
             self._sampler_options.update(training=False, shuffle=False, reweight=False)
 
-        # discover auto-generated reweight file
-        if ".auto.yaml" in data_config_file:
-            data_config_autogen_file = data_config_file
-        else:
-            data_config_md5 = _md5(data_config_file)
-            data_config_autogen_file = data_config_file.replace(
-                ".yaml", ".%s.auto.yaml" % data_config_md5
-            )
-            if os.path.exists(data_config_autogen_file):
-                data_config_file = data_config_autogen_file
-                _logger.info(
-                    "Found file %s w/ auto-generated preprocessing information, will use that instead!"
-                    % data_config_file
-                )
-
-        # load data config (w/ observers now -- so they will be included in the auto-generated yaml)
-        self._data_config = DataConfig.load(data_config_file)
-
-        if for_training:
-            # produce variable standardization info if needed
-            if self._data_config._missing_standardization_info:
-                s = AutoStandardizer(file_dict, self._data_config)
-                self._data_config = s.produce(data_config_autogen_file)
-
-            # produce reweight info if needed
-            # if self._sampler_options['reweight'] and self._data_config.weight_name and not self._data_config.use_precomputed_weights:
-            #    if remake_weights or self._data_config.reweight_hists is None:
-            #        w = WeightMaker(file_dict, self._data_config)
-            #        self._data_config = w.produce(data_config_autogen_file)
-
-            # reload data_config w/o observers for training
-            if (
-                os.path.exists(data_config_autogen_file)
-                and data_config_file != data_config_autogen_file
-            ):
-                data_config_file = data_config_autogen_file
-                _logger.info(
-                    "Found file %s w/ auto-generated preprocessing information, will use that instead!"
-                    % data_config_file
+        self._data_config, data_config_file = _load_data_config(
+            data_config_file, file_dict, for_training, extra_selection
+        )
+        self._data_config_md5 = _md5(data_config_file)
+        if self._graph_cache_dir is not None and self._data_config.overlay:
+            _logger.warning("The graph cache is not used with the background overlay")
+            self._graph_cache_dir = None
+        self._sampler_options["synthetic"] = None
+        if synthetic:
+            files = [f for f in sum(file_dict.values(), []) if not _is_synthetic(f)]
+            if files:
+                raise RuntimeError(
+                    "Synthetic events are generated for the virtual files of synthetic_files, got %s" % files[:3]
                 )
-            self._data_config = DataConfig.load(
-                data_config_file, load_observers=False, extra_selection=extra_selection
-            )
-        else:
-            self._data_config = DataConfig.load(
-                data_config_file,
-                load_reweight_info=False,
-                extra_test_selection=extra_selection,
+            self._sampler_options["synthetic"] = _synthetic_options(
+                self._data_config.synthetic, synthetic_npart_min, synthetic_npart_max
             )
+            if self._graph_cache_dir is not None or self._shared_memory is not None:
+                _logger.warning("The graph cache and the shared memory are not used with synthetic events")
+                self._graph_cache_dir = self._shared_memory = None
 
         # derive all variables added to self.__dict__
         self._init_args = set(self.__dict__.keys()) - _init_args
@@ -450,8 +889,142 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
             worker_info = torch.utils.data.get_worker_info()
             worker_id = worker_info.id if worker_info is not None else 0
             try:
-                return self._iters[worker_id]
+                it = self._iters[worker_id]
+                it._new_epoch()
+                return it
             except KeyError:
                 kwargs = {k: copy.deepcopy(self.__dict__[k]) for k in self._init_args}
                 self._iters[worker_id] = _SimpleIter(**kwargs)
                 return self._iters[worker_id]
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    r"""Map-style dataset over the events of an ``EventIndex``.
+    Item ``i`` is the graph of the i-th event of the index within ``load_range_and_fraction``, or None if it
+    does not pass the selection or its graph is empty (None items are dropped by ``graph_batch_func``).
+    Events are read by chunks of ``chunk_size`` entries of a file, each DataLoader worker keeping the last
+    ``max_chunks`` chunks in memory, so that samplers should keep neighbouring entries close in time.
+    Arguments:
+        event_index (EventIndex): index of the events of the files.
+        data_config_file (str): YAML file containing data format information.
+        for_training (bool): flag indicating whether the dataset is used for training or testing.
+        load_range_and_fraction (tuple of tuples, ``((start_pos, end_pos), load_frac)``): fractional range of
+            events of each file, and fraction of them used (the same events on every rank).
+        graph_cache (str), graph_cache_max_bytes (float): directory and size of the graph cache, see
+            ``SimpleIterDataset``.
+    """
+
+    def __init__(
+        self,
+        event_index,
+        data_config_file,
+        for_training=True,
+        load_range_and_fraction=None,
+        extra_selection=None,
+        chunk_size=256,
+        max_chunks=4,
+        graph_cache=None,
+        graph_cache_max_bytes=None,
+        name="",
+    ):
+        self.event_index = event_index
+        self._name = name
+        self._chunk_size = chunk_size
+        self._max_chunks = max_chunks
+        file_dict = {"_": event_index.files}
+        self._data_config, data_config_file = _load_data_config(
+            data_config_file, file_dict, for_training, extra_selection
+        )
+        self._options = {"training": for_training, "shuffle": False}
+        if load_range_and_fraction is None:
+            events = np.arange(len(event_index))
+        else:
+            load_range, load_frac = load_range_and_fraction
+            events = event_index.select(load_range)
+            if load_frac < 1:
+                rng = np.random.RandomState(0)
+                events = np.sort(
+                    rng.choice(events, int(len(events) * load_frac), replace=False)
+                )
+        self.events = events
+        self._graph_cache_dir = graph_cache
+        self._graph_cache_max_bytes = graph_cache_max_bytes
+        if graph_cache is not None and self._data_config.overlay:
+            _logger.warning("The graph cache is not used with the background overlay")
+            self._graph_cache_dir = None
+        self._data_config_md5 = _md5(data_config_file)
+        self._graph_cache = None
+        self._chunks = OrderedDict()
+        self._file_entries = np.bincount(
+            event_index.file_index, minlength=len(event_index.files)
+        )
+
+    @property
+    def config(self):
+        return self._data_config
+
+    @property
+    def n_hits(self):
+        return self.event_index.n_hits[self.events]
+
+    @property
+    def chunk_ids(self):
+        chunk = self.event_index.entry[self.events] // self._chunk_size
+        return self.event_index.file_index[self.events] * (chunk.max(initial=0) + 1) + chunk
+
+    def __len__(self):
+        return len(self.events)
+
+    def _load_chunk(self, file_index, chunk_start):
+        key = (file_index, chunk_start)
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+        num_entries = int(self._file_entries[file_index])
+        chunk_stop = min(chunk_start + self._chunk_size, num_entries)
+        table = _read_files(
+            [self.event_index.files[file_index]],
+            self._data_config.load_branches,
+            _load_range_of_entries(chunk_start, chunk_stop, num_entries),
+            treename=self._data_config.treename,
+            with_entries=True,
+        )
+        if self._data_config.overlay:
+            table = _apply_overlay(table, self._data_config)
+        result = _preprocess(table, self._data_config, self._options)
+        if len(result) == 0:
+            table, rows = None, {}
+        else:
+            table = result[0]
+            rows = {int(e): i for i, e in enumerate(table["_entry"])}
+        self._chunks[key] = (table, rows)
+        if len(self._chunks) > self._max_chunks:
+            self._chunks.popitem(last=False)
+        return self._chunks[key]
+
+    def __getitem__(self, i):
+        k = self.events[i]
+        file_index = int(self.event_index.file_index[k])
+        entry = int(self.event_index.entry[k])
+        source = self.event_index.files[file_index]
+        if self._graph_cache_dir is not None:
+            if self._graph_cache is None:
+                # one per DataLoader worker
+                self._graph_cache = GraphCache(
+                    self._graph_cache_dir,
+                    self._data_config_md5,
+                    self._data_config.graph_config,
+                    max_bytes=self._graph_cache_max_bytes,
+                )
+            cached = self._graph_cache.get(source, entry)
+            if cached is not None:
+                return None if cached[1] else cached[0]
+        table, rows = self._load_chunk(
+            file_index, entry // self._chunk_size * self._chunk_size
+        )
+        if entry not in rows:
+            return None
+        [g, features_partnn], graph_empty = _build_graph(table, rows[entry], self._data_config)
+        if self._graph_cache is not None:
+            self._graph_cache.put(source, entry, ([g, features_partnn], graph_empty))
+        return None if graph_empty else [g, features_partnn]
@@ -6,6 +6,13 @@ from sklearn.preprocessing import StandardScaler
 import time
 
 
+def _event_tensor(a):
+    # contiguous copy of the values of an event, from a view of the loaded
+    # table: the only copy of the inputs before the graph is built, and a
+    # private one, as some of the tensors are modified in place
+    return torch.from_numpy(np.array(a, order="C"))
+
+
 # TODO remove the particles with little hits or mark them as noise
 def get_number_hits(part_idx):
     number_of_hits = scatter_sum(torch.ones_like(part_idx), part_idx.long(), dim=0)
@@ -57,21 +64,25 @@ def fix_splitted_tracks(hit_particle_link, y):
 
 def create_inputs_from_table(output, get_vtx, cld=False, tau=False):
     graph_empty = False
-    number_hits = np.int32(np.sum(output["pf_mask"][0]))
-
-    number_part = np.int32(np.sum(output["pf_mask"][1]))
+    if "pf_mask" in output:
+        number_hits = np.int32(np.sum(output["pf_mask"][0]))
+        number_part = np.int32(np.sum(output["pf_mask"][1]))
+    else:
+        # ragged inputs, not padded
+        number_hits = output["pf_features"].shape[1]
+        number_part = output["pf_vectors"].shape[1]
     #! idx of particle does not start at
     if tau:
-        hit_particle_link = torch.tensor(output["pf_vectoronly"][0, 0:number_hits])
-        hit_particle_link_tau = torch.tensor(output["pf_vectoronly"][1, 0:number_hits])
+        hit_particle_link = _event_tensor(output["pf_vectoronly"][0, 0:number_hits])
+        hit_particle_link_tau = _event_tensor(output["pf_vectoronly"][1, 0:number_hits])
     else:
-        hit_particle_link = torch.tensor(output["pf_vectoronly"][0, 0:number_hits])
+        hit_particle_link = _event_tensor(output["pf_vectoronly"][0, 0:number_hits])
         hit_particle_link_tau = None
     # print(output["pf_vectoronly"].shape[1], hit_particle_link.shape[0])
     # if output["pf_vectoronly"].shape[1] > hit_particle_link.shape[0]:
     # print("hit_particle_link", torch.unique(hit_particle_link))
     features_hits = torch.permute(
-        torch.tensor(output["pf_features"][:, 0:number_hits]), (1, 0)
+        _event_tensor(output["pf_features"][:, 0:number_hits]), (1, 0)
     )
     
     hit_type = features_hits[:, 9].clone()
@@ -91,7 +102,7 @@ def create_inputs_from_table(output, get_vtx, cld=False, tau=False):
     # print("unique_list_particles", unique_list_particles)
     unique_list_particles = torch.Tensor(unique_list_particles).to(torch.int64)
     features_particles = torch.permute(
-        torch.tensor(output["pf_vectors"][:, 0:number_part]),
+        _event_tensor(output["pf_vectors"][:, 0:number_part]),
         (1, 0),
     )
 
@@ -117,7 +128,7 @@ def create_inputs_from_table(output, get_vtx, cld=False, tau=False):
         unique_list_particles = torch.Tensor(unique_list_particles).to(torch.int64)
 
         features_particles = torch.permute(
-            torch.tensor(output["pf_vectors"][:, 0:number_part]),
+            _event_tensor(output["pf_vectors"][:, 0:number_part]),
             (1, 0),
         )
 
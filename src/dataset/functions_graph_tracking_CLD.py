@@ -3,6 +3,7 @@ import torch
 import dgl
 from torch_scatter import scatter_add, scatter_sum, scatter_min, scatter_max
 from sklearn.preprocessing import StandardScaler
+from src.dataset.functions_graph_tracking import _event_tensor
 
 
 # TODO remove the particles with little hits or mark them as noise
@@ -53,24 +54,28 @@ def scatter_count(input: torch.Tensor):
 
 
 def create_inputs_from_table(output, predict=False, tau=False, overlay=False):
-    number_hits = np.int32(np.sum(output["pf_mask"][0]))
-    # print("number_hits", number_hits)
-    number_part = np.int32(np.sum(output["pf_mask"][1]))
+    if "pf_mask" in output:
+        number_hits = np.int32(np.sum(output["pf_mask"][0]))
+        number_part = np.int32(np.sum(output["pf_mask"][1]))
+    else:
+        # ragged inputs, not padded
+        number_hits = output["pf_features"].shape[1]
+        number_part = output["pf_vectors"].shape[1]
     #! idx of particle does not start at 1
-    hit_particle_link = torch.tensor(output["pf_vectoronly"][0, 0:number_hits])
+    hit_particle_link = _event_tensor(output["pf_vectoronly"][0, 0:number_hits])
     if tau:
-        hit_particle_link_tau = torch.tensor(output["pf_vectoronly"][1, 0:number_hits])
+        hit_particle_link_tau = _event_tensor(output["pf_vectoronly"][1, 0:number_hits])
         unique_tau_label = torch.unique(hit_particle_link_tau)
     else:
         hit_particle_link_tau = None
     if predict:
-        ct_track = torch.tensor(output["pf_vectoronly"][2, 0:number_hits])
-        unique_id = torch.tensor(output["pf_vectoronly"][3, 0:number_hits])
+        ct_track = _event_tensor(output["pf_vectoronly"][2, 0:number_hits])
+        unique_id = _event_tensor(output["pf_vectoronly"][3, 0:number_hits])
     else:
         ct_track = None
         unique_id = None
     features_hits = torch.permute(
-        torch.tensor(output["pf_features"][:, 0:number_hits]), (1, 0)
+        _event_tensor(output["pf_features"][:, 0:number_hits]), (1, 0)
     )
     hit_type = features_hits[:, 3].clone()
     if overlay:
@@ -85,11 +90,11 @@ def create_inputs_from_table(output, predict=False, tau=False, overlay=False):
     unique_list_particles = torch.Tensor(unique_list_particles).to(torch.int64)
     # print("unique_list_particles", unique_list_particles)
     features_particles = torch.permute(
-        torch.tensor(output["pf_vectors"][:, list(unique_list_particles)]),
+        torch.from_numpy(output["pf_vectors"][:, list(unique_list_particles)]),
         (1, 0),
     )
     if tau and predict:
-        tau_mom = torch.tensor(output["pf_vectors"][6, list(unique_tau_label.long().numpy())])
+        tau_mom = torch.from_numpy(output["pf_vectors"][6, list(unique_tau_label.long().numpy())])
         # print(tau_mom)
     else:
         tau_mom = None
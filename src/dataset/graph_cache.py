@@ -0,0 +1,287 @@
+import os
+import json
+import uuid
+import fcntl
+import shutil
+import hashlib
+import threading
+import numpy as np
+import torch
+import dgl
+
+from src.logger.logger import _logger
+from src.data.fileio import _num_entries, _entry_range
+from src.data.tools import _expr_key
+
+# on-disk cache of the graphs built by _SimpleIter.get_data, one directory per
+# input file, keyed by the file (path, size, mtime), the md5 of the data config
+# and the graph_config flags. Each iterator appends its own segments to it:
+#   seg_<id>.bin   node tensors and particle table of a set of events, read back
+#                  memory-mapped
+#   seg_<id>.json  dtype/shape/offset of every array of these events, written
+#                  after the .bin, so that only complete segments are read
+# The headers also record which entries were read and which passed the
+# selection, so that a load range fully in the cache is not read from the
+# input files at all.
+# The cache is bounded by max_bytes: the least recently used file directories
+# are removed when a new segment does not fit, except those used by a running
+# iterator, which holds a shared lock on their .lock file. Segments which still
+# do not fit are not written (the graphs are built again by later passes).
+# The cache can otherwise be cleared by removing the directory between runs.
+
+_graph_flags = ("VTX", "vector", "tau", "overlay", "tracking_CLD", "predict")
+
+
+def _md5_of(values):
+    return hashlib.md5(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class _FileState(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.graphs = {}  # entry -> (segment, record)
+        self.known = {}  # selection key -> entries read
+        self.selected = {}  # selection key -> entries passing the selection
+        self.pending_graphs = {}
+        self.pending_loaded = []
+        self.mmaps = {}
+
+    def add_loaded(self, selection, entries, selected):
+        self.known.setdefault(selection, set()).update(entries)
+        self.selected.setdefault(selection, set()).update(selected)
+
+
+class GraphCache(object):
+    def __init__(self, cache_dir, data_config_md5, graph_config, flush_every=1000, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.config_key = [data_config_md5] + [
+            bool(graph_config.get(k, False)) for k in _graph_flags
+        ]
+        self.flush_every = flush_every
+        self.max_bytes = max_bytes
+        self._states = {}
+        self._locks = []
+        self._full = False
+        self._num_entries = {}
+        self._n_pending = 0
+        self._lock = threading.RLock()
+
+    def _file_key(self, filepath):
+        stat = os.stat(filepath)
+        return _md5_of(self.config_key + [os.path.abspath(filepath), stat.st_size, stat.st_mtime])
+
+    def _state(self, filepath):
+        if filepath not in self._states:
+            directory = os.path.join(self.cache_dir, self._file_key(filepath))
+            self._hold(directory)
+            state = _FileState(directory)
+            if os.path.isdir(directory):
+                for name in sorted(os.listdir(directory)):
+                    if not name.startswith("seg_") or not name.endswith(".json"):
+                        continue
+                    with open(os.path.join(directory, name)) as f:
+                        header = json.load(f)
+                    segment = name[: -len(".json")]
+                    for entry, record in header["graphs"].items():
+                        state.graphs[int(entry)] = (segment, record)
+                    for loaded in header["loaded"]:
+                        state.add_loaded(loaded["selection"], loaded["entries"], loaded["selected"])
+            self._states[filepath] = state
+        return self._states[filepath]
+
+    def _hold(self, directory):
+        # shared lock on the directory of a file while this process uses it, so
+        # that it is not evicted, and most recently used
+        path = os.path.join(directory, ".lock")
+        while True:
+            os.makedirs(directory, exist_ok=True)
+            lock = open(path, "a")
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if os.path.exists(path):
+                break
+            # removed by an eviction in the meantime
+            lock.close()
+        os.utime(directory)
+        self._locks.append(lock)
+
+    def _make_room(self, nbytes):
+        if self.max_bytes is None:
+            return True
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, key)
+            try:
+                size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+                entries.append((os.stat(directory).st_mtime, size, directory))
+            except OSError:
+                continue
+        total = sum(e[1] for e in entries)
+        for _, size, directory in sorted(entries):
+            if total + nbytes <= self.max_bytes:
+                break
+            try:
+                lock = open(os.path.join(directory, ".lock"), "a")
+            except OSError:
+                continue
+            with lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # used by a running iterator
+                    continue
+                shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+        if total + nbytes > self.max_bytes:
+            if not self._full:
+                _logger.warning(
+                    "Graph cache %s is full (%.1f GB), the graphs are not cached anymore"
+                    % (self.cache_dir, self.max_bytes / 1e9)
+                )
+                self._full = True
+            return False
+        return True
+
+    def load(self, filelist, load_range, selection, treename=None):
+        # entries of the load range passing the selection, if they are all in
+        # the cache, None otherwise
+        file_index = []
+        entries = []
+        with self._lock:
+            for i, filepath in enumerate(filelist):
+                if filepath not in self._num_entries:
+                    self._num_entries[filepath] = _num_entries(filepath, treename)
+                if self._num_entries[filepath] is None:
+                    return None
+                start, stop = _entry_range(self._num_entries[filepath], load_range)
+                state = self._state(filepath)
+                known = state.known.get(selection, set())
+                if any(e not in known for e in range(start, stop)):
+                    return None
+                selected = sorted(e for e in state.selected.get(selection, ()) if start <= e < stop)
+                if any(e not in state.graphs and e not in state.pending_graphs for e in selected):
+                    return None
+                file_index += [i] * len(selected)
+                entries += selected
+        return {
+            "_file_index": np.asarray(file_index, dtype=np.int64),
+            "_entry": np.asarray(entries, dtype=np.int64),
+        }
+
+    def add_loaded(self, filelist, file_index, entries, selected_file_index, selected_entries, selection):
+        # entries read from the input files and the ones passing the selection
+        with self._lock:
+            for i, filepath in enumerate(filelist):
+                read = entries[file_index == i]
+                if len(read) == 0 or np.any(read < 0):
+                    continue
+                selected = selected_entries[selected_file_index == i]
+                loaded = {
+                    "selection": selection,
+                    "entries": read.tolist(),
+                    "selected": selected.tolist(),
+                }
+                state = self._state(filepath)
+                state.add_loaded(selection, loaded["entries"], loaded["selected"])
+                state.pending_loaded.append(loaded)
+
+    def get(self, filepath, entry):
+        with self._lock:
+            state = self._state(filepath)
+            if entry in state.pending_graphs:
+                return self._to_graph(state.pending_graphs[entry], None, state)
+            if entry in state.graphs:
+                segment, record = state.graphs[entry]
+                return self._to_graph(record, segment, state)
+        return None
+
+    def put(self, filepath, entry, result):
+        [g, y], graph_empty = result
+        if entry < 0:
+            return
+        if graph_empty:
+            arrays = {}
+        else:
+            arrays = {"ndata/" + k: v.numpy() for k, v in g.ndata.items()}
+            arrays["y"] = y.numpy()
+        with self._lock:
+            state = self._state(filepath)
+            state.pending_graphs[entry] = {
+                "empty": bool(graph_empty),
+                "num_nodes": 0 if graph_empty else g.number_of_nodes(),
+                "arrays": arrays,
+            }
+            self._n_pending += 1
+            if self._n_pending >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            for state in self._states.values():
+                if state.pending_graphs or state.pending_loaded:
+                    self._write_segment(state)
+            self._n_pending = 0
+
+    def _write_segment(self, state):
+        nbytes = sum(v.nbytes for p in state.pending_graphs.values() for v in p["arrays"].values())
+        if not self._make_room(nbytes):
+            state.pending_graphs = {}
+            state.pending_loaded = []
+            return
+        os.makedirs(state.directory, exist_ok=True)
+        segment = "seg_%s" % uuid.uuid4().hex
+        graphs = {}
+        offset = 0
+        with open(os.path.join(state.directory, segment + ".bin"), "wb") as f:
+            for entry, pending in state.pending_graphs.items():
+                fields = {}
+                for name, value in pending["arrays"].items():
+                    value = np.ascontiguousarray(value)
+                    f.write(value.tobytes())
+                    fields[name] = [value.dtype.str, list(value.shape), offset]
+                    offset += value.nbytes
+                graphs[str(entry)] = {
+                    "empty": pending["empty"],
+                    "num_nodes": pending["num_nodes"],
+                    "fields": fields,
+                }
+        header = {"graphs": graphs, "loaded": state.pending_loaded}
+        tmp = os.path.join(state.directory, "." + segment + ".json")
+        with open(tmp, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp, os.path.join(state.directory, segment + ".json"))
+        for entry, record in graphs.items():
+            state.graphs[int(entry)] = (segment, record)
+        state.pending_graphs = {}
+        state.pending_loaded = []
+
+    def _to_graph(self, record, segment, state):
+        if record["empty"]:
+            return [0, 0], True
+        if segment is None:
+            arrays = {k: v.copy() for k, v in record["arrays"].items()}
+        else:
+            if segment not in state.mmaps:
+                path = os.path.join(state.directory, segment + ".bin")
+                state.mmaps[segment] = np.memmap(path, dtype=np.uint8, mode="r")
+            buffer = state.mmaps[segment]
+            arrays = {}
+            for name, (dtype, shape, offset) in record["fields"].items():
+                count = int(np.prod(shape))
+                value = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+                arrays[name] = value.reshape(shape).copy()
+        g = dgl.DGLGraph()
+        g.add_nodes(record["num_nodes"])
+        for name, value in arrays.items():
+            if name.startswith("ndata/"):
+                g.ndata[name[len("ndata/") :]] = torch.from_numpy(value)
+        return [g, torch.from_numpy(arrays["y"])], False
+
+
+def _selection_key(data_config, options):
+    return _md5_of(
+        _expr_key(
+            data_config.selection_expr
+            if options["training"]
+            else data_config.test_time_selection_expr
+        )
+    )
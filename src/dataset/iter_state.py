@@ -0,0 +1,193 @@
+import os
+import json
+import numpy as np
+import torch
+from lightning.pytorch.callbacks import Callback
+
+from src.logger.logger import _logger
+
+# position of the _SimpleIter of every DataLoader worker, so that a run
+# restarted from a checkpoint resumes the epoch at the next unread event
+# instead of reading the files again from the start. Every worker writes in the
+# state directory a record of each table it iterates over (<name>.json, and
+# <name>.<seq>.npz with the order of the events and the numpy random state):
+# the files and load range of the table, the position of the next fetch in the
+# file list of the epoch, and the events without graph. The main process counts
+# the events of the batches it got from each worker (the batches are tagged with
+# the id of the worker which collated them, see WorkerBatchFunc) and saves, with every checkpoint, the table and
+# cursor of the next event of each worker. Events yielded by a worker but not
+# used by the main process (prefetched batches, or those dropped at the end of
+# an epoch) are not counted, so that they are yielded again after a resume.
+
+# tables kept in the records of a worker, which is at most a few batches ahead
+# of the main process
+_n_records = 8
+
+
+def _write_json(path, obj):
+    # written under a temporary name and renamed, the main process reading it at any time
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+class _Records(object):
+    # records of the tables of one worker, written to state_dir/<name>.json
+    def __init__(self, state_dir, name):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, name)
+        self.records = []
+        self.seq = 0
+        # events yielded since the iterator was created, and at the start of the current epoch
+        self.n_yielded = 0
+        self.epoch_start = 0
+        self._write()
+
+    def _write(self):
+        _write_json(self.path + ".json", {"epoch_start": self.epoch_start, "records": self.records})
+
+    def new_table(self, fetch, indices, cursor=0):
+        self.seq += 1
+        keys, pos, has_gauss, cached_gaussian = np.random.get_state()[1:]
+        np.savez(
+            "%s.%d.npz" % (self.path, self.seq),
+            indices=np.asarray(indices),
+            keys=keys,
+            pos=pos,
+            has_gauss=has_gauss,
+            cached_gaussian=cached_gaussian,
+        )
+        self.records.append(dict(seq=self.seq, start=self.n_yielded, cursor=cursor, empties=[], **fetch))
+        for r in self.records[:-_n_records]:
+            try:
+                os.remove("%s.%d.npz" % (self.path, r["seq"]))
+            except OSError:
+                pass
+        self.records = self.records[-_n_records:]
+        self._write()
+
+    def event(self, position, graph_empty):
+        if graph_empty:
+            self.records[-1]["empties"].append(int(position))
+            self._write()
+        else:
+            self.n_yielded += 1
+
+    def new_epoch(self):
+        self.epoch_start = self.n_yielded
+        self._write()
+
+
+def _worker_state(state_dir, name, n_events):
+    # table and cursor of the next event of worker `name` after n_events events
+    # of the current epoch, None if its records do not go back that far
+    path = os.path.join(state_dir, name)
+    with open(path + ".json") as f:
+        state = json.load(f)
+    target = state["epoch_start"] + n_events
+    records = [r for r in state["records"] if r["start"] <= target]
+    if not records:
+        return None
+    record = records[-1]
+    cursor = record["cursor"] + target - record["start"]
+    for position in sorted(record["empties"]):
+        # events without graph are skipped without being counted
+        if position <= cursor:
+            cursor += 1
+    with np.load("%s.%d.npz" % (path, record["seq"])) as f:
+        rng = ("MT19937", f["keys"], int(f["pos"]), int(f["has_gauss"]), float(f["cached_gaussian"]))
+        indices = f["indices"]
+    return dict(
+        fetch=record["fetch"],
+        filelist=record["filelist"],
+        load_range=record["load_range"],
+        ipos=record["ipos"],
+        indices=indices,
+        cursor=cursor,
+        rng=rng,
+    )
+
+
+class WorkerBatchFunc(object):
+    r"""Collate function appending to the batches of ``collate`` (e.g. ``graph_batch_func``) the id of the
+    DataLoader worker which made them (0 without workers), used by ``IterStateCheckpoint``.
+    """
+
+    def __init__(self, collate):
+        self.collate = collate
+
+    def __call__(self, items):
+        info = torch.utils.data.get_worker_info()
+        return tuple(self.collate(items)) + (0 if info is None else info.id,)
+
+
+def _iter_state_path(checkpoint, rank):
+    return "%s.iter_state_rank%d" % (os.path.splitext(checkpoint)[0], rank or 0)
+
+
+def load_iter_state(checkpoint, rank=None):
+    r"""Position of the workers saved with ``checkpoint`` by ``IterStateCheckpoint``, to be given to
+    ``SimpleIterDataset(resume_state=...)``.
+    """
+    path = _iter_state_path(checkpoint, rank)
+    if not os.path.exists(path):
+        raise RuntimeError("No iterator state %s for checkpoint %s" % (path, checkpoint))
+    _logger.info("Resuming the training data from %s" % path)
+    return torch.load(path, weights_only=False)
+
+
+class IterStateCheckpoint(Callback):
+    r"""Saves the position of the DataLoader workers of the training ``SimpleIterDataset`` with the checkpoints
+    of ``ModelCheckpoint``, as ``<checkpoint>.iter_state_rank<rank>`` next to ``<checkpoint>.ckpt``.
+    Resuming requires the same number of workers and of GPUs. Each worker resumes at its next unread event
+    (within one sort buffer with ``--batch-sort-buffer``) and then goes through the rest of the files and load
+    ranges of the epoch, whose events may be shuffled differently than in the interrupted run.
+    Arguments:
+        loader (DataLoader): training DataLoader, whose dataset was given ``iter_state_dir`` and whose batches
+            are made by ``WorkerBatchFunc``.
+        dirpath (str), filename (str), every_n_train_steps (int): as given to ``ModelCheckpoint``.
+    """
+
+    def __init__(self, loader, dirpath, filename="_{epoch}_{step}", every_n_train_steps=1000):
+        # unwrap HitBudgetBatches
+        dataset = loader.dataset
+        self.dataset = getattr(dataset, "dataset", dataset)
+        self.num_workers = loader.num_workers
+        self.dirpath = dirpath
+        self.filename = filename
+        self.every_n_train_steps = every_n_train_steps
+        self.n_events = {}
+        self._last_step = None
+
+    def _names(self):
+        if self.num_workers == 0:
+            return [self.dataset._name]
+        return ["%s_worker%d" % (self.dataset._name, w) for w in range(self.num_workers)]
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.n_events = {name: 0 for name in self._names()}
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        # the saved position only applies to the first epoch after the resume
+        self.dataset._resume_state = None
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        # worker which made the batch, appended by WorkerBatchFunc
+        self.n_events[self._names()[batch[-1]]] += batch[0].batch_size
+        step = trainer.global_step
+        if step == 0 or step % self.every_n_train_steps != 0 or step == self._last_step:
+            return
+        self._last_step = step
+        state = {}
+        for name, n_events in self.n_events.items():
+            try:
+                state[name] = _worker_state(self.dataset._iter_state_dir, name, n_events)
+            except OSError:
+                state[name] = None
+            if state[name] is None:
+                _logger.warning("Position of DataIter %s after %d events is not known" % (name, n_events))
+        checkpoint = os.path.join(
+            self.dirpath, self.filename.format(epoch="epoch=%d" % trainer.current_epoch, step="step=%d" % step)
+        )
+        torch.save(state, _iter_state_path(checkpoint, trainer.global_rank))
@@ -0,0 +1,176 @@
+import time
+import queue
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+
+# staged prefetch of _SimpleIter: every stage runs its function on a pool of
+# worker threads and keeps the futures of its outputs, in input order, in a
+# bounded queue read by the next stage. A stage whose output queue is full
+# stops taking inputs, so that at most depth + 1 items are in flight in each
+# stage (depth should be at least the number of workers). The occupancy of the
+# queues tells which stage limits the rate: the queues after the bottleneck are
+# mostly empty (their consumer waits), the ones before it mostly full (their
+# producer waits).
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class _Done(object):
+    # already computed output, e.g. failure of the upstream stage
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class _Stage(object):
+    def __init__(self, name, fn, workers=1, depth=1, expand=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.depth = depth
+        # maps an upstream output to the list of inputs of this stage
+        self.expand = expand
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue = queue.Queue(maxsize=depth)
+        # counters
+        self.n_items = 0
+        self.occupancy = 0
+        self.empty = 0
+        self.consumer_wait = 0.0
+        self.producer_wait = 0.0
+
+    def stats(self):
+        n = max(self.n_items, 1)
+        return {
+            "items": self.n_items,
+            "workers": self.workers,
+            "depth": self.depth,
+            "mean_occupancy": self.occupancy / n,
+            "empty_fraction": self.empty / n,
+            "consumer_wait": self.consumer_wait,
+            "producer_wait": self.producer_wait,
+        }
+
+
+class StagedPipeline(object):
+    r"""Chain of stages, each running on its own thread pool with a bounded output queue.
+    Arguments:
+        source (iterable): inputs of the first stage, consumed by a background thread.
+        stages (list of dict): ``name``, ``fn``, ``workers``, ``depth`` and optionally ``expand``, a function
+            mapping each output of the previous stage to a list of inputs of this one.
+    Outputs are returned by ``get`` in the order of the inputs; exceptions raised by a stage are raised there.
+    """
+
+    def __init__(self, source, stages):
+        self.stages = [_Stage(**s) for s in stages]
+        self._stop = threading.Event()
+        self._threads = []
+        upstream = source
+        for stage in self.stages:
+            t = threading.Thread(target=self._feed, args=(stage, upstream), daemon=True)
+            self._threads.append(t)
+            upstream = self._drain(stage)
+        self._output = upstream
+        for t in self._threads:
+            t.start()
+
+    def _put(self, stage, item):
+        t0 = time.time()
+        while not self._stop.is_set():
+            try:
+                stage.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stage.producer_wait += time.time() - t0
+
+    def _feed(self, stage, upstream):
+        try:
+            for item in upstream:
+                for x in [item] if stage.expand is None else stage.expand(item):
+                    if self._stop.is_set():
+                        return
+                    self._put(stage, stage.executor.submit(stage.fn, x))
+        except Exception as e:
+            self._put(stage, _Done(_Failure(e)))
+        finally:
+            self._put(stage, _END)
+
+    def _drain(self, stage):
+        while not self._stop.is_set():
+            occupancy = stage.queue.qsize()
+            t0 = time.time()
+            try:
+                item = stage.queue.get(timeout=0.1)
+            except queue.Empty:
+                stage.consumer_wait += time.time() - t0
+                continue
+            stage.consumer_wait += time.time() - t0
+            if item is _END:
+                return
+            stage.n_items += 1
+            stage.occupancy += occupancy
+            stage.empty += occupancy == 0
+            value = item.result()
+            if isinstance(value, _Failure):
+                raise value.exc
+            yield value
+
+    def get(self):
+        # next output of the last stage, StopIteration at the end of the source
+        return next(self._output)
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def summary(self):
+        return ", ".join(
+            "%s: %d items, %d workers, occupancy %.1f/%d, empty %.0f%%, consumer wait %.1fs, producer wait %.1fs"
+            % (
+                name,
+                s["items"],
+                s["workers"],
+                s["mean_occupancy"],
+                s["depth"],
+                100 * s["empty_fraction"],
+                s["consumer_wait"],
+                s["producer_wait"],
+            )
+            for name, s in self.stats().items()
+        )
+
+    def close(self):
+        # the feeder threads return within their polling interval, the queued
+        # outputs are dropped and the items not started are cancelled
+        self._stop.set()
+        for stage in self.stages:
+            stage.executor.shutdown(wait=False, cancel_futures=True)
+            while True:
+                try:
+                    stage.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+
+def _parse_pipeline(spec):
+    # "read_workers:depth,preprocess_workers:depth,build_workers:depth", e.g. "1:2,1:2,4:256"
+    if not spec:
+        return None
+    names = ("read", "preprocess", "build")
+    values = spec.split(",")
+    if len(values) != len(names):
+        raise ValueError("Expected %d stages in the pipeline spec %s" % (len(names), spec))
+    config = {}
+    for name, value in zip(names, values):
+        workers, depth = (int(v) for v in value.split(":"))
+        if workers < 1 or depth < 1:
+            raise ValueError("Workers and depth of the %s stage must be positive in %s" % (name, spec))
+        config[name] = {"workers": workers, "depth": depth}
+    return config
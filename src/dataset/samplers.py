@@ -0,0 +1,217 @@
+import numpy as np
+import torch.utils.data
+import torch.distributed as dist
+
+from src.data.event_index import _balanced_event_shards
+
+
+def _replicas_and_rank(num_replicas, rank):
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    if rank is None:
+        rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    return num_replicas, rank
+
+
+class HitBalancedSampler(torch.utils.data.Sampler):
+    r"""Distributed sampler of an ``IndexedDataset``.
+    Every rank gets the same number of events, so that they run the same number of steps, and about the
+    same total number of hits, so that no rank waits for the others at every step.
+    Arguments:
+        n_hits (array): number of hits of each event of the dataset.
+        num_replicas (int): number of ranks, from torch.distributed if None.
+        rank (int): rank of this process, from torch.distributed if None.
+        shuffle (bool): new assignment and order of the events at every epoch (``set_epoch``).
+        seed (int): seed shared by all the ranks.
+        chunk_ids (array): chunk read by the dataset for each event (``IndexedDataset.chunk_ids``); when
+            shuffling, the events of a chunk are yielded together, the chunks in random order.
+    """
+
+    def __init__(self, n_hits, num_replicas=None, rank=None, shuffle=True, seed=0, chunk_ids=None):
+        self.n_hits = np.asarray(n_hits)
+        self.chunk_ids = None if chunk_ids is None else np.asarray(chunk_ids)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _events(self, num_replicas, rank):
+        # events of a rank for the current epoch, the same on all the ranks
+        rng = np.random.RandomState(self.seed + self.epoch)
+        events = _balanced_event_shards(self.n_hits, num_replicas, rng)[rank]
+        if self.shuffle:
+            events = rng.permutation(events)
+            if self.chunk_ids is not None:
+                _, chunk = np.unique(self.chunk_ids[events], return_inverse=True)
+                chunk_order = rng.permutation(chunk.max() + 1) if len(chunk) else chunk
+                events = events[np.argsort(chunk_order[chunk], kind="stable")]
+        else:
+            events = np.sort(events)
+        return events
+
+    def __iter__(self):
+        num_replicas, rank = _replicas_and_rank(self.num_replicas, self.rank)
+        return iter(self._events(num_replicas, rank).tolist())
+
+    def __len__(self):
+        num_replicas, _ = _replicas_and_rank(self.num_replicas, self.rank)
+        return len(self.n_hits) // num_replicas
+
+
+def _event_cost(n_hits, cost):
+    # cost of an event in the batch budget: its hits, or its squared hits for the
+    # memory of the attention
+    n_hits = np.asarray(n_hits, dtype=np.float64)
+    if cost == "hits":
+        return n_hits
+    elif cost == "hits2":
+        return n_hits ** 2
+    raise ValueError("Unknown batch cost %s, expected hits or hits2" % cost)
+
+
+def _sort_buffers(events, n_hits, sort_buffer):
+    # events sorted by size within consecutive windows of sort_buffer events, so
+    # that events of similar size are batched together
+    if sort_buffer <= 1:
+        return events
+    events = np.asarray(events)
+    return np.concatenate(
+        [
+            events[i : i + sort_buffer][np.argsort(n_hits[events[i : i + sort_buffer]], kind="stable")]
+            for i in range(0, len(events), sort_buffer)
+        ]
+        + [events[:0]]
+    )
+
+
+def _pack_batches(events, cost, budget):
+    # consecutive events packed in batches with a total cost up to budget, an
+    # event above the budget making a batch on its own
+    batches = []
+    batch = []
+    total = 0
+    for e, c in zip(events, cost):
+        if batch and total + c > budget:
+            batches.append(batch)
+            batch = []
+            total = 0
+        batch.append(e)
+        total += c
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class HitBudgetBatchSampler(torch.utils.data.Sampler):
+    r"""Batch sampler of an ``IndexedDataset`` packing events up to a total number of hits instead of a
+    fixed number of events, for models (GATr) whose cost grows with the hits of each event.
+    The events of each rank are those of ``HitBalancedSampler``, the ranks are given the same number of
+    batches (the extra batches of some ranks are dropped).
+    Arguments:
+        n_hits (array): number of hits of each event of the dataset.
+        budget (float): maximum cost of a batch.
+        cost (str): ``hits`` (sum of the hits) or ``hits2`` (sum of the squared hits, for the attention).
+        sort_buffer (int): events are sorted by size within windows of this many events before packing.
+        other arguments: see ``HitBalancedSampler``.
+    """
+
+    def __init__(
+        self,
+        n_hits,
+        budget,
+        cost="hits",
+        sort_buffer=0,
+        num_replicas=None,
+        rank=None,
+        shuffle=True,
+        seed=0,
+        chunk_ids=None,
+    ):
+        self.sampler = HitBalancedSampler(
+            n_hits, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, chunk_ids=chunk_ids
+        )
+        self.n_hits = self.sampler.n_hits
+        self.cost = _event_cost(self.n_hits, cost)
+        self.budget = budget
+        self.sort_buffer = sort_buffer
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def _batches(self, rank):
+        events = _sort_buffers(self.sampler._events(self._num_replicas, rank), self.n_hits, self.sort_buffer)
+        return _pack_batches(events.tolist(), self.cost[events], self.budget)
+
+    def _all_batches(self):
+        self._num_replicas, self._rank = _replicas_and_rank(self.sampler.num_replicas, self.sampler.rank)
+        batches = self._batches(self._rank)
+        n_batches = min(len(self._batches(r)) if r != self._rank else len(batches) for r in range(self._num_replicas))
+        batches = batches[:n_batches]
+        if self.sampler.shuffle:
+            rng = np.random.RandomState(self.sampler.seed + self.sampler.epoch + 1)
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        return iter(self._all_batches())
+
+    def __len__(self):
+        return len(self._all_batches())
+
+
+class HitBudgetBatches(torch.utils.data.IterableDataset):
+    r"""Batches of the graphs of an iterable dataset (``SimpleIterDataset``) packed up to a total number of
+    nodes, to be used with ``DataLoader(batch_size=None, collate_fn=graph_batch_func)``.
+    Arguments:
+        dataset (IterableDataset): dataset yielding ``[g, y]``.
+        budget (float): maximum cost of a batch.
+        cost (str): ``hits`` or ``hits2``, see ``HitBudgetBatchSampler``.
+        sort_buffer (int): graphs are collected by this many and sorted by size before packing.
+    """
+
+    def __init__(self, dataset, budget, cost="hits", sort_buffer=0):
+        self.dataset = dataset
+        self.budget = budget
+        self.cost = cost
+        self.sort_buffer = sort_buffer
+        # unknown costs fail here rather than in the DataLoader workers
+        _event_cost([], cost)
+
+    @property
+    def config(self):
+        return self.dataset.config
+
+    def _pack(self, buffer):
+        n_nodes = np.array([g.number_of_nodes() for g, _ in buffer])
+        events = _sort_buffers(np.arange(len(buffer)), n_nodes, len(buffer))
+        for batch in _pack_batches(events.tolist(), _event_cost(n_nodes, self.cost)[events], self.budget):
+            yield [buffer[i] for i in batch]
+
+    def __iter__(self):
+        if self.sort_buffer > 1:
+            buffer = []
+            for item in self.dataset:
+                buffer.append(item)
+                if len(buffer) == self.sort_buffer:
+                    yield from self._pack(buffer)
+                    buffer = []
+            if buffer:
+                yield from self._pack(buffer)
+        else:
+            # graphs packed in the order they come
+            batch = []
+            total = 0
+            for item in self.dataset:
+                c = _event_cost([item[0].number_of_nodes()], self.cost)[0]
+                if batch and total + c > self.budget:
+                    yield batch
+                    batch = []
+                    total = 0
+                batch.append(item)
+                total += c
+            if batch:
+                yield batch
@@ -0,0 +1,72 @@
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+import numpy as np
+
+from src.logger.logger import _logger
+
+# preprocessed tables of the in_memory datasets, written once per node as a
+# directory of .npy files (in /dev/shm by default, i.e. in shared memory) and
+# memory-mapped read-only by every DataLoader worker of every process, instead
+# of each worker holding its own copy. The first process taking the lock of a
+# table builds it, the others wait for it and attach to it. Tables are keyed by
+# the data config, the input files, the load range and the selection, and are
+# left in place at the end of the run: remove the directory to free the memory.
+
+
+def _shared_dir(shared_dir):
+    if shared_dir:
+        return shared_dir
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/tracking_dc"
+    return os.path.join(tempfile.gettempdir(), "tracking_dc")
+
+
+def _attach(directory):
+    with open(os.path.join(directory, "header.json")) as f:
+        header = json.load(f)
+    table = {
+        name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+        for name in header["arrays"]
+    }
+    table.update(header["objects"])
+    return table
+
+
+def _write(directory, table):
+    # written under a temporary name and renamed once complete
+    tmp = directory + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    header = {"arrays": [], "objects": {}}
+    for name, value in table.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp, name + ".npy"), value)
+            header["arrays"].append(name)
+        else:
+            header["objects"][name] = value
+    with open(os.path.join(tmp, "header.json"), "w") as f:
+        json.dump(header, f)
+    os.replace(tmp, directory)
+
+
+def shared_table(shared_dir, key, build):
+    # table `key` of shared_dir, built by build() if no process did it yet
+    shared_dir = _shared_dir(shared_dir)
+    os.makedirs(shared_dir, exist_ok=True)
+    directory = os.path.join(shared_dir, key)
+    with open(directory + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isdir(directory):
+                table = build()
+                _write(directory, table)
+                _logger.info(
+                    "Wrote shared table %s, %.1f MB"
+                    % (directory, sum(v.nbytes for v in table.values() if isinstance(v, np.ndarray)) / 1e6)
+                )
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return _attach(directory)
@@ -1,3 +1,4 @@
+import math
 import dgl
 import torch
 
@@ -6,11 +7,13 @@ def graph_batch_func(list_graphs):
     """collator function for graph dataloader
 
     Args:
-        list_graphs (list): list of graphs from the iterable dataset
+        list_graphs (list): list of graphs from the iterable dataset, or from the map-style
+            dataset where the events without graph are None
 
     Returns:
         batch dgl: dgl batch of graphs
     """
+    list_graphs = [el for el in list_graphs if el is not None]
     list_graphs_g = [el[0] for el in list_graphs]
     list_y = add_batch_number(list_graphs)
     ys = torch.cat(list_y, dim=0)
@@ -21,6 +24,94 @@ def graph_batch_func(list_graphs):
     return bg, ys
 
 
+def augment_batch(bg, ys, rotate_phi=True, reflect_z=True, h_positions=(), theta=None, phi=None, momentum=None):
+    """random global rotation around the z axis and reflection z -> -z of every event of a batch,
+    applied to the positions of the hits (pos_hits_xyz, the left-right vector and the (x, y, z)
+    columns ``h_positions`` of h) and to the particles (columns ``theta``, ``phi`` and
+    ``momentum`` = (px, py, pz) of ys)
+
+    Args:
+        bg (dgl batch), ys (tensor): as returned by graph_batch_func, the last column of ys being
+            the index of the event of the particle
+
+    Returns:
+        bg, ys: augmented batch
+    """
+    n_events = bg.batch_size
+    angle = torch.rand(n_events) * 2 * math.pi if rotate_phi else torch.zeros(n_events)
+    sign = torch.ones(n_events)
+    if reflect_z:
+        sign[torch.rand(n_events) < 0.5] = -1
+    cos, sin = torch.cos(angle), torch.sin(angle)
+
+    def transform(xyz, event):
+        c, s, z_sign = cos[event].to(xyz), sin[event].to(xyz), sign[event].to(xyz)
+        x, y, z = xyz.unbind(-1)
+        return torch.stack((c * x - s * y, s * x + c * y, z_sign * z), dim=-1)
+
+    node_event = torch.repeat_interleave(torch.arange(n_events), bg.batch_num_nodes().cpu())
+    for key in ("pos_hits_xyz", "vector"):
+        if key in bg.ndata:
+            bg.ndata[key] = transform(bg.ndata[key], node_event)
+    if h_positions and "h" in bg.ndata:
+        h = bg.ndata["h"].clone()
+        for columns in h_positions:
+            h[:, list(columns)] = transform(h[:, list(columns)], node_event)
+        bg.ndata["h"] = h
+
+    ys = ys.clone()
+    part_event = ys[:, -1].long()
+    if theta is not None:
+        ys[:, theta] = torch.where(sign[part_event] < 0, math.pi - ys[:, theta], ys[:, theta])
+    if phi is not None:
+        ys[:, phi] = torch.remainder(ys[:, phi] + angle[part_event] + math.pi, 2 * math.pi) - math.pi
+    if momentum is not None:
+        ys[:, list(momentum)] = transform(ys[:, list(momentum)], part_event)
+    return bg, ys
+
+
+class AugmentedBatchFunc(object):
+    """collator function applying augment_batch to the batches of another one (graph_batch_func),
+    with the columns of h and ys taken from the pf_features and pf_vectors inputs of the data config
+
+    Args:
+        data_config (DataConfig): data config of the dataset
+        rotate_phi (bool), reflect_z (bool): transformations of augment_batch
+        collate (callable): collator function making the batches
+    """
+
+    def __init__(self, data_config, rotate_phi=True, reflect_z=True, collate=graph_batch_func):
+        self.collate = collate
+        self.rotate_phi = rotate_phi
+        self.reflect_z = reflect_z
+        features = list(data_config.input_dicts.get("pf_features", []))
+        # (x, y, z) triplets of the hit features, e.g. hit_x, hit_y, hit_z or leftPosition_x, ...
+        self.h_positions = [
+            (i, i + 1, i + 2)
+            for i, name in enumerate(features)
+            if name.endswith("_x") and features[i + 1 : i + 3] == [name[:-1] + "y", name[:-1] + "z"]
+        ]
+        vectors = list(data_config.input_dicts.get("pf_vectors", []))
+        column = lambda name: vectors.index(name) if name in vectors else None
+        self.theta = column("part_theta")
+        self.phi = column("part_phi")
+        momentum = [column("part_p" + c) for c in "xyz"]
+        self.momentum = None if None in momentum else momentum
+
+    def __call__(self, list_graphs):
+        bg, ys = self.collate(list_graphs)
+        return augment_batch(
+            bg,
+            ys,
+            self.rotate_phi,
+            self.reflect_z,
+            self.h_positions,
+            self.theta,
+            self.phi,
+            self.momentum,
+        )
+
+
 def add_batch_number(list_graphs):
     list_y = []
     for i, el in enumerate(list_graphs):
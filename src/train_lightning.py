@@ -39,6 +39,7 @@ from lightning.pytorch.callbacks import (
 from lightning.pytorch.profilers import AdvancedProfiler
 from src.utils.train_utils import get_samples_steps_per_epoch, model_setup, get_gpu_dev
 from src.models.Build_graphs import FreezeEFDeepSet
+from src.dataset.iter_state import IterStateCheckpoint
 import os
 # os.environ["CUDA_VISIBLE_DEVICES"] = ""
 # os.environ["CUDA_LAUNCH_BLOCKING"] = "1"
@@ -119,10 +120,11 @@ def main():
         #         dev=0, strict=False, map_location=torch.device("cuda:0"))  # Load the good clustering
         #     model.EFDeepSet.fcnn = EFDeepSet_model.fcnn
 
+        every_n_train_steps = 1000
         checkpoint_callback = ModelCheckpoint(
             dirpath=args.model_prefix,  # checkpoints_path, # <--- specify this on the trainer itself for version control
             filename="_{epoch}_{step}",
-            every_n_train_steps=1000,
+            every_n_train_steps=every_n_train_steps,
             save_top_k=-1,  # <--- this is important!
             save_weights_only=True,
         )
@@ -143,6 +145,8 @@ def main():
             logger=wandb_logger,
             # max_epochs=5,
             strategy="ddp",
+            # the map-style datasets come with their own distributed sampler
+            use_distributed_sampler=not args.map_style,
             # limit_train_batches=20,
             # limit_train_batches=890,
             limit_val_batches=5,
@@ -150,6 +154,16 @@ def main():
         args.local_rank = trainer.global_rank
         print("here")
         train_loader, val_loader, data_config, train_input_names = train_load(args)
+        if args.save_iter_state:
+            # saved with the checkpoints of checkpoint_callback
+            trainer.callbacks.append(
+                IterStateCheckpoint(
+                    train_loader,
+                    args.model_prefix,
+                    filename="_{epoch}_{step}",
+                    every_n_train_steps=every_n_train_steps,
+                )
+            )
 
         trainer.fit(
             model=model,
@@ -102,6 +102,83 @@ parser.add_argument(
     default=False,
     help="load the whole dataset (and perform the preprocessing) only once and keep it in memory for the entire run",
 )
+parser.add_argument(
+    "--shared-memory",
+    type=str,
+    nargs="?",
+    const="",
+    default=None,
+    help="with --in-memory, write the preprocessed dataset once per node (in /dev/shm, or in the given directory) "
+    "and memory-map it in every DataLoader worker of every GPU, instead of one copy per worker",
+)
+parser.add_argument(
+    "--graph-cache",
+    type=str,
+    default=None,
+    help="directory where the graphs built from the input files are cached on disk (memory-mapped), "
+    "so that later epochs and runs with the same data config read them back instead of rebuilding them",
+)
+parser.add_argument(
+    "--graph-cache-max-gb",
+    type=float,
+    default=100,
+    help="maximum size of the graph cache in GB, the least recently used files are removed to make room",
+)
+parser.add_argument(
+    "--read-threads",
+    type=int,
+    default=1,
+    help="number of input files read and decompressed concurrently by each DataLoader worker",
+)
+parser.add_argument(
+    "--pipeline",
+    type=str,
+    default="",
+    help="staged prefetch in each DataLoader worker, as workers:queue_depth of the read, preprocess and graph "
+    "building stages, e.g. 1:2,1:2,4:256 (empty: single prefetch of the next fetch); the occupancy of the "
+    "queues is logged to find the slowest stage",
+)
+parser.add_argument(
+    "--event-index",
+    type=str,
+    default=None,
+    help="path of the event index (.npz with the number of hits and particles of every event), built if it does "
+    "not exist; used to split the files between GPUs and DataLoader workers with balanced numbers of hits",
+)
+parser.add_argument(
+    "--map-style",
+    action="store_true",
+    default=False,
+    help="map-style training/validation datasets on the event index (requires --event-index), each GPU getting "
+    "the same number of events with balanced numbers of hits",
+)
+parser.add_argument(
+    "--batch-hits",
+    type=float,
+    default=0,
+    help="if positive, batches are packed up to this total cost (see --batch-cost) instead of --batch-size events",
+)
+parser.add_argument(
+    "--batch-cost",
+    type=str,
+    default="hits",
+    choices=["hits", "hits2"],
+    help="cost of an event in the --batch-hits budget: number of hits, or squared number of hits (attention)",
+)
+parser.add_argument(
+    "--batch-sort-buffer",
+    type=int,
+    default=0,
+    help="with --batch-hits, events are sorted by size within windows of this many events before packing",
+)
+parser.add_argument(
+    "--augment",
+    nargs="+",
+    default=[],
+    choices=["phi", "z"],
+    help="random global rotation in phi (`phi`) and reflection z -> -z (`z`) of every training event, applied "
+    "to the batches: hit and left/right positions, and directions and momenta of the particles",
+)
 parser.add_argument(
     "--train-val-split",
     type=float,
@@ -178,6 +255,21 @@ parser.add_argument(
     default=None,
     help="initialize model with pre-trained weights",
 )
+parser.add_argument(
+    "--save-iter-state",
+    action="store_true",
+    default=False,
+    help="save the position of the DataLoader workers in the training files with every checkpoint "
+    "(as <checkpoint>.iter_state_rank<rank>), to resume the epoch with `--resume-iter-state`; "
+    "not available with `--map-style`",
+)
+parser.add_argument(
+    "--resume-iter-state",
+    type=str,
+    default=None,
+    help="checkpoint (.ckpt) saved with `--save-iter-state` whose position in the training files is restored, "
+    "the first epoch resuming at the next unread event (requires the same --num-workers and --gpus)",
+)
 parser.add_argument("--num-epochs", type=int, default=20, help="number of epochs")
 parser.add_argument(
     "--steps-per-epoch",
@@ -302,7 +394,26 @@ parser.add_argument(
     "--copy-inputs",
     action="store_true",
     default=False,
-    help="copy input files to the current dir (can help to speed up dataloading when running over remote files, e.g., from EOS)",
+    help="copy input files in the background to a local staging directory kept across runs, read from there once "
+    "copied (can help to speed up dataloading when running over remote files, e.g., from EOS)",
+)
+parser.add_argument(
+    "--staging-dir",
+    type=str,
+    default=None,
+    help="staging directory of `--copy-inputs`; if not set, `tracking_dc_staging` in the temporary directory",
+)
+parser.add_argument(
+    "--staging-max-gb",
+    type=float,
+    default=100,
+    help="maximum size of the staging directory in GB, the least recently used files are removed to make room",
+)
+parser.add_argument(
+    "--staging-threads",
+    type=int,
+    default=4,
+    help="number of files copied concurrently to the staging directory",
 )
 parser.add_argument(
     "--log",
@@ -443,7 +554,15 @@ parser.add_argument(
     "-synthetic",
     type=str,
     default="",
-    help="Range of number of particles to use for synthetic graph generation: e.g. '3, 5'",
+    help="train on synthetic events instead of files, with a number of particles per event in the given range, "
+    "e.g. '3-5'; the other parameters of the generator are taken from the `synthetic` section of the data config "
+    "(not compatible with --data-train/--data-val, --event-index, --copy-inputs and --map-style)",
+)
+parser.add_argument(
+    "--synthetic-files",
+    type=int,
+    default=16,
+    help="number of virtual files of synthetic events of every GPU, with --synthetic-graph-npart-range",
 )
 
 parser.add_argument(
@@ -13,9 +13,15 @@ import sys
 
 from torch.utils.data import DataLoader
 from src.logger.logger import _logger, _configLogger
-from src.dataset.dataset import SimpleIterDataset
+from src.dataset.dataset import SimpleIterDataset, IndexedDataset
+from src.dataset.pipeline import _parse_pipeline
+from src.dataset.iter_state import load_iter_state, WorkerBatchFunc
+from src.dataset.samplers import HitBalancedSampler, HitBudgetBatchSampler, HitBudgetBatches
+from src.data.event_index import EventIndex, _balanced_file_shards
+from src.data.staging import StagingCache
+from src.data.synthetic import synthetic_files
 from src.utils.import_tools import import_module
-from src.layers.batch_operations import graph_batch_func
+from src.layers.batch_operations import graph_batch_func, AugmentedBatchFunc
 
 def set_gpus(args):
     if args.gpus:
@@ -112,42 +118,35 @@ def to_filelist(args, mode="train"):
     for name, files in file_dict.items():
         file_dict[name] = sorted(files)
 
-    if args.local_rank is not None:
+    shared = args.in_memory and args.shared_memory is not None
+    if args.local_rank is not None and not args.map_style and not shared:
+        # with --map-style, the events are split between the GPUs by the sampler,
+        # and with --shared-memory by the workers of the shared table
         if mode == "train":
             gpus_list, _ = set_gpus(args)
             local_world_size = len(gpus_list)  # int(os.environ['LOCAL_WORLD_SIZE'])
             new_file_dict = {}
             for name, files in file_dict.items():
-                new_files = files[args.local_rank :: local_world_size]
+                if args.event_index is not None:
+                    # same total number of hits on every GPU
+                    index = EventIndex.build(files, args.event_index)
+                    hits = dict(zip(index.files, index.hits_per_file()))
+                    new_files = _balanced_file_shards(
+                        files, [hits.get(f, 0) for f in files], local_world_size
+                    )[args.local_rank]
+                else:
+                    new_files = files[args.local_rank :: local_world_size]
                 assert len(new_files) > 0
                 np.random.shuffle(new_files)
                 new_file_dict[name] = new_files
             file_dict = new_file_dict
 
     if args.copy_inputs:
-        import tempfile
-
-        tmpdir = tempfile.mkdtemp()
-        if os.path.exists(tmpdir):
-            shutil.rmtree(tmpdir)
-        new_file_dict = {name: [] for name in file_dict}
-        for name, files in file_dict.items():
-            for src in files:
-                dest = os.path.join(tmpdir, src.lstrip("/"))
-                if not os.path.exists(os.path.dirname(dest)):
-                    os.makedirs(os.path.dirname(dest), exist_ok=True)
-                shutil.copy2(src, dest)
-                _logger.info("Copied file %s to %s" % (src, dest))
-                new_file_dict[name].append(dest)
-            if len(files) != len(new_file_dict[name]):
-                _logger.error(
-                    "Only %d/%d files copied for %s file group %s",
-                    len(new_file_dict[name]),
-                    len(files),
-                    mode,
-                    name,
-                )
-        file_dict = new_file_dict
+        # copied in the background to the staging directory of the node and read
+        # from there once complete, the file lists keep the original paths
+        StagingCache(
+            args.staging_dir, max_bytes=args.staging_max_gb * 1e9, num_threads=args.staging_threads
+        ).stage(sum(file_dict.values(), []))
 
     filelist = sum(file_dict.values(), [])
     assert len(filelist) == len(set(filelist))
@@ -161,7 +160,20 @@ def train_load(args):
     :param args:
     :return: train_loader, val_loader, data_config, train_inputs
     """
+    if args.synthetic_graph_npart_range:
+        # the virtual files of synthetic events are neither on disk nor indexed
+        if args.data_train or args.data_val:
+            raise RuntimeError("--synthetic-graph-npart-range cannot be used with --data-train or --data-val")
+        if args.event_index is not None or args.copy_inputs or args.map_style:
+            raise RuntimeError(
+                "--event-index, --copy-inputs and --map-style cannot be used with --synthetic-graph-npart-range"
+            )
     train_file_dict, train_files = to_filelist(args, "train")
+    if args.synthetic_graph_npart_range:
+        # virtual files of synthetic events, different on every GPU
+        offset = 0 if args.local_rank is None else args.local_rank * args.synthetic_files
+        train_files = synthetic_files(args.synthetic_files, offset)
+        train_file_dict = {"_": train_files}
     if args.data_val:
         val_file_dict, val_files = to_filelist(args, "val")
         train_range = val_range = (0, 1)
@@ -200,73 +212,175 @@ def train_load(args):
         minp = int(syn_str.split("-")[0])
         maxp = int(syn_str.split("-")[1])
 
-    train_data = SimpleIterDataset(
-        train_file_dict,
-        args.data_config,
-        for_training=True,
-        extra_selection=args.extra_selection,
-        remake_weights=not args.no_remake_weights,
-        load_range_and_fraction=(train_range, args.data_fraction),
-        file_fraction=args.file_fraction,
-        fetch_by_files=args.fetch_by_files,
-        fetch_step=args.fetch_step,
-        infinity_mode=args.steps_per_epoch is not None,
-        in_memory=args.in_memory,
-        laplace=args.laplace,
-        diffs=args.diffs,
-        edges=args.class_edges,
-        name="train" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
-        dataset_cap=args.train_cap,
-        n_noise=args.n_noise,
-        synthetic=synthetic,
-        synthetic_npart_min=minp,
-        synthetic_npart_max=maxp,
-    )
-    val_data = SimpleIterDataset(
-        val_file_dict,
-        args.data_config,
-        for_training=True,
-        extra_selection=args.extra_selection,
-        load_range_and_fraction=(val_range, args.data_fraction),
-        file_fraction=args.file_fraction,
-        fetch_by_files=args.fetch_by_files,
-        fetch_step=args.fetch_step,
-        infinity_mode=args.steps_per_epoch_val is not None,
-        in_memory=args.in_memory,
-        laplace=args.laplace,
-        diffs=args.diffs,
-        edges=args.class_edges,
-        name="val" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
-        dataset_cap=args.val_cap,
-        n_noise=args.n_noise,
-        synthetic=synthetic,
-        synthetic_npart_min=minp,
-        synthetic_npart_max=maxp,
-    )
+    event_index = None
+    if args.event_index is not None:
+        event_index = EventIndex.build(sorted(set(train_files + val_files)), args.event_index)
+    train_sampler = val_sampler = None
+    if args.map_style:
+        if event_index is None:
+            raise RuntimeError("Must set --event-index when using --map-style!")
+        if args.save_iter_state:
+            raise RuntimeError("--save-iter-state cannot be used with --map-style")
+        num_replicas = len(args.gpus.split(",")) if args.gpus else 1
+        train_data = IndexedDataset(
+            event_index.subset(train_files),
+            args.data_config,
+            for_training=True,
+            extra_selection=args.extra_selection,
+            load_range_and_fraction=(train_range, args.data_fraction),
+            graph_cache=args.graph_cache,
+            graph_cache_max_bytes=args.graph_cache_max_gb * 1e9,
+            name="train" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
+        )
+        val_data = IndexedDataset(
+            event_index.subset(val_files),
+            args.data_config,
+            for_training=True,
+            extra_selection=args.extra_selection,
+            load_range_and_fraction=(val_range, args.data_fraction),
+            graph_cache=args.graph_cache,
+            graph_cache_max_bytes=args.graph_cache_max_gb * 1e9,
+            name="val" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
+        )
+        train_sampler = HitBalancedSampler(
+            train_data.n_hits,
+            num_replicas=num_replicas,
+            rank=args.local_rank,
+            chunk_ids=train_data.chunk_ids,
+        )
+        val_sampler = HitBalancedSampler(
+            val_data.n_hits, num_replicas=num_replicas, rank=args.local_rank, shuffle=False
+        )
+    else:
+        train_data = SimpleIterDataset(
+            train_file_dict,
+            args.data_config,
+            for_training=True,
+            extra_selection=args.extra_selection,
+            remake_weights=not args.no_remake_weights,
+            load_range_and_fraction=(train_range, args.data_fraction),
+            file_fraction=args.file_fraction,
+            fetch_by_files=args.fetch_by_files,
+            fetch_step=args.fetch_step,
+            infinity_mode=args.steps_per_epoch is not None,
+            in_memory=args.in_memory,
+            laplace=args.laplace,
+            diffs=args.diffs,
+            edges=args.class_edges,
+            name="train" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
+            dataset_cap=args.train_cap,
+            n_noise=args.n_noise,
+            synthetic=synthetic,
+            synthetic_npart_min=minp,
+            synthetic_npart_max=maxp,
+            graph_cache=args.graph_cache,
+            graph_cache_max_bytes=args.graph_cache_max_gb * 1e9,
+            read_threads=args.read_threads,
+            event_index=event_index,
+            shared_memory=args.shared_memory,
+            rank=args.local_rank,
+            num_replicas=len(args.gpus.split(",")) if args.gpus else 1,
+            pipeline=_parse_pipeline(args.pipeline),
+            iter_state_dir=os.path.join(args.model_prefix, "iter_state") if args.save_iter_state else None,
+            resume_state=None
+            if args.resume_iter_state is None
+            else load_iter_state(args.resume_iter_state, args.local_rank),
+        )
+        val_data = SimpleIterDataset(
+            val_file_dict,
+            args.data_config,
+            for_training=True,
+            extra_selection=args.extra_selection,
+            load_range_and_fraction=(val_range, args.data_fraction),
+            file_fraction=args.file_fraction,
+            fetch_by_files=args.fetch_by_files,
+            fetch_step=args.fetch_step,
+            infinity_mode=args.steps_per_epoch_val is not None,
+            in_memory=args.in_memory,
+            laplace=args.laplace,
+            diffs=args.diffs,
+            edges=args.class_edges,
+            name="val" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
+            dataset_cap=args.val_cap,
+            n_noise=args.n_noise,
+            synthetic=synthetic,
+            synthetic_npart_min=minp,
+            synthetic_npart_max=maxp,
+            graph_cache=args.graph_cache,
+            graph_cache_max_bytes=args.graph_cache_max_gb * 1e9,
+            read_threads=args.read_threads,
+            event_index=event_index,
+            shared_memory=args.shared_memory,
+            pipeline=_parse_pipeline(args.pipeline),
+        )
 
     if args.class_edges:
         collator_func = graph_batch_func_edges
     else:
         collator_func = graph_batch_func
+    train_collator_func = collator_func
+    if args.augment:
+        train_collator_func = AugmentedBatchFunc(
+            train_data.config,
+            rotate_phi="phi" in args.augment,
+            reflect_z="z" in args.augment,
+            collate=collator_func,
+        )
+    if args.save_iter_state and not args.map_style:
+        # batches tagged with their worker, counted by IterStateCheckpoint
+        train_collator_func = WorkerBatchFunc(train_collator_func)
     # train_data_arg = train_data
     # val_data_arg = val_data
     # if args.train_cap == 1:
     #    train_data_arg = [next(iter(train_data_arg))]
     # if args.val_cap == 1:
     #    val_data_arg = [next(iter(val_data_arg))]
+    train_batching = dict(batch_size=args.batch_size, sampler=train_sampler, drop_last=True)
+    val_batching = dict(batch_size=args.batch_size, sampler=val_sampler, drop_last=True)
+    if args.batch_hits > 0:
+        # batches packed up to a total number of hits instead of batch_size events
+        if args.map_style:
+            train_batching = dict(
+                batch_sampler=HitBudgetBatchSampler(
+                    train_data.n_hits,
+                    args.batch_hits,
+                    cost=args.batch_cost,
+                    sort_buffer=args.batch_sort_buffer,
+                    num_replicas=num_replicas,
+                    rank=args.local_rank,
+                    chunk_ids=train_data.chunk_ids,
+                )
+            )
+            val_batching = dict(
+                batch_sampler=HitBudgetBatchSampler(
+                    val_data.n_hits,
+                    args.batch_hits,
+                    cost=args.batch_cost,
+                    sort_buffer=args.batch_sort_buffer,
+                    num_replicas=num_replicas,
+                    rank=args.local_rank,
+                    shuffle=False,
+                )
+            )
+        else:
+            train_data = HitBudgetBatches(
+                train_data, args.batch_hits, args.batch_cost, args.batch_sort_buffer
+            )
+            val_data = HitBudgetBatches(
+                val_data, args.batch_hits, args.batch_cost, args.batch_sort_buffer
+            )
+            train_batching = val_batching = dict(batch_size=None)
     train_loader = DataLoader(
         train_data,
-        batch_size=args.batch_size,
-        drop_last=True,
+        **train_batching,
         pin_memory=True,
         num_workers=min(args.num_workers, int(len(train_files) * args.file_fraction)),
-        collate_fn=collator_func,
+        collate_fn=train_collator_func,
         persistent_workers=args.num_workers > 0 and args.steps_per_epoch is not None,
     )
     val_loader = DataLoader(
         val_data,
-        batch_size=args.batch_size,
-        drop_last=True,
+        **val_batching,
         pin_memory=True,
         collate_fn=collator_func,
         num_workers=min(args.num_workers, int(len(val_files) * args.file_fraction)),
@@ -334,6 +448,10 @@ def test_load(args):
             fetch_by_files=True,
             fetch_step=1,
             name="test_" + name,
+            graph_cache=args.graph_cache,
+            graph_cache_max_bytes=args.graph_cache_max_gb * 1e9,
+            read_threads=args.read_threads,
+            pipeline=_parse_pipeline(args.pipeline),
         )
         test_loader = DataLoader(
             test_data,